@@ -0,0 +1,29 @@
+-- AlterTable
+ALTER TABLE "LateDelay" ADD COLUMN "recordKey" TEXT;
+
+-- Backfill recordKey for existing rows with the same formula as late_record_key() in late-report:
+-- sha256 of normalized lower(driver)|lower(route)|planned|date, where date is the report day
+-- (delayDate is stored as midnight Europe/Moscow converted to UTC)
+UPDATE "LateDelay"
+SET "recordKey" = encode(sha256(convert_to(concat_ws('|',
+      lower(btrim(regexp_replace(replace("driverName", chr(160), ' '), '\s+', ' ', 'g'))),
+      lower(btrim(regexp_replace(replace("routeName", chr(160), ' '), '\s+', ' ', 'g'))),
+      btrim(regexp_replace(replace(COALESCE("plannedTime", ''), chr(160), ' '), '\s+', ' ', 'g')),
+      to_char(("delayDate" AT TIME ZONE 'UTC') AT TIME ZONE 'Europe/Moscow', 'YYYY-MM-DD')
+    ), 'UTF8')), 'hex')
+WHERE "recordKey" IS NULL;
+
+-- Remove duplicates created by repeated late-report uploads (keep the latest row per record key)
+DELETE FROM "LateDelay" a
+USING (
+  SELECT "id",
+         ROW_NUMBER() OVER (
+           PARTITION BY "recordKey"
+           ORDER BY "updatedAt" DESC, "createdAt" DESC
+         ) AS rn
+  FROM "LateDelay"
+) d
+WHERE a."id" = d."id" AND d.rn > 1;
+
+-- CreateIndex
+CREATE UNIQUE INDEX "LateDelay_recordKey_key" ON "LateDelay"("recordKey");
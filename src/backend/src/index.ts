@@ -4,6 +4,7 @@ import jwt from "@fastify/jwt";
 import cookie from "@fastify/cookie";
 import multipart from "@fastify/multipart";
 import fs from "fs";
+import zlib from "zlib";
 import path from "path";
 import Excel from "exceljs";
 import { PrismaClient, Prisma, ReceiptStatus, PaymentMethod, FuelType, DataSource } from "@prisma/client";
@@ -931,6 +932,82 @@ app.post("/api/receipts", async (req, reply) => {
 });
 
 // Late delays routes
+
+// Запись опозданий из tools/late-report: записи с record_key обновляются (upsert),
+// поэтому повторная отправка того же отчёта не создаёт дубликатов.
+app.post(
+  "/api/late-delays",
+  {
+    // late-report может сжимать тело запроса (API_GZIP=1)
+    preParsing: async (req, _reply, payload) => {
+      if (String(req.headers["content-encoding"] ?? "").toLowerCase() !== "gzip") return payload;
+      const gunzip = zlib.createGunzip();
+      (gunzip as any).receivedEncodedLength = Number(req.headers["content-length"] ?? 0);
+      payload.pipe(gunzip);
+      return gunzip;
+    },
+  },
+  async (req, reply) => {
+    const apiKey = process.env.LATE_DELAYS_API_KEY;
+    if (apiKey && req.headers["x-api-key"] !== apiKey) {
+      // allow JWT as alternative
+      const ok = await requireAuth(req, reply);
+      if (!ok) return;
+    } else if (!apiKey) {
+      // no API key configured: protect by auth
+      const ok = await requireAuth(req, reply);
+      if (!ok) return;
+    }
+
+    const body = (req.body ?? {}) as any;
+    const records = Array.isArray(body.records) ? body.records : [];
+    if (!records.length) return reply.code(400).send({ error: "records[] is required and must be non-empty" });
+
+    const rows: { recordKey: string | null; data: Prisma.LateDelayCreateInput }[] = [];
+    for (const r of records) {
+      const driverName = String(r?.driver_name ?? "").trim();
+      const routeName = String(r?.route_name ?? "").trim();
+      const delayDate = new Date(r?.delay_date);
+      const delayMinutes = Number.parseInt(String(r?.delay_minutes ?? ""), 10);
+      if (!driverName || !routeName || Number.isNaN(delayDate.getTime()) || Number.isNaN(delayMinutes)) {
+        return reply.code(400).send({ error: "driver_name, route_name, delay_minutes and delay_date are required", record: r });
+      }
+      const recordKey = typeof r?.record_key === "string" && r.record_key.trim() ? r.record_key.trim().slice(0, 128) : null;
+      rows.push({
+        recordKey,
+        data: {
+          driverName,
+          plateNumber: r?.plate_number ? String(r.plate_number).trim() : null,
+          routeName,
+          plannedTime: r?.planned_time ? String(r.planned_time).trim() : null,
+          assignedTime: r?.assigned_time ? String(r.assigned_time).trim() : null,
+          delayMinutes,
+          delayDate,
+        },
+      });
+    }
+
+    try {
+      await prisma.$transaction(
+        rows.map((row) =>
+          row.recordKey
+            ? prisma.lateDelay.upsert({
+                where: { recordKey: row.recordKey },
+                create: { ...row.data, recordKey: row.recordKey },
+                update: row.data,
+              })
+            : prisma.lateDelay.create({ data: row.data })
+        )
+      );
+    } catch (err: any) {
+      req.log.error({ err, count: rows.length }, "late delays save error");
+      return handlePrismaError(err, reply);
+    }
+    const upserted = rows.filter((row) => row.recordKey).length;
+    return reply.code(200).send({ saved: rows.length, upserted });
+  }
+);
+
 app.get("/api/late-delays", async (req, reply) => {
   if (!(await requireAuth(req, reply))) return;
   const q = (req.query ?? {}) as any;
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+Локальная замена Telegram Bot API для нагрузочных тестов доставки
+
+Реализует sendPhoto, sendMessage, sendMediaGroup и sendDocument с настраиваемой
+задержкой ответа, случайными ответами 429 и лимитом сообщений на чат.
+late_report.py направляется сюда через TG_API_BASE=http://127.0.0.1:8081
+
+Запуск: python3 src/fake_telegram_api.py --port 8081 --latency-ms 150 --chat-limit 20
+"""
+import argparse
+import email
+import email.policy
+import hashlib
+import json
+import logging
+import random
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
+logger = logging.getLogger(__name__)
+
+SUPPORTED_METHODS = ('sendPhoto', 'sendMessage', 'sendMediaGroup', 'sendDocument')
+
+
+class FakeTelegramState:
+    """Состояние сервера: счётчики, окна лимитов по чатам, загруженные файлы"""
+
+    def __init__(self, latency_ms: float = 0, jitter_ms: float = 0, error_rate: float = 0,
+                 retry_after: int = 1, chat_limit: int = 0, chat_window: float = 60, global_limit: int = 0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.chat_limit = chat_limit
+        self.chat_window = chat_window
+        self.global_limit = global_limit
+        self.lock = threading.Lock()
+        self.message_id = 0
+        self.chat_sends: Dict[str, deque] = {}
+        self.global_sends: deque = deque()
+        self.files: Dict[str, int] = {}
+        self.stats = {'requests': 0, 'messages': 0, 'uploaded_bytes': 0, 'rate_limited': 0, 'by_method': {}}
+        self.messages: List[Dict] = []
+
+    def check_limits(self, chat_id: str, cost: int) -> Optional[int]:
+        """retry_after, если отправка превысит лимит (общий - в секунду, на чат - за chat_window)
+
+        Альбом дороже самого лимита принимается, когда окно пусто, иначе он не прошёл бы никогда.
+        """
+        now = time.monotonic()
+        with self.lock:
+            if self.error_rate and random.random() < self.error_rate:
+                return self.retry_after
+            sends = self.chat_sends.setdefault(chat_id, deque())
+            while sends and now - sends[0] >= self.chat_window:
+                sends.popleft()
+            while self.global_sends and now - self.global_sends[0] >= 1:
+                self.global_sends.popleft()
+            if self.chat_limit and sends and len(sends) + cost > self.chat_limit:
+                return max(1, int(self.chat_window - (now - sends[0])) + 1)
+            if self.global_limit and self.global_sends and len(self.global_sends) + cost > self.global_limit:
+                return 1
+            sends.extend([now] * cost)
+            self.global_sends.extend([now] * cost)
+            return None
+
+    def next_message(self, chat_id: str, thread_id, **fields) -> Dict:
+        with self.lock:
+            self.message_id += 1
+            message = {
+                'message_id': self.message_id,
+                'date': int(time.time()),
+                'chat': {'id': int(chat_id) if str(chat_id).lstrip('-').isdigit() else chat_id},
+            }
+            if thread_id:
+                message['message_thread_id'] = int(thread_id)
+            message.update(fields)
+            self.stats['messages'] += 1
+            self.messages.append(message)
+            return message
+
+    def photo_sizes(self, data: Optional[bytes], file_id: Optional[str]) -> List[Dict]:
+        """Размеры фото как у Telegram; file_id детерминирован по содержимому"""
+        if data is not None:
+            file_id = 'fake-' + hashlib.sha256(data).hexdigest()[:32]
+            with self.lock:
+                self.files[file_id] = len(data)
+                self.stats['uploaded_bytes'] += len(data)
+        elif file_id not in self.files:
+            raise ValueError('Bad Request: wrong file identifier/HTTP URL specified')
+        size = self.files[file_id]
+        return [
+            {'file_id': f'{file_id}-thumb', 'file_unique_id': f'{file_id[-8:]}t', 'width': 320, 'height': 180, 'file_size': size // 10},
+            {'file_id': file_id, 'file_unique_id': file_id[-8:], 'width': 1280, 'height': 720, 'file_size': size},
+        ]
+
+
+def parse_form(content_type: str, body: bytes) -> Tuple[Dict[str, str], Dict[str, Tuple[str, bytes]]]:
+    """Разбор multipart/form-data, urlencoded или JSON тела: (поля, файлы)"""
+    if content_type.startswith('application/json'):
+        return {key: str(value) if not isinstance(value, str) else value for key, value in json.loads(body or b'{}').items()}, {}
+    if content_type.startswith('multipart/form-data'):
+        message = email.message_from_bytes(
+            f'Content-Type: {content_type}\r\n\r\n'.encode('latin-1') + body, policy=email.policy.HTTP)
+        fields, files = {}, {}
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            filename = part.get_filename()
+            payload = part.get_payload(decode=True) or b''
+            if filename is not None:
+                files[name] = (filename, payload)
+            else:
+                fields[name] = payload.decode('utf-8')
+        return fields, files
+    return dict(parse_qsl(body.decode('utf-8'))), {}
+
+
+def handle_method(state: FakeTelegramState, method: str, fields: Dict[str, str],
+                  files: Dict[str, Tuple[str, bytes]]) -> Tuple[int, Dict]:
+    """Ответ (HTTP-код, JSON) на вызов метода Bot API"""
+    chat_id = fields.get('chat_id')
+    if not chat_id:
+        return 400, {'ok': False, 'error_code': 400, 'description': 'Bad Request: chat_id is empty'}
+    thread_id = fields.get('message_thread_id')
+
+    media = json.loads(fields['media']) if method == 'sendMediaGroup' else None
+    if media is not None and not 2 <= len(media) <= 10:
+        return 400, {'ok': False, 'error_code': 400, 'description': 'Bad Request: wrong number of media items'}
+
+    retry_after = state.check_limits(chat_id, len(media) if media is not None else 1)
+    if retry_after is not None:
+        with state.lock:
+            state.stats['rate_limited'] += 1
+        return 429, {'ok': False, 'error_code': 429, 'description': f'Too Many Requests: retry after {retry_after}',
+                     'parameters': {'retry_after': retry_after}}
+
+    try:
+        if method == 'sendMessage':
+            text = fields.get('text', '')
+            if not 1 <= len(text) <= 4096:
+                return 400, {'ok': False, 'error_code': 400, 'description': 'Bad Request: message text is empty or too long'}
+            return 200, {'ok': True, 'result': state.next_message(chat_id, thread_id, text=text)}
+        if method == 'sendPhoto':
+            upload = files.get('photo')
+            photo = state.photo_sizes(upload[1] if upload else None, None if upload else fields.get('photo'))
+            return 200, {'ok': True, 'result': state.next_message(chat_id, thread_id, photo=photo, caption=fields.get('caption', ''))}
+        if method == 'sendDocument':
+            filename, data = files['document']
+            with state.lock:
+                state.stats['uploaded_bytes'] += len(data)
+            document = {'file_id': 'fake-doc-' + hashlib.sha256(data).hexdigest()[:32], 'file_name': filename, 'file_size': len(data)}
+            return 200, {'ok': True, 'result': state.next_message(chat_id, thread_id, document=document, caption=fields.get('caption', ''))}
+        # sendMediaGroup
+        group_id = str(random.getrandbits(63))
+        result = []
+        for item in media:
+            ref = item['media']
+            if ref.startswith('attach://'):
+                photo = state.photo_sizes(files[ref[len('attach://'):]][1], None)
+            else:
+                photo = state.photo_sizes(None, ref)
+            result.append(state.next_message(chat_id, thread_id, photo=photo, caption=item.get('caption', ''),
+                                             media_group_id=group_id))
+        return 200, {'ok': True, 'result': result}
+    except (KeyError, ValueError) as e:
+        return 400, {'ok': False, 'error_code': 400, 'description': f'Bad Request: {e}'}
+
+
+class FakeTelegramHandler(BaseHTTPRequestHandler):
+    """HTTP-обработчик: POST /bot<token>/<method>, GET /stats"""
+
+    state: FakeTelegramState = None
+
+    def _reply(self, status: int, payload: Dict) -> None:
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if status == 429:
+            self.send_header('Retry-After', str(payload['parameters']['retry_after']))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            with self.state.lock:
+                self._reply(200, self.state.stats)
+        else:
+            self._reply(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+
+    def do_POST(self):
+        parts = self.path.strip('/').split('/')
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if len(parts) != 2 or not parts[0].startswith('bot') or parts[1] not in SUPPORTED_METHODS:
+            self._reply(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+            return
+        method = parts[1]
+
+        delay = self.state.latency_ms + random.uniform(0, self.state.jitter_ms)
+        if delay > 0:
+            time.sleep(delay / 1000)
+
+        try:
+            fields, files = parse_form(self.headers.get('Content-Type', ''), body)
+        except Exception as e:
+            self._reply(400, {'ok': False, 'error_code': 400, 'description': f'Bad Request: {e}'})
+            return
+        status, payload = handle_method(self.state, method, fields, files)
+        with self.state.lock:
+            self.state.stats['requests'] += 1
+            by_method = self.state.stats['by_method'].setdefault(method, {})
+            by_method[str(status)] = by_method.get(str(status), 0) + 1
+        self._reply(status, payload)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def start_fake_telegram_api(host: str = '127.0.0.1', port: int = 0, **options) -> Tuple[ThreadingHTTPServer, str]:
+    """Запуск сервера в фоновом потоке (для тестов и бенчмарков): (сервер, base URL для TG_API_BASE)"""
+    state = FakeTelegramState(**options)
+    handler = type('Handler', (FakeTelegramHandler,), {'state': state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.state = state
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f'http://{host}:{server.server_address[1]}'
+
+
+def main():
+    """Запуск сервера из командной строки"""
+    parser = argparse.ArgumentParser(description='Fake Telegram Bot API for late-report delivery tests')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency-ms', type=float, default=100, help='задержка ответа, мс')
+    parser.add_argument('--jitter-ms', type=float, default=50, help='случайная добавка к задержке, мс')
+    parser.add_argument('--error-rate', type=float, default=0, help='доля случайных ответов 429 (0..1)')
+    parser.add_argument('--retry-after', type=int, default=1, help='retry_after для случайных 429, сек')
+    parser.add_argument('--chat-limit', type=int, default=20, help='сообщений на чат за --chat-window (0 - без лимита)')
+    parser.add_argument('--chat-window', type=float, default=60, help='окно лимита на чат, сек')
+    parser.add_argument('--global-limit', type=int, default=30, help='сообщений в секунду на бота (0 - без лимита)')
+    args = parser.parse_args()
+
+    server, base_url = start_fake_telegram_api(
+        args.host, args.port, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate,
+        retry_after=args.retry_after, chat_limit=args.chat_limit, chat_window=args.chat_window,
+        global_limit=args.global_limit,
+    )
+    logger.info(f"Fake Telegram Bot API listening on {base_url} (set TG_API_BASE={base_url})")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+        logger.info(f"Stats: {json.dumps(server.state.stats)}")
+
+
+if __name__ == '__main__':
+    main()
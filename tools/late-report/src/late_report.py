@@ -5,19 +5,33 @@ Late Report Service
 """
 
 import os
+import atexit
 import re
+import csv
+import html
 import json
 import imaplib
 import email
 import email.header
 import io
+import asyncio
 import hashlib
+import gzip
+import random
 import textwrap
 import time
+import threading
+import multiprocessing
+import sqlite3
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from queue import Queue, Empty, Full
+from functools import lru_cache
 from pathlib import Path
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
-from typing import List, Dict, Optional, Tuple
+from typing import List, Dict, Optional, Tuple, Iterable, Iterator
 import logging
 
 import pandas as pd
@@ -25,6 +39,9 @@ from PIL import Image, ImageDraw, ImageFont
 from imapclient import IMAPClient
 from dotenv import load_dotenv
 import requests
+import httpx
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Настройка логирования
 logging.basicConfig(
@@ -36,46 +53,122 @@ logging.basicConfig(
     ]
 )
 logger = logging.getLogger(__name__)
+# httpx логирует каждый запрос на уровне INFO (вместе с токеном бота в URL)
+logging.getLogger('httpx').setLevel(logging.WARNING)
 
 
-def load_config():
-    """Загрузка конфигурации из env файла"""
+def load_config(overrides: Optional[Dict] = None):
+    """Загрузка конфигурации из env файла
+
+    overrides - значения переменных окружения, которые важнее env (конфиг тенанта из TENANTS_FILE).
+    """
     env_path = os.getenv('LATE_REPORT_ENV', '/etc/late-report/late-report.env')
     if os.path.exists(env_path):
         load_dotenv(env_path)
     else:
         load_dotenv('.env')
     
-    attachment_regex = os.getenv('ATTACHMENT_NAME_REGEX', r'Соблюдение\s+сроков')
+    def getenv(name: str, default: Optional[str] = None) -> Optional[str]:
+        if overrides and overrides.get(name) is not None:
+            value = overrides[name]
+            # JSON true/false -> '1'/'0', как в env-файле
+            return ('1' if value else '0') if isinstance(value, bool) else str(value)
+        return os.getenv(name, default)
+    
+    attachment_regex = getenv('ATTACHMENT_NAME_REGEX', r'Соблюдение\s+сроков')
     # Если regex пустой - отключаем фильтр
     if not attachment_regex or attachment_regex.strip() == '':
         attachment_regex = None
     
     return {
-        'imap_host': os.getenv('YA_IMAP_HOST', 'imap.yandex.com'),
-        'imap_user': os.getenv('YA_IMAP_USER'),
-        'imap_pass': os.getenv('YA_IMAP_PASS'),
-        'mailbox': os.getenv('YA_MAILBOX', 'INBOX'),
+        'imap_host': getenv('YA_IMAP_HOST', 'imap.yandex.com'),
+        'imap_user': getenv('YA_IMAP_USER'),
+        'imap_pass': getenv('YA_IMAP_PASS'),
+        'mailbox': getenv('YA_MAILBOX', 'INBOX'),
         'attachment_regex': attachment_regex,
-        'tg_token': os.getenv('TG_TOKEN'),
-        'tg_chat_id': os.getenv('TG_CHAT_ID'),
-        'tg_topic_id_late': os.getenv('TG_TOPIC_ID_LATE', os.getenv('TG_TOPIC_ID', '26')),
-        'tg_topic_id_docs': os.getenv('TG_TOPIC_ID_DOCS', '2'),
-        'admin_chat_id': os.getenv('ADMIN_CHAT_ID'),
-        'dry_run': os.getenv('DRY_RUN', '0').lower() in ('1', 'true', 'yes'),
-        'send_if_empty': os.getenv('SEND_IF_EMPTY', 'false').lower() == 'true',
-        'run_late_report': False if os.getenv('DOCS_ONLY', '0').lower() in ('1', 'true', 'yes') else os.getenv('RUN_LATE_REPORT', '1').lower() in ('1', 'true', 'yes'),
-        'run_docs_report': True if os.getenv('DOCS_ONLY', '0').lower() in ('1', 'true', 'yes') else os.getenv('RUN_DOCS_REPORT', '1').lower() in ('1', 'true', 'yes'),
-        'state_path': os.getenv('STATE_PATH', '/var/lib/late-report/state.json'),
-        'state_file': os.getenv('STATE_FILE', '/opt/fuel-control/tools/late-report/state/processed.json'),
-        'imap_lookback_days': int(os.getenv('IMAP_LOOKBACK_DAYS', '3')),
-        'imap_max_uids': int(os.getenv('IMAP_MAX_UIDS', '500')),
-        'report_tz': os.getenv('REPORT_TZ', 'Europe/Moscow'),
-        'force_resend': os.getenv('FORCE_RESEND', '0').lower() in ('1', 'true', 'yes'),
-        'dry_run': os.getenv('DRY_RUN', '0').lower() in ('1', 'true', 'yes'),
-        'docs_only': os.getenv('DOCS_ONLY', '0').lower() in ('1', 'true', 'yes'),
-        'docs_date_token': os.getenv('DOCS_DATE_TOKEN'),  # Override для тестов
-        'test_limit': int(os.getenv('TEST_LIMIT', '10')),
+        'tg_token': getenv('TG_TOKEN'),
+        'tg_chat_id': getenv('TG_CHAT_ID'),
+        'tg_topic_id_late': getenv('TG_TOPIC_ID_LATE', getenv('TG_TOPIC_ID', '26')),
+        'tg_topic_id_docs': getenv('TG_TOPIC_ID_DOCS', '2'),
+        'admin_chat_id': getenv('ADMIN_CHAT_ID'),
+        'dry_run': getenv('DRY_RUN', '0').lower() in ('1', 'true', 'yes'),
+        'send_if_empty': getenv('SEND_IF_EMPTY', 'false').lower() == 'true',
+        'run_late_report': False if getenv('DOCS_ONLY', '0').lower() in ('1', 'true', 'yes') else getenv('RUN_LATE_REPORT', '1').lower() in ('1', 'true', 'yes'),
+        'run_docs_report': True if getenv('DOCS_ONLY', '0').lower() in ('1', 'true', 'yes') else getenv('RUN_DOCS_REPORT', '1').lower() in ('1', 'true', 'yes'),
+        'state_path': getenv('STATE_PATH', '/var/lib/late-report/state.json'),
+        'state_file': getenv('STATE_FILE', '/opt/fuel-control/tools/late-report/state/processed.json'),
+        'imap_lookback_days': int(getenv('IMAP_LOOKBACK_DAYS', '3')),
+        'imap_max_uids': int(getenv('IMAP_MAX_UIDS', '500')),
+        'imap_meta_index': getenv('IMAP_META_INDEX', '1').lower() in ('1', 'true', 'yes'),
+        'content_dedup_hours': float(getenv('CONTENT_DEDUP_HOURS', '12')),
+        'late_latest_date_only': getenv('LATE_LATEST_DATE_ONLY', '0').lower() in ('1', 'true', 'yes'),
+        # Конвейер прогона: подмножество стадий, параллельный режим, размер очередей между стадиями
+        'pipeline_stages': [name.strip() for name in getenv('PIPELINE_STAGES', '').split(',') if name.strip()],
+        'pipeline_concurrent': getenv('PIPELINE_CONCURRENT', '0').lower() in ('1', 'true', 'yes'),
+        'pipeline_queue_size': int(getenv('PIPELINE_QUEUE_SIZE', '4')),
+        # Мультитенантный режим: JSON-список конфигов тенантов, общий процесс и пулы
+        'tenants_file': getenv('TENANTS_FILE'),
+        'tenant_workers': int(getenv('TENANT_WORKERS', '4')),
+        'tenant_delivery_slots': int(getenv('TENANT_DELIVERY_SLOTS', '2')),
+        'report_tz': getenv('REPORT_TZ', 'Europe/Moscow'),
+        'force_resend': getenv('FORCE_RESEND', '0').lower() in ('1', 'true', 'yes'),
+        'dry_run': getenv('DRY_RUN', '0').lower() in ('1', 'true', 'yes'),
+        'docs_only': getenv('DOCS_ONLY', '0').lower() in ('1', 'true', 'yes'),
+        'docs_date_token': getenv('DOCS_DATE_TOKEN'),  # Override для тестов
+        'test_limit': int(getenv('TEST_LIMIT', '10')),
+        # Постраничная отрисовка больших таблиц
+        'png_max_page_height': int(getenv('PNG_MAX_PAGE_HEIGHT', '2000')),
+        'png_max_page_pixels': int(getenv('PNG_MAX_PAGE_PIXELS', '4000000')),
+        'png_max_page_bytes': int(getenv('PNG_MAX_PAGE_BYTES', str(5 * 1024 * 1024))),
+        # Формат отчётов: image (PNG) | text (Telegram-HTML <pre>) | html | csv (файл)
+        'report_output': getenv('REPORT_OUTPUT', 'image').lower(),
+        # Что делать с водителями, у которых набор документов не изменился: send | reference | skip
+        'docs_unchanged_mode': getenv('DOCS_UNCHANGED_MODE', 'send').lower(),
+        # Параллельный рендер docs-таблиц (процессы)
+        'render_workers': int(getenv('RENDER_WORKERS', str(min(4, os.cpu_count() or 1)))),
+        'render_max_inflight': int(getenv('RENDER_MAX_INFLIGHT', '0')) or None,
+        # Кодирование картинок
+        'image_format': getenv('IMAGE_FORMAT', 'png').lower(),
+        'image_palette_colors': int(getenv('IMAGE_PALETTE_COLORS', '32')),
+        'image_quality': int(getenv('IMAGE_QUALITY', '85')),
+        'png_compress_level': int(getenv('PNG_COMPRESS_LEVEL', '9')),
+        'image_target_bytes': int(getenv('IMAGE_TARGET_BYTES', '0')),
+        # Каталог для сохранения отрендеренных картинок (только для отладки)
+        'debug_image_dir': getenv('DEBUG_IMAGE_DIR'),
+        'http_pool_size': int(getenv('HTTP_POOL_SIZE', '10')),
+        'http_pool_hosts': int(getenv('HTTP_POOL_HOSTS', '4')),
+        'http_connect_retries': int(getenv('HTTP_CONNECT_RETRIES', '3')),
+        'http_retry_backoff': float(getenv('HTTP_RETRY_BACKOFF', '0.5')),
+        'docs_delivery': getenv('DOCS_DELIVERY', 'album').strip().lower(),
+        'tg_global_rate': float(getenv('TG_GLOBAL_RATE', '30')),
+        'tg_chat_rate': float(getenv('TG_CHAT_RATE', '1')),
+        'tg_chat_min_rate': float(getenv('TG_CHAT_MIN_RATE', '0.3')),
+        'tg_chat_burst': float(getenv('TG_CHAT_BURST', '3')),
+        'tg_rate_increase': float(getenv('TG_RATE_INCREASE', '0.05')),
+        'tg_max_retries': int(getenv('TG_MAX_RETRIES', '5')),
+        'delivery_engine': getenv('DELIVERY_ENGINE', 'sync').strip().lower(),
+        'async_uploads': int(getenv('ASYNC_UPLOADS', '3')),
+        'async_queue_size': int(getenv('ASYNC_QUEUE_SIZE', '20')),
+        'outbox_enabled': getenv('OUTBOX_ENABLED', '1').lower() in ('1', 'true', 'yes'),
+        'outbox_path': getenv('OUTBOX_PATH', '/var/lib/late-report/outbox.sqlite'),
+        'outbox_max_attempts': int(getenv('OUTBOX_MAX_ATTEMPTS', '10')),
+        'outbox_max_age_hours': float(getenv('OUTBOX_MAX_AGE_HOURS', '48')),
+        'file_id_cache_path': getenv('FILE_ID_CACHE_PATH', '/var/lib/late-report/file_ids.json'),
+        'tg_api_base': getenv('TG_API_BASE', 'https://api.telegram.org'),
+        'api_base_url': getenv('API_BASE_URL', 'http://localhost:3000'),
+        'api_key': getenv('LATE_DELAYS_API_KEY'),
+        'api_spool_path': getenv('API_SPOOL_PATH', '/var/lib/late-report/api_spool.jsonl'),
+        'api_spool_max_bytes': int(getenv('API_SPOOL_MAX_BYTES', str(50 * 1024 * 1024))),
+        'state_backend': getenv('STATE_BACKEND', 'sqlite').strip().lower(),
+        'state_db_path': getenv('STATE_DB_PATH', '/opt/fuel-control/tools/late-report/state/processed.sqlite'),
+        'state_commit_batch': int(getenv('STATE_COMMIT_BATCH', '100')),
+        'state_journal_path': getenv('STATE_JOURNAL_PATH', '/opt/fuel-control/tools/late-report/state/processed.journal'),
+        'state_fsync_batch': int(getenv('STATE_FSYNC_BATCH', '50')),
+        'api_chunk_size': int(getenv('API_CHUNK_SIZE', '500')),
+        'api_gzip': getenv('API_GZIP', '0').lower() in ('1', 'true', 'yes'),
+        'api_max_retries': int(getenv('API_MAX_RETRIES', '4')),
+        'api_retry_backoff': float(getenv('API_RETRY_BACKOFF', '1')),
+        'api_timeout': float(getenv('API_TIMEOUT', '30')),
     }
 
 
@@ -96,20 +189,558 @@ def load_state(state_path: str) -> Dict:
     return {'processed_uids': [], 'processed_file_hashes': []}
 
 
+def _fsync_dir(path: str) -> None:
+    """fsync каталога, чтобы переименование файла пережило сбой питания"""
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def atomic_write_json(path: str, data, indent: Optional[int] = 2) -> None:
+    """Запись JSON через временный файл, fsync и os.replace: файл всегда целый (старый или новый)"""
+    target_dir = os.path.dirname(path)
+    if target_dir:
+        os.makedirs(target_dir, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=indent, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    _fsync_dir(path)
+
+
 def save_state(state_path: str, state: Dict):
     """Сохранение состояния"""
     try:
-        state_dir = os.path.dirname(state_path)
-        if state_dir:
-            os.makedirs(state_dir, exist_ok=True)
-        with open(state_path, 'w', encoding='utf-8') as f:
-            json.dump(state, f, indent=2, ensure_ascii=False)
+        atomic_write_json(state_path, state)
     except PermissionError as e:
         logger.warning(f"Permission denied saving state to {state_path}: {e}. State will not be persisted.")
     except Exception as e:
         logger.error(f"Failed to save state: {e}")
 
 
+# Состояние меняют несколько стадий (в т.ч. параллельно при PIPELINE_CONCURRENT)
+_STATE_LOCK = threading.Lock()
+
+
+@contextmanager
+def updated_state(state_path: str) -> Iterator[Dict]:
+    """Чтение-изменение-запись state под общей блокировкой: правки других стадий не теряются"""
+    with _STATE_LOCK:
+        state = load_state(state_path)
+        yield state
+        save_state(state_path, state)
+
+
+def open_outbox(config: Dict) -> sqlite3.Connection:
+    """Открытие outbox (SQLite): очередь запросов к Telegram, переживающая перезапуск
+
+    outbox - по строке на запрос Bot API (единица доставки = unit_key + seq),
+    outbox_files - содержимое файлов запросов (картинки, документы).
+    """
+    path = config['outbox_path']
+    outbox_dir = os.path.dirname(path)
+    if outbox_dir:
+        os.makedirs(outbox_dir, exist_ok=True)
+    # async-движок пишет в outbox из потока рендера и из event loop (доступ под блокировкой)
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript('''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            idempotency_key TEXT UNIQUE NOT NULL,
+            unit_key TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            drivers TEXT NOT NULL,
+            method TEXT NOT NULL,
+            cost REAL NOT NULL,
+            params TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt REAL NOT NULL DEFAULT 0,
+            last_error TEXT,
+            created_at REAL NOT NULL,
+            sent_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS outbox_status ON outbox (status, next_attempt);
+        CREATE TABLE IF NOT EXISTS outbox_files (
+            outbox_id INTEGER NOT NULL,
+            field TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            mime_type TEXT NOT NULL,
+            data BLOB NOT NULL,
+            PRIMARY KEY (outbox_id, field)
+        );
+    ''')
+    return conn
+
+
+def outbox_request_key(method: str, kwargs: Dict) -> str:
+    """Хеш содержимого запроса (метод, параметры, файлы)"""
+    digest = hashlib.sha256(method.encode('utf-8'))
+    params = {key: value for key, value in kwargs.items() if key != 'files'}
+    digest.update(json.dumps(params, ensure_ascii=False, sort_keys=True).encode('utf-8'))
+    for field, (filename, data, mime_type) in sorted(kwargs.get('files', {}).items()):
+        digest.update(f"{field}:{filename}:{mime_type}".encode('utf-8'))
+        digest.update(hashlib.sha256(data).digest())
+    return digest.hexdigest()
+
+
+def outbox_enqueue(config: Dict, conn: sqlite3.Connection, unit_prefix: str, drivers: List[Tuple[str, int]],
+                   requests_list: List[Tuple[str, float, Dict]]) -> Tuple[List[int], List[Tuple[str, float, Dict]]]:
+    """Запись единицы доставки в outbox до отправки
+
+    Ключ идемпотентности - префикс запуска (отчёт и дата) + хеш запроса: уже отправленные
+    запросы повторно не отправляются (кроме FORCE_RESEND). Возвращает id и запросы,
+    которые ещё нужно отправить.
+    """
+    now = time.time()
+    request_keys = [outbox_request_key(method, kwargs) for method, _, kwargs in requests_list]
+    unit_key = f"{unit_prefix}:{hashlib.sha256(''.join(request_keys).encode('utf-8')).hexdigest()[:16]}"
+    outbox_ids = []
+    pending = []
+    with conn:
+        for seq, ((method, cost, kwargs), request_key) in enumerate(zip(requests_list, request_keys)):
+            idempotency_key = f"{unit_prefix}:{request_key}"
+            row = conn.execute('SELECT id, status FROM outbox WHERE idempotency_key = ?', (idempotency_key,)).fetchone()
+            if row is None:
+                params = {key: value for key, value in kwargs.items() if key != 'files'}
+                cursor = conn.execute(
+                    'INSERT INTO outbox (idempotency_key, unit_key, seq, drivers, method, cost, params, created_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (idempotency_key, unit_key, seq, json.dumps(drivers, ensure_ascii=False), method, cost,
+                     json.dumps(params, ensure_ascii=False), now),
+                )
+                outbox_id = cursor.lastrowid
+                for field, (filename, data, mime_type) in kwargs.get('files', {}).items():
+                    conn.execute('INSERT INTO outbox_files (outbox_id, field, filename, mime_type, data) VALUES (?, ?, ?, ?, ?)',
+                                 (outbox_id, field, filename, mime_type, data))
+            else:
+                outbox_id, status = row
+                if status == 'sent' and not config.get('force_resend', False):
+                    continue
+                conn.execute("UPDATE outbox SET status = 'pending', next_attempt = 0 WHERE id = ?", (outbox_id,))
+            outbox_ids.append(outbox_id)
+            pending.append((method, cost, kwargs))
+    return outbox_ids, pending
+
+
+def outbox_mark(config: Dict, conn: sqlite3.Connection, outbox_ids: List[int], done: int,
+                requests_list: List[Tuple[str, float, Dict]]) -> None:
+    """Отметка результата: первые done запросов отправлены, остальные - повтор с backoff"""
+    now = time.time()
+    max_attempts = config.get('outbox_max_attempts', 10)
+    with conn:
+        conn.executemany("UPDATE outbox SET status = 'sent', sent_at = ?, attempts = attempts + 1 WHERE id = ?",
+                         [(now, outbox_id) for outbox_id in outbox_ids[:done]])
+        if done < len(outbox_ids):
+            failed_id = outbox_ids[done]
+            attempts = conn.execute('SELECT attempts FROM outbox WHERE id = ?', (failed_id,)).fetchone()[0] + 1
+            status = 'dead' if attempts >= max_attempts else 'pending'
+            delay = min(3600, 30 * 2 ** (attempts - 1))
+            conn.execute('UPDATE outbox SET status = ?, attempts = ?, next_attempt = ?, last_error = ? WHERE id = ?',
+                         (status, attempts, now + delay, f"failed {requests_list[done][0]}", failed_id))
+            if status == 'dead':
+                # Остаток единицы без упавшего запроса не отправляем (альбом/страницы неполные)
+                conn.execute("UPDATE outbox SET status = 'dead' WHERE status = 'pending' AND unit_key = "
+                             "(SELECT unit_key FROM outbox WHERE id = ?)", (failed_id,))
+                logger.error(f"Outbox: {requests_list[done][0]} gave up after {attempts} attempts")
+
+
+def outbox_pending_units(config: Dict, conn: sqlite3.Connection) -> List[Tuple[str, List[Tuple[str, int]], List[int], List[Tuple[str, float, Dict]]]]:
+    """Недоставленные единицы, готовые к повтору, в порядке постановки в очередь"""
+    now = time.time()
+    max_age = config.get('outbox_max_age_hours', 48) * 60 * 60
+    with conn:
+        expired = conn.execute("UPDATE outbox SET status = 'expired' WHERE status = 'pending' AND created_at < ?", (now - max_age,)).rowcount
+        if expired:
+            logger.warning(f"Outbox: {expired} requests older than {config.get('outbox_max_age_hours', 48)}h expired")
+        # Отправленные и просроченные записи храним неделю (идемпотентность повторных запусков)
+        old_ids = "SELECT id FROM outbox WHERE status != 'pending' AND created_at < ?"
+        conn.execute(f'DELETE FROM outbox_files WHERE outbox_id IN ({old_ids})', (now - 7 * 24 * 60 * 60,))
+        conn.execute("DELETE FROM outbox WHERE status != 'pending' AND created_at < ?", (now - 7 * 24 * 60 * 60,))
+    
+    units = {}
+    rows = conn.execute(
+        "SELECT id, unit_key, drivers, method, cost, params FROM outbox "
+        "WHERE status = 'pending' AND unit_key NOT IN "
+        "(SELECT unit_key FROM outbox WHERE status = 'pending' AND next_attempt > ?) ORDER BY id",
+        (now,),
+    ).fetchall()
+    for outbox_id, unit_key, drivers, method, cost, params in rows:
+        kwargs = json.loads(params)
+        files = {
+            field: (filename, data, mime_type)
+            for field, filename, mime_type, data in conn.execute(
+                'SELECT field, filename, mime_type, data FROM outbox_files WHERE outbox_id = ?', (outbox_id,))
+        }
+        if files:
+            kwargs['files'] = files
+        unit = units.setdefault(unit_key, (unit_key, [tuple(driver) for driver in json.loads(drivers)], [], []))
+        unit[2].append(outbox_id)
+        unit[3].append((method, cost, kwargs))
+    return list(units.values())
+
+
+def drain_outbox(config: Dict) -> None:
+    """Дозапуск недоставленных запросов из outbox (в начале каждого запуска)"""
+    if not config.get('outbox_enabled', True) or config.get('dry_run', False) or not os.path.exists(config['outbox_path']):
+        return
+    conn = open_outbox(config)
+    try:
+        units = outbox_pending_units(config, conn)
+        if not units:
+            return
+        logger.info(f"Outbox: resuming {len(units)} undelivered units")
+        for unit_key, drivers, outbox_ids, requests_list in units:
+            done = deliver_requests(config, requests_list)
+            outbox_mark(config, conn, outbox_ids, done, requests_list)
+            names = ', '.join(str(fio) for fio, _ in drivers)
+            if done == len(requests_list):
+                logger.info(f"Outbox: delivered {unit_key} ({names})")
+            else:
+                logger.error(f"Outbox: still undelivered {unit_key} ({names})")
+        save_file_id_cache(config)
+    finally:
+        conn.close()
+
+
+class ProcessedKeyStore:
+    """Обработанные ключи вложений в SQLite (WAL) с интерфейсом словаря {key: timestamp}
+
+    Поиск и вставка - по первичному ключу; новые ключи копятся в памяти и
+    записываются одной транзакцией по STATE_COMMIT_BATCH штук или при flush().
+    Доступ из нескольких потоков (стадии конвейера) сериализуется блокировкой.
+    """
+    
+    def __init__(self, path: str, commit_batch: int = 100):
+        state_dir = os.path.dirname(path)
+        if state_dir:
+            os.makedirs(state_dir, exist_ok=True)
+        self.path = path
+        self.commit_batch = max(1, commit_batch)
+        self.pending: Dict[str, float] = {}
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS processed_keys (
+                key TEXT PRIMARY KEY,
+                ts REAL NOT NULL
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS processed_keys_ts ON processed_keys (ts);
+        ''')
+    
+    def __contains__(self, key: str) -> bool:
+        with self.lock:
+            if key in self.pending:
+                return True
+            return self.conn.execute('SELECT 1 FROM processed_keys WHERE key = ?', (key,)).fetchone() is not None
+    
+    def __getitem__(self, key: str) -> float:
+        with self.lock:
+            if key in self.pending:
+                return self.pending[key]
+            row = self.conn.execute('SELECT ts FROM processed_keys WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return row[0]
+    
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+    
+    def __setitem__(self, key: str, ts: float) -> None:
+        with self.lock:
+            self.pending[key] = ts
+            if len(self.pending) >= self.commit_batch:
+                self.flush()
+    
+    def __len__(self) -> int:
+        with self.lock:
+            self.flush()
+            return self.conn.execute('SELECT COUNT(*) FROM processed_keys').fetchone()[0]
+    
+    def update(self, items: Dict[str, float]) -> None:
+        for key, ts in items.items():
+            self[key] = ts
+    
+    def items_since(self, since_ts: float) -> List[Tuple[str, float]]:
+        """Ключи, обработанные не раньше since_ts (по индексу ts)"""
+        with self.lock:
+            self.flush()
+            return self.conn.execute('SELECT key, ts FROM processed_keys WHERE ts >= ?', (since_ts,)).fetchall()
+    
+    def flush(self) -> None:
+        """Запись накопленных ключей одной транзакцией"""
+        with self.lock:
+            if not self.pending:
+                return
+            with self.conn:
+                self.conn.executemany('INSERT OR REPLACE INTO processed_keys (key, ts) VALUES (?, ?)', self.pending.items())
+            self.pending.clear()
+    
+    def prune(self, max_age_days: int = 30, max_keys: int = 5000) -> None:
+        """Удаление ключей старше max_age_days и сверх max_keys самых новых (по индексу ts)"""
+        with self.lock:
+            self.flush()
+            with self.conn:
+                self.conn.execute('DELETE FROM processed_keys WHERE ts < ?', (time.time() - max_age_days * 24 * 60 * 60,))
+                self.conn.execute(
+                    'DELETE FROM processed_keys WHERE ts < (SELECT ts FROM processed_keys ORDER BY ts DESC LIMIT 1 OFFSET ?)',
+                    (max_keys - 1,),
+                )
+    
+    def close(self) -> None:
+        with self.lock:
+            self.flush()
+            self.conn.close()
+
+
+class JournalKeyStore:
+    """Обработанные ключи в append-only журнале (строка "ts<TAB>key" на ключ)
+
+    Запись ключа - дозапись строки; fsync раз в STATE_FSYNC_BATCH ключей и при flush().
+    Оборванная при сбое последняя строка при загрузке пропускается. Журнал
+    периодически сжимается: снимок живых ключей пишется во временный файл и
+    атомарно заменяет журнал. Запись из нескольких потоков сериализуется блокировкой.
+    """
+    
+    def __init__(self, path: str, fsync_batch: int = 50):
+        journal_dir = os.path.dirname(path)
+        if journal_dir:
+            os.makedirs(journal_dir, exist_ok=True)
+        self.path = path
+        self.fsync_batch = max(1, fsync_batch)
+        self.keys: Dict[str, float] = {}
+        self.lock = threading.RLock()
+        self.lines = 0
+        self.unsynced = 0
+        self._load()
+        self.file = open(path, 'a', encoding='utf-8')
+    
+    def _load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        damaged = 0
+        with open(self.path, 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                self.lines += 1
+                ts, sep, key = line.rstrip('\n').partition('\t')
+                try:
+                    if not line.endswith('\n') or not sep or not key:
+                        raise ValueError(line)
+                    self.keys[key] = float(ts)
+                except ValueError:
+                    damaged += 1
+        if damaged:
+            logger.warning(f"Skipped {damaged} damaged lines in journal {self.path}")
+            # Оборванный хвост нельзя оставлять: следующая запись склеится с ним
+            self.compact()
+    
+    def __contains__(self, key: str) -> bool:
+        return key in self.keys
+    
+    def __getitem__(self, key: str) -> float:
+        return self.keys[key]
+    
+    def get(self, key: str, default=None):
+        return self.keys.get(key, default)
+    
+    def __setitem__(self, key: str, ts: float) -> None:
+        with self.lock:
+            self.keys[key] = ts
+            self.file.write(f"{ts:.6f}\t{key}\n")
+            self.lines += 1
+            self.unsynced += 1
+            if self.unsynced >= self.fsync_batch:
+                self.flush()
+    
+    def __len__(self) -> int:
+        return len(self.keys)
+    
+    def update(self, items: Dict[str, float]) -> None:
+        for key, ts in items.items():
+            self[key] = ts
+    
+    def items_since(self, since_ts: float) -> List[Tuple[str, float]]:
+        """Ключи, обработанные не раньше since_ts"""
+        with self.lock:
+            return [(key, ts) for key, ts in self.keys.items() if ts >= since_ts]
+    
+    def flush(self) -> None:
+        """Сброс дозаписанных строк на диск"""
+        with self.lock:
+            if self.unsynced:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.unsynced = 0
+    
+    def compact(self) -> None:
+        """Перезапись журнала только живыми ключами (временный файл + os.replace)"""
+        file = getattr(self, 'file', None)
+        if file is not None:
+            self.flush()
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for key, ts in self.keys.items():
+                f.write(f"{ts:.6f}\t{key}\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        _fsync_dir(self.path)
+        self.lines = len(self.keys)
+        if file is not None:
+            file.close()
+            self.file = open(self.path, 'a', encoding='utf-8')
+    
+    def prune(self, max_age_days: int = 30, max_keys: int = 5000) -> None:
+        """Удаление старых ключей и из памяти, и из журнала
+
+        Если ключи удалены, журнал сжимается сразу, иначе они вернулись бы при
+        следующей загрузке. Без удалений сжатие - когда мёртвых строк больше, чем живых.
+        """
+        cutoff = time.time() - max_age_days * 24 * 60 * 60
+        with self.lock:
+            live = {key: ts for key, ts in self.keys.items() if ts >= cutoff}
+            if len(live) > max_keys:
+                live = dict(sorted(live.items(), key=lambda x: x[1], reverse=True)[:max_keys])
+            removed = len(self.keys) - len(live)
+            self.keys = live
+            if removed or self.lines > 2 * len(self.keys) + 1000:
+                self.compact()
+            else:
+                self.flush()
+    
+    def close(self) -> None:
+        with self.lock:
+            self.flush()
+            self.file.close()
+
+
+class DryRunKeyStore:
+    """Обработанные ключи для DRY_RUN: читаются из хранилища, новые живут только в памяти
+
+    Ключи, отмеченные в прогоне, видны до его конца (повторное вложение не
+    обрабатывается дважды), но ни в SQLite, ни в журнал, ни в processed.json
+    не попадают и при закрытии отбрасываются: следующий настоящий прогон их не пропустит.
+    """
+    
+    def __init__(self, base):
+        self.base = base
+        self.path = getattr(base, 'path', None)
+        self.keys: Dict[str, float] = {}
+    
+    def __contains__(self, key: str) -> bool:
+        return key in self.keys or key in self.base
+    
+    def __getitem__(self, key: str) -> float:
+        if key in self.keys:
+            return self.keys[key]
+        return self.base[key]
+    
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+    
+    def __setitem__(self, key: str, ts: float) -> None:
+        self.keys[key] = ts
+    
+    def __len__(self) -> int:
+        return len(self.base) + sum(1 for key in self.keys if key not in self.base)
+    
+    def update(self, items: Dict[str, float]) -> None:
+        self.keys.update(items)
+    
+    def items(self) -> List[Tuple[str, float]]:
+        if hasattr(self.base, 'items_since'):
+            base_items = self.base.items_since(0)
+        else:
+            base_items = list(self.base.items())
+        return list({**dict(base_items), **self.keys}.items())
+    
+    def items_since(self, since_ts: float) -> List[Tuple[str, float]]:
+        return [(key, ts) for key, ts in self.items() if ts and ts >= since_ts]
+    
+    def flush(self) -> None:
+        pass
+    
+    def prune(self, max_age_days: int = 30, max_keys: int = 5000) -> None:
+        pass
+    
+    def close(self) -> None:
+        if self.keys:
+            logger.info(f"[DRY_RUN] Discarding {len(self.keys)} processed keys")
+        self.keys.clear()
+        if hasattr(self.base, 'close'):
+            self.base.close()
+
+
+def content_hash_index(processed_keys, window_hours: float) -> Dict[str, str]:
+    """sha256 содержимого -> первый ключ uid:att_index:sha256 с этим содержимым за последние window_hours часов"""
+    since_ts = time.time() - window_hours * 60 * 60
+    if hasattr(processed_keys, 'items_since'):
+        items = processed_keys.items_since(since_ts)
+    else:
+        # Старый формат-список не хранит время: такие ключи в окно не попадают
+        items = [(key, ts) for key, ts in processed_keys.items() if ts and ts >= since_ts]
+    index = {}
+    for key, _ts in sorted(items, key=lambda x: x[1]):
+        index.setdefault(key.rsplit(':', 1)[-1], key)
+    return index
+
+
+def migrate_processed_keys_json(store, state_file: str) -> None:
+    """Однократный перенос ключей из processed.json (оба формата) в хранилище"""
+    if not os.path.exists(state_file):
+        return
+    keys = load_processed_keys(state_file)
+    now = time.time()
+    # Старый формат-список не хранит время: считаем ключи обработанными в момент миграции
+    store.update({key: ts or now for key, ts in keys.items()})
+    store.flush()
+    migrated_path = f"{state_file}.migrated"
+    os.replace(state_file, migrated_path)
+    logger.info(f"Migrated {len(keys)} processed keys from {state_file} to {store.path} (old file kept as {migrated_path})")
+
+
+def open_processed_keys(config: Dict):
+    """Хранилище обработанных ключей по STATE_BACKEND: sqlite (по умолчанию), journal или json (словарь)
+
+    В DRY_RUN хранилище оборачивается в DryRunKeyStore: новые ключи не сохраняются.
+    """
+    backend = config.get('state_backend', 'sqlite')
+    if backend == 'json':
+        keys = load_processed_keys(config['state_file'])
+        return DryRunKeyStore(keys) if config.get('dry_run', False) else keys
+    if backend == 'journal':
+        store = JournalKeyStore(config['state_journal_path'], fsync_batch=config.get('state_fsync_batch', 50))
+    else:
+        store = ProcessedKeyStore(config['state_db_path'], commit_batch=config.get('state_commit_batch', 100))
+    # Накопленные ключи фиксируются и при раннем выходе из main()
+    atexit.register(store.close)
+    if config.get('dry_run', False):
+        return DryRunKeyStore(store)
+    try:
+        migrate_processed_keys_json(store, config['state_file'])
+    except Exception as e:
+        logger.warning(f"Failed to migrate processed keys from {config['state_file']}: {e}")
+    return store
+
+
 def load_processed_keys(state_file: str) -> Dict[str, float]:
     """Загрузка обработанных ключей из state файла"""
     if os.path.exists(state_file):
@@ -128,7 +759,19 @@ def load_processed_keys(state_file: str) -> Dict[str, float]:
 
 
 def save_processed_keys(state_file: str, processed_keys: Dict[str, float], max_age_days: int = 30, max_keys: int = 5000):
-    """Сохранение обработанных ключей с ограничением размера"""
+    """Сохранение обработанных ключей с ограничением размера
+
+    Для ProcessedKeyStore - фиксация накопленных ключей и очистка в SQL, файл не переписывается.
+    DryRunKeyStore (DRY_RUN) ничего не сохраняет.
+    """
+    if isinstance(processed_keys, DryRunKeyStore):
+        return
+    if isinstance(processed_keys, (ProcessedKeyStore, JournalKeyStore)):
+        try:
+            processed_keys.prune(max_age_days=max_age_days, max_keys=max_keys)
+        except Exception as e:
+            logger.error(f"Failed to save processed keys to {processed_keys.path}: {e}")
+        return
     try:
         # Создаём папку если не существует
         state_dir = os.path.dirname(state_file)
@@ -151,8 +794,7 @@ def save_processed_keys(state_file: str, processed_keys: Dict[str, float], max_a
             filtered_keys = dict(sorted_items[:max_keys])
         
         # Сохраняем
-        with open(state_file, 'w', encoding='utf-8') as f:
-            json.dump(filtered_keys, f, indent=2, ensure_ascii=False)
+        atomic_write_json(state_file, filtered_keys)
         
         logger.debug(f"Saved {len(filtered_keys)} processed keys to {state_file}")
     except PermissionError as e:
@@ -429,17 +1071,53 @@ determine_report_type = detect_report_type
 
 
 
-def get_email_attachments(config: Dict) -> List[Tuple[int, int, str, bytes, Optional[datetime]]]:
-    """Получение XLSX вложений из писем за последние lookback дней
+def _bodystructure_parts(body, prefix: str = '') -> List[Tuple[str, int]]:
+    """Листовые части BODYSTRUCTURE: (номер части IMAP, размер в байтах)"""
+    if body.is_multipart:
+        parts = []
+        for i, child in enumerate(body[0], start=1):
+            parts.extend(_bodystructure_parts(child, f"{prefix}{i}."))
+        return parts
+    try:
+        size = int(body[6])
+    except (IndexError, TypeError, ValueError):
+        size = 0
+    return [(f"{prefix}1" if not prefix else prefix.rstrip('.'), size)]
+
+
+def message_meta_key(config: Dict, uidvalidity, uid: int, meta: Dict) -> Optional[str]:
+    """Ключ письма по метаданным до скачивания: UIDVALIDITY, UID, Message-ID, размер и части BODYSTRUCTURE
+
+    None, если сервер не вернул BODYSTRUCTURE или UIDVALIDITY (тогда письмо скачивается как обычно).
+    """
+    body = meta.get(b'BODYSTRUCTURE')
+    if body is None or uidvalidity is None:
+        return None
+    envelope = meta.get(b'ENVELOPE')
+    message_id = getattr(envelope, 'message_id', None) or b''
+    if isinstance(message_id, bytes):
+        message_id = message_id.decode('utf-8', errors='replace')
+    payload = json.dumps([
+        str(uidvalidity), uid, message_id, meta.get(b'RFC822.SIZE'),
+        _bodystructure_parts(body), config.get('attachment_regex') or '',
+    ])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def iter_email_attachments(config: Dict, processed_keys=None) -> Iterator[Tuple[int, int, str, bytes, Optional[datetime]]]:
+    """XLSX вложения из писем за последние lookback дней - по мере скачивания писем
+
+    Если передан processed_keys, письма, все Excel-вложения которых уже обработаны, не скачиваются:
+    индекс message_index в STATE_PATH хранит по ключу метаданных письма (message_meta_key)
+    sha256 его вложений, из них ключи uid:att_index:sha256 восстанавливаются без загрузки.
     
-    Returns:
-        List[Tuple[uid, attachment_index, filename, file_data, internaldate]]
+    Yields:
+        Tuple[uid, attachment_index, filename, file_data, internaldate]
     """
     if not config['imap_user'] or not config['imap_pass']:
         logger.error("IMAP credentials not set")
-        return []
+        return
     
-    attachments = []
     attachment_pattern = None
     # Применяем regex-фильтр только если он задан и не пустой
     if config.get('attachment_regex'):
@@ -452,7 +1130,8 @@ def get_email_attachments(config: Dict) -> List[Tuple[int, int, str, bytes, Opti
         with IMAPClient(config['imap_host'], port=993, ssl=True) as client:
             client.login(config['imap_user'], config['imap_pass'])
             mailbox = config.get('mailbox', 'INBOX')
-            client.select_folder(mailbox)
+            folder_info = client.select_folder(mailbox)
+            uidvalidity = folder_info.get(b'UIDVALIDITY') if isinstance(folder_info, dict) else None
             
             # Поиск писем за последние lookback дней
             # Используем московское время для определения "сегодня"
@@ -487,9 +1166,35 @@ def get_email_attachments(config: Dict) -> List[Tuple[int, int, str, bytes, Opti
                 messages = sorted(messages)
                 logger.info(f"Processing all {len(messages)} UIDs")
             
+            # Индекс метаданных писем: пропуск скачивания уже обработанных
+            use_index = processed_keys is not None and config.get('imap_meta_index', True) and bool(messages)
+            state = load_state(config['state_path']) if use_index else {}
+            message_index = state.get('message_index', {})
+            metas = {}
+            if use_index:
+                try:
+                    metas = client.fetch(messages, ['BODYSTRUCTURE', 'ENVELOPE', 'RFC822.SIZE'])
+                except Exception as e:
+                    logger.warning(f"Failed to fetch message metadata, downloading all messages: {e}")
+            index_skipped = 0
+            now_ts = time.time()
+            
             attachment_index = 0
             for uid in messages:
+                meta_key = message_meta_key(config, uidvalidity, uid, metas[uid]) if uid in metas else None
+                known = message_index.get(meta_key) if meta_key else None
+                if known is not None:
+                    # Ключи, которые получились бы после скачивания; полный sha256 по-прежнему часть ключа
+                    keys = [f"{uid}:{attachment_index + i}:{file_hash}" for i, file_hash in enumerate(known['hashes'])]
+                    if all(key in processed_keys for key in keys):
+                        known['ts'] = now_ts
+                        attachment_index += len(keys)
+                        index_skipped += 1
+                        logger.debug(f"Skipping download of UID {uid}: {len(keys)} attachments already processed (meta index)")
+                        continue
+                
                 try:
+                    message_hashes = []
                     # Получаем INTERNALDATE для логирования
                     fetch_data = client.fetch([uid], ['RFC822', 'INTERNALDATE'])
                     msg_data = fetch_data[uid]
@@ -534,20 +1239,39 @@ def get_email_attachments(config: Dict) -> List[Tuple[int, int, str, bytes, Opti
                                         file_data = part.get_payload(decode=True)
                                         if file_data:
                                             internaldate = msg_data.get(b'INTERNALDATE')
-                                            attachments.append((uid, attachment_index, filename or f"mail_{uid}.xlsx", file_data, internaldate))
+                                            message_hashes.append(hashlib.sha256(file_data).hexdigest())
                                             logger.debug(f"Found Excel attachment: UID {uid}, INTERNALDATE {internaldate_str}, filename={filename[:50] if filename else 'N/A'}, index {attachment_index}, content-type: {content_type}")
                                             attachment_index += 1
+                                            yield (uid, attachment_index - 1, filename or f"mail_{uid}.xlsx", file_data, internaldate)
                                     except Exception as e:
                                         logger.error(f"Failed to decode attachment {filename} (UID {uid}): {e}")
+                    if meta_key:
+                        message_index[meta_key] = {'hashes': message_hashes, 'ts': now_ts}
                 except Exception as e:
                     logger.error(f"Error processing message {uid}: {e}")
+            
+            if use_index:
+                # Письма за пределами окна поиска больше не встретятся
+                max_age = (lookback_days + 7) * 86400
+                with updated_state(config['state_path']) as fresh_state:
+                    fresh_state['message_index'] = {
+                        key: entry for key, entry in message_index.items() if now_ts - entry.get('ts', 0) <= max_age
+                    }
+                logger.info(f"Meta index: {index_skipped}/{len(messages)} messages skipped without download")
     
     except Exception as e:
         logger.error(f"IMAP error: {e}")
         import traceback
         traceback.print_exc()
-    
-    return attachments
+
+
+def get_email_attachments(config: Dict, processed_keys=None) -> List[Tuple[int, int, str, bytes, Optional[datetime]]]:
+    """Получение XLSX вложений из писем за последние lookback дней (списком)
+
+    Returns:
+        List[Tuple[uid, attachment_index, filename, file_data, internaldate]]
+    """
+    return list(iter_email_attachments(config, processed_keys))
 
 
 def normalize_column_name(name: str) -> str:
@@ -794,11 +1518,237 @@ def get_delay_emoji(delay: int) -> str:
         return '🟢'
 
 
-def generate_png_table_docs(df: pd.DataFrame, output_path: str):
-    """Генерация PNG таблицы для docs-report (отстающие документы)"""
-    if len(df) == 0:
-        return False
-    
+# Шрифты для PNG таблиц
+FONT_PATH = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
+FONT_BOLD_PATH = "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"
+
+# Холст 1x1 только для измерения текста (textbbox без рисования)
+_MEASURE_DRAW = ImageDraw.Draw(Image.new('RGB', (1, 1)))
+
+
+@lru_cache(maxsize=None)
+def get_font(size: int, bold: bool = False):
+    """Реестр шрифтов: каждый (размер, начертание) загружается один раз на процесс"""
+    try:
+        return ImageFont.truetype(FONT_BOLD_PATH if bold else FONT_PATH, size)
+    except Exception:
+        return ImageFont.load_default()
+
+
+@lru_cache(maxsize=8192)
+def text_bbox(font, text: str) -> Tuple[int, int, int, int]:
+    """Кэшированный bbox текста для шрифта (повторяющиеся подписи и ФИО не измеряются заново)"""
+    return _MEASURE_DRAW.textbbox((0, 0), text, font=font)
+
+
+def text_width(font, text: str) -> int:
+    """Ширина текста в пикселях (через кэш метрик)"""
+    bbox = text_bbox(font, text)
+    return bbox[2] - bbox[0]
+
+
+def text_height(font, text: str) -> int:
+    """Высота текста в пикселях (через кэш метрик)"""
+    bbox = text_bbox(font, text)
+    return bbox[3] - bbox[1]
+
+
+@lru_cache(maxsize=None)
+def font_line_height(font) -> int:
+    """Высота строки шрифта (ascent + descent)"""
+    try:
+        ascent, descent = font.getmetrics()
+        return ascent + descent
+    except AttributeError:
+        return text_bbox(font, 'Ёy')[3]
+
+
+# Параметры раскладки таблиц
+CELL_PADDING = 10  # Горизонтальный отступ текста в ячейке
+CELL_PADDING_Y = 8  # Вертикальный отступ текста в ячейке
+LINE_SPACING = 2  # Интервал между строками внутри ячейки
+BORDER = 2  # Зазор между ячейками и от края изображения
+MIN_COL_WIDTH = 40
+
+
+def _split_long_word(word: str, font, max_width: int) -> List[str]:
+    """Разбиение слова, которое не помещается в ширину, по символам"""
+    parts = []
+    current = ''
+    for ch in word:
+        if current and text_width(font, current + ch) > max_width:
+            parts.append(current)
+            current = ch
+        else:
+            current += ch
+    if current:
+        parts.append(current)
+    return parts
+
+
+@lru_cache(maxsize=8192)
+def wrap_text_px(text: str, font, max_width: int) -> Tuple[str, ...]:
+    """Перенос текста по ширине в пикселях
+
+    Переносит по словам, явные '\\n' сохраняются. Слово шире max_width режется
+    по символам, поэтому текст никогда не обрезается.
+    """
+    lines = []
+    for paragraph in str(text).split('\n'):
+        current = ''
+        for word in paragraph.split():
+            candidate = f"{current} {word}" if current else word
+            if text_width(font, candidate) <= max_width:
+                current = candidate
+                continue
+            if current:
+                lines.append(current)
+            if text_width(font, word) <= max_width:
+                current = word
+            else:
+                *head, current = _split_long_word(word, font, max_width)
+                lines.extend(head)
+        lines.append(current)
+    return tuple(lines) if lines else ('',)
+
+
+def _text_block_height(lines, font) -> int:
+    """Высота блока из нескольких строк"""
+    return len(lines) * font_line_height(font) + (len(lines) - 1) * LINE_SPACING
+
+
+def compute_column_widths(headers: List[str], rows: List[List[str]], max_col_widths: List[int],
+                          font, font_bold) -> List[int]:
+    """Ширины колонок по содержимому (не шире max_col_widths)"""
+    col_widths = []
+    for i, max_w in enumerate(max_col_widths):
+        # Заголовок переносится по словам - учитываем только самое длинное слово
+        longest_word = max((text_width(font_bold, word) for word in str(headers[i]).split()), default=0)
+        needed = longest_word
+        for row in rows:
+            for line in str(row[i]).split('\n'):
+                needed = max(needed, text_width(font, line))
+                longest_word = max([longest_word] + [text_width(font, word) for word in line.split()])
+        width = min(max_w, needed + 2 * CELL_PADDING)
+        # Колонка расширяется до самого длинного слова, чтобы не резать слова (но не больше 2x)
+        width = max(width, min(longest_word + 2 * CELL_PADDING, 2 * max_w))
+        col_widths.append(max(MIN_COL_WIDTH, width))
+    return col_widths
+
+
+@lru_cache(maxsize=256)
+def _header_layout(headers: Tuple[str, ...], col_widths: Tuple[int, ...], font_bold) -> Tuple[Tuple[Tuple[str, ...], ...], int]:
+    """Перенос заголовков и высота шапки (одинаковы для всех таблиц с теми же колонками)"""
+    header_lines = tuple(wrap_text_px(str(h), font_bold, w - 2 * CELL_PADDING) for h, w in zip(headers, col_widths))
+    header_height = max(_text_block_height(lines, font_bold) for lines in header_lines) + 2 * CELL_PADDING_Y
+    return header_lines, header_height
+
+
+def compute_table_layout(headers: List[str], rows: List[List[str]], max_col_widths: List[int],
+                         font, font_bold, fixed_widths: bool = False) -> Dict:
+    """Раскладка таблицы: перенос текста, ширины колонок и высоты строк
+
+    Текст каждой ячейки измеряется и переносится один раз. Если fixed_widths=False,
+    колонка сужается до ширины содержимого (но не шире max_col_widths). Размер
+    холста вычисляется точно, без обрезки и лишних пустых строк.
+    """
+    if fixed_widths:
+        col_widths = list(max_col_widths)
+    else:
+        col_widths = compute_column_widths(headers, rows, max_col_widths, font, font_bold)
+
+    header_lines, header_height = _header_layout(tuple(str(h) for h in headers), tuple(col_widths), font_bold)
+
+    cells = []
+    row_heights = []
+    for row in rows:
+        row_lines = [wrap_text_px(str(value), font, w - 2 * CELL_PADDING) for value, w in zip(row, col_widths)]
+        cells.append(row_lines)
+        row_heights.append(max(_text_block_height(lines, font) for lines in row_lines) + 2 * CELL_PADDING_Y)
+
+    width = sum(col_widths) + (len(col_widths) + 1) * BORDER
+    height = BORDER + header_height + sum(row_heights) + BORDER
+    return {
+        'col_widths': col_widths,
+        'header_lines': header_lines,
+        'header_height': header_height,
+        'cells': cells,
+        'row_heights': row_heights,
+        'width': width,
+        'height': height,
+    }
+
+
+def _draw_cell_text(draw, cell_rect, lines, font, align: str, valign: str = 'middle'):
+    """Отрисовка перенесённого текста внутри ячейки"""
+    line_h = font_line_height(font)
+    if valign == 'top':
+        text_y = cell_rect[1] + CELL_PADDING_Y
+    else:
+        text_y = cell_rect[1] + (cell_rect[3] - cell_rect[1] - _text_block_height(lines, font)) // 2
+    for line in lines:
+        if align == 'center':
+            text_x = cell_rect[0] + (cell_rect[2] - cell_rect[0] - text_width(font, line)) // 2
+        else:
+            text_x = cell_rect[0] + CELL_PADDING
+        draw.text((text_x, text_y), line, fill='black', font=font)
+        text_y += line_h + LINE_SPACING
+
+
+@lru_cache(maxsize=64)
+def render_header_strip(header_lines: Tuple[Tuple[str, ...], ...], col_widths: Tuple[int, ...],
+                        header_height: int, font_bold) -> Image.Image:
+    """Шаблон шапки таблицы: заливка, границы и текст заголовков
+
+    Рисуется один раз на (колонки, ширины, шрифт) и вставляется в каждый новый холст,
+    так что для каждого водителя рисуются только строки данных.
+    """
+    width = sum(col_widths) + (len(col_widths) + 1) * BORDER
+    strip = Image.new('RGB', (width, BORDER + header_height + 1), color='white')
+    draw = ImageDraw.Draw(strip)
+    x = BORDER
+    y = BORDER
+    for col_w, lines in zip(col_widths, header_lines):
+        cell_rect = [x, y, x + col_w, y + header_height]
+        draw.rectangle(cell_rect, outline='black', width=2)
+        draw.rectangle([cell_rect[0]+1, cell_rect[1]+1, cell_rect[2]-1, cell_rect[3]-1], fill='#f0f0f0')
+        _draw_cell_text(draw, cell_rect, lines, font_bold, 'left', valign='top')
+        x += col_w + BORDER
+    return strip
+
+
+def render_table(layout: Dict, font, font_bold, aligns: Optional[List[str]] = None,
+                 row_fills: Optional[List[str]] = None) -> Image.Image:
+    """Отрисовка таблицы по готовой раскладке на холсте точного размера"""
+    col_widths = layout['col_widths']
+    aligns = aligns or ['left'] * len(col_widths)
+    img = Image.new('RGB', (layout['width'], layout['height']), color='white')
+    draw = ImageDraw.Draw(img)
+
+    # Заголовок (из кэша шаблонов)
+    header_height = layout['header_height']
+    img.paste(render_header_strip(tuple(layout['header_lines']), tuple(col_widths), header_height, font_bold), (0, 0))
+
+    # Данные
+    y = BORDER + header_height
+    for row_idx, (row_lines, row_h) in enumerate(zip(layout['cells'], layout['row_heights'])):
+        fill = row_fills[row_idx] if row_fills else None
+        x = BORDER
+        for i, lines in enumerate(row_lines):
+            col_w = col_widths[i]
+            cell_rect = [x, y, x + col_w, y + row_h]
+            draw.rectangle(cell_rect, outline='black', width=1)
+            if fill:
+                draw.rectangle([cell_rect[0]+1, cell_rect[1]+1, cell_rect[2]-1, cell_rect[3]-1], fill=fill)
+            _draw_cell_text(draw, cell_rect, lines, font, aligns[i])
+            x += col_w + BORDER
+        y += row_h
+
+    return img
+
+
+def prepare_docs_table(df: pd.DataFrame) -> Tuple[pd.DataFrame, List[int]]:
+    """Подготовка docs-таблицы: удаление лишних колонок и максимальные ширины колонок"""
     # Убираем ненужные колонки
     columns_to_remove = []
     for col in df.columns:
@@ -815,28 +1765,17 @@ def generate_png_table_docs(df: pd.DataFrame, output_path: str):
         # Убираем "Номер маршрута" / "№ маршрута" (но не "Наименование маршрута")
         elif ('номер' in col_lower or '№' in col_lower) and 'маршрут' in col_lower and 'наименован' not in col_lower:
             columns_to_remove.append(col)
-    
+
     if columns_to_remove:
         df = df.drop(columns=columns_to_remove, errors='ignore')
         logger.info(f"Removed columns from docs-report: {columns_to_remove}")
-    
-    if len(df.columns) == 0:
-        logger.warning("No columns left after filtering")
-        return False
-    
-    # Параметры таблицы (как в late-report для единообразия)
-    cell_padding = 10  # Как в generate_png_table
-    row_height = 50  # Как в generate_png_table
-    header_height = 50  # Как в generate_png_table
-    font_size = 11  # Увеличен на 1 для лучшей читаемости
-    
+
     # Определяем ширины колонок динамически
     # Узкие колонки (даты, номера): 120-150
     # Средние колонки (ФИО, компания): 200-250
     # Широкие колонки (пункт назначения, причина): 300-400
-    num_cols = len(df.columns)
     col_widths = []
-    
+
     for col in df.columns:
         col_lower = normalize_column_name(str(col))
         # Очень узкие колонки (коды, даты)
@@ -866,336 +1805,1031 @@ def generate_png_table_docs(df: pd.DataFrame, output_path: str):
         # По умолчанию - средняя ширина
         else:
             col_widths.append(180)
-    
+
     # Нормализуем ширины, чтобы сумма была ~1200 (как в late-report)
     total_width = sum(col_widths)
     target_width = 1200
     if total_width > target_width:
         scale = target_width / total_width
         col_widths = [int(w * scale) for w in col_widths]
-    elif total_width < 800:
+    elif 0 < total_width < 800:
         # Если слишком узко, увеличиваем
         scale = 800 / total_width
         col_widths = [int(w * scale) for w in col_widths]
-    
-    table_width = sum(col_widths) + (num_cols + 1) * 2  # + отступы
-    
-    num_rows = len(df) + 1  # +1 для заголовка
-    table_height = header_height + num_rows * row_height
-    
-    # Создание изображения
-    img = Image.new('RGB', (table_width, table_height), color='white')
-    draw = ImageDraw.Draw(img)
-    
-    try:
-        font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", font_size)
-        font_bold = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", font_size)
-    except:
-        font = ImageFont.load_default()
-        font_bold = font
-    
-    # Заголовки
-    headers = list(df.columns)
-    
-    x = 2
-    y = 2
-    
-    # Рисование заголовка
-    for i, header in enumerate(headers):
-        col_w = col_widths[i]
-        cell_rect = [x, y, x + col_w, y + header_height]
-        draw.rectangle(cell_rect, outline='black', width=2)
-        draw.rectangle([cell_rect[0]+1, cell_rect[1]+1, cell_rect[2]-1, cell_rect[3]-1], fill='#f0f0f0')
-        
-        # Текст заголовка с переносами (wrap для длинных заголовков)
-        header_text = str(header)
-        col_lower = normalize_column_name(str(header))
-        
-        # Для "Код получателя" - принудительный перенос в две строки
-        if 'код получател' in col_lower:
-            # Разбиваем "Код получателя" на две строки
-            words = header_text.split()
-            if len(words) >= 2:
-                # Разделяем на "Код" и "получателя"
-                wrapped_lines = [words[0], ' '.join(words[1:])]
-            else:
-                # Если одно слово, просто переносим пополам
-                mid = len(header_text) // 2
-                wrapped_lines = [header_text[:mid], header_text[mid:]]
-        # Для "Срок ожидания документов по маршруту" - принудительный перенос в три строки
-        elif 'срок ожидания документов' in col_lower:
-            # Разбиваем "Срок ожидания документов по маршруту" на три строки
-            words = header_text.split()
-            if len(words) >= 3:
-                # Разделяем на "Срок ожидания", "документов по", "маршруту"
-                if len(words) == 6:  # "Срок ожидания документов по маршруту"
-                    wrapped_lines = ['Срок ожидания', 'документов по', 'маршруту']
-                elif len(words) == 5:  # "Срок ожидания документов по маршруту" (вариант)
-                    wrapped_lines = ['Срок ожидания', 'документов по', 'маршруту']
-                else:
-                    # Общий случай: делим на 3 части
-                    part_size = len(words) // 3
-                    wrapped_lines = [
-                        ' '.join(words[:part_size]),
-                        ' '.join(words[part_size:2*part_size]),
-                        ' '.join(words[2*part_size:])
-                    ]
-            else:
-                # Если мало слов, разбиваем по символам
-                part_size = len(header_text) // 3
-                wrapped_lines = [header_text[:part_size], header_text[part_size:2*part_size], header_text[2*part_size:]]
-        else:
-            # Компактный перенос для остальных заголовков
-            wrap_width = max(12, col_w // 7)  # Адаптивная ширина переноса
-            wrapped_lines = textwrap.wrap(header_text, width=wrap_width)
-        
-        text_y = cell_rect[1] + cell_padding
-        line_spacing = 11  # Компактный интервал между строками
-        for line in wrapped_lines[:3]:  # Максимум 3 строки для заголовка
-            draw.text((cell_rect[0] + cell_padding, text_y), line, fill='black', font=font_bold)
-            text_y += line_spacing
-        
-        x += col_w + 2
-    
+
+    return df, col_widths
+
+
+def docs_header_text(header: str) -> str:
+    """Текст заголовка docs-колонки с принудительными переносами"""
+    header_text = str(header)
+    col_lower = normalize_column_name(header_text)
+    words = header_text.split()
+
+    # Для "Код получателя" - принудительный перенос в две строки
+    if 'код получател' in col_lower and len(words) >= 2:
+        return words[0] + '\n' + ' '.join(words[1:])
+    # Для "Срок ожидания документов по маршруту" - принудительный перенос в три строки
+    if 'срок ожидания документов' in col_lower and len(words) >= 3:
+        if len(words) in (5, 6):
+            return 'Срок ожидания\nдокументов по\nмаршруту'
+        # Общий случай: делим на 3 части
+        part_size = len(words) // 3
+        return '\n'.join([
+            ' '.join(words[:part_size]),
+            ' '.join(words[part_size:2*part_size]),
+            ' '.join(words[2*part_size:])
+        ])
+    return header_text
+
+
+def docs_row_fills(df: pd.DataFrame) -> List[str]:
+    """Цвета фона строк docs-таблицы по "Сроку ожидания документов" """
     # Находим колонку "Срок ожидания документов" для подсветки строк
     waiting_period_col = None
     for col in df.columns:
         col_norm = normalize_column_name(str(col))
         if 'срок ожидания документов' in col_norm:
             waiting_period_col = col
-    
+
     # Получаем сегодняшнюю дату по московскому времени
     today_msk = datetime.now(ZoneInfo('Europe/Moscow')).date()
-    
+
     # Функция для вычисления разницы в днях между "Срок ожидания документов" и сегодняшней датой
     def calculate_days_diff(row):
         """Вычисляет разницу в днях между 'Срок ожидания документов' и сегодняшней датой (МСК)"""
         if not waiting_period_col:
             return None
-        
+
         waiting_date_str = str(row.get(waiting_period_col, '')) if pd.notna(row.get(waiting_period_col)) else ''
-        
+
         if not waiting_date_str:
             return None
-        
+
         try:
             # Пробуем распарсить дату в разных форматах
             # Сначала пробуем без dayfirst (для YYYY-MM-DD), потом с dayfirst (для DD.MM.YYYY)
             waiting_date = pd.to_datetime(waiting_date_str, errors='coerce', dayfirst=False)
             if pd.isna(waiting_date):
                 waiting_date = pd.to_datetime(waiting_date_str, errors='coerce', dayfirst=True)
-            
+
             if pd.isna(waiting_date):
                 return None
-            
-            # Преобразуем в date для сравнения
-            waiting_date_only = waiting_date.date()
-            
+
             # Разница в днях (waiting_date - today_msk)
             # Если waiting_date в будущем, разница положительная
             # Если waiting_date в прошлом, разница отрицательная
-            diff = (waiting_date_only - today_msk).days
-            return diff
+            return (waiting_date.date() - today_msk).days
         except:
             return None
-    
-    # Данные
-    y = header_height + 2
-    for idx, row in df.iterrows():
-        x = 2
-        
-        # Вычисляем разницу в днях для текущей строки
+
+    fills = []
+    for _, row in df.iterrows():
         days_diff = calculate_days_diff(row)
-        
-        # Определяем цвет фона строки (более насыщенные цвета)
         # Подсветка: < 2 дней → красная, 2-4 дня → оранжевая, >= 4 дней → белая
-        if days_diff is not None:
-            if days_diff >= 0 and days_diff < 2:
-                row_bg_color = '#ff8888'  # Чуть краснее (< 2 дней)
-            elif days_diff >= 2 and days_diff < 4:
-                row_bg_color = '#ffd4aa'  # Чуть побледнее (2-4 дня)
-            else:
-                row_bg_color = '#ffffff'  # Белый (>= 4 дней или отрицательная разница)
+        if days_diff is not None and 0 <= days_diff < 2:
+            fills.append('#ff8888')  # Чуть краснее (< 2 дней)
+        elif days_diff is not None and 2 <= days_diff < 4:
+            fills.append('#ffd4aa')  # Чуть побледнее (2-4 дня)
         else:
-            row_bg_color = '#ffffff'  # Белый (нет дат или не распознаны)
-        
-        for i, col_name in enumerate(headers):
-            col_w = col_widths[i]
-            cell_rect = [x, y, x + col_w, y + row_height]
-            draw.rectangle(cell_rect, outline='black', width=1)
-            
-            # Заливаем фон ячейки цветом строки
-            draw.rectangle([cell_rect[0]+1, cell_rect[1]+1, cell_rect[2]-1, cell_rect[3]-1], fill=row_bg_color)
-            
-            # Получаем значение ячейки
-            cell_value = str(row[col_name]) if pd.notna(row[col_name]) else ''
-            
-            # Определяем ширину переноса в зависимости от ширины колонки (компактный режим)
-            col_lower = normalize_column_name(str(col_name))
-            if any(word in col_lower for word in ['пункт назначен', 'адрес', 'причина', 'наименован', 'компани']):
-                wrap_width = max(16, col_w // 9)  # Широкие колонки - компактный перенос
-            elif any(word in col_lower for word in ['фио', 'водител']):
-                wrap_width = max(14, col_w // 8)  # Средние колонки
-            else:
-                wrap_width = max(12, col_w // 7)  # Узкие колонки
-            
-            # Используем textwrap с break_long_words=False, чтобы слова не разбивались посередине
-            wrapped_lines = textwrap.wrap(cell_value, width=wrap_width, break_long_words=False, break_on_hyphens=False)
-            
-            if not wrapped_lines:
-                wrapped_lines = ['']
-            
-            # Вертикальное центрирование с компактным интервалом
-            line_height = 11  # Компактный интервал между строками
-            total_text_height = len(wrapped_lines) * line_height + (len(wrapped_lines) - 1) * 1
-            text_y_start = cell_rect[1] + (row_height - total_text_height) // 2
-            
-            # Ограничиваем длину строки в зависимости от ширины колонки
-            max_chars = min(45, col_w // 6)
-            for line in wrapped_lines[:4]:  # Максимум 4 строки для компактности
-                line_text = line[:max_chars] if len(line) > max_chars else line
-                draw.text((cell_rect[0] + cell_padding, text_y_start), line_text, fill='black', font=font)
-                text_y_start += line_height
-            
-            x += col_w + 2
-        
-        y += row_height
-    
+            fills.append('#ffffff')  # Белый (>= 4 дней, отрицательная разница или нет даты)
+    return fills
+
+
+def _docs_table_cells(df: pd.DataFrame) -> Tuple[List[str], List[List[str]]]:
+    """Заголовки и строки docs-таблицы в виде текста"""
+    headers = [docs_header_text(col) for col in df.columns]
+    rows = [
+        [str(row[col]) if pd.notna(row[col]) else '' for col in df.columns]
+        for _, row in df.iterrows()
+    ]
+    return headers, rows
+
+
+def compute_docs_column_widths(df: pd.DataFrame) -> List[int]:
+    """Общие верхние границы ширин колонок docs-таблицы для всех водителей
+
+    Считаются один раз по объединённой таблице; таблица каждого водителя сужается
+    до своего содержимого, но не шире этих границ (см. build_docs_table).
+    """
+    df, max_col_widths = prepare_docs_table(df)
+    headers, rows = _docs_table_cells(df)
+    return compute_column_widths(headers, rows, max_col_widths, get_font(11), get_font(11, bold=True))
+
+
+# Уровни ширины колонки водителя (доли общей ширины): ширины квантуются, чтобы
+# шапка таблицы бралась из кэша шаблонов, а не рисовалась для каждого водителя
+DOCS_WIDTH_LEVELS = 3
+
+
+def quantize_column_width(own: int, shared: int, levels: int = DOCS_WIDTH_LEVELS) -> int:
+    """Наименьший уровень shared * k / levels, в который помещается own (не шире shared)"""
+    for k in range(1, levels + 1):
+        width = max(MIN_COL_WIDTH, shared * k // levels)
+        if width >= own:
+            return width
+    return shared
+
+
+def build_docs_table(df: pd.DataFrame, col_widths: Optional[List[int]] = None) -> Optional[Dict]:
+    """Раскладка docs-таблицы для отрисовки (целиком или постранично)
+
+    col_widths - общие границы ширин колонок (см. compute_docs_column_widths): колонки
+    сужаются по содержимому этой таблицы до ближайшего уровня DOCS_WIDTH_LEVELS,
+    короткие таблицы дают узкие картинки, а наборы ширин (и шапки) повторяются.
+    """
+    if len(df) == 0:
+        return None
+
+    df, max_col_widths = prepare_docs_table(df)
+
+    if len(df.columns) == 0:
+        logger.warning("No columns left after filtering")
+        return None
+
+    font = get_font(11)
+    font_bold = get_font(11, bold=True)
+
+    headers, rows = _docs_table_cells(df)
+
+    if col_widths is not None and len(col_widths) == len(headers):
+        own_widths = compute_column_widths(headers, rows, max_col_widths, font, font_bold)
+        widths = [quantize_column_width(own, shared) for shared, own in zip(col_widths, own_widths)]
+        layout = compute_table_layout(headers, rows, widths, font, font_bold, fixed_widths=True)
+    else:
+        layout = compute_table_layout(headers, rows, max_col_widths, font, font_bold)
+    return {
+        'layout': layout,
+        'font': font,
+        'font_bold': font_bold,
+        'aligns': None,
+        'row_fills': docs_row_fills(df),
+    }
+
+
+def generate_png_table_docs(df: pd.DataFrame, output_path: str, col_widths: Optional[List[int]] = None):
+    """Генерация PNG таблицы для docs-report (отстающие документы)"""
+    table = build_docs_table(df, col_widths=col_widths)
+    if not table:
+        return False
+
+    img = render_table(table['layout'], table['font'], table['font_bold'], row_fills=table['row_fills'])
+
     img.save(output_path)
     logger.info(f"Generated docs-report PNG table: {output_path}")
     return True
 
 
+# Колонки late-report: заголовок, максимальная ширина, выравнивание
+LATE_TABLE_COLUMNS = [
+    ('Наименование маршрута', 250, 'left'),
+    ('Плановое время подачи', 150, 'center'),
+    ('Время назначения а/м на маршрут (факт)', 180, 'center'),
+    ('Опоздание, мин.', 100, 'center'),
+    ('ФИО водителя', 200, 'center'),
+    ('Гос. №', 120, 'center'),
+]
+
+
+def late_table_rows(records: List[Dict]) -> List[List[str]]:
+    """Строки таблицы late-report в порядке LATE_TABLE_COLUMNS"""
+    return [
+        [
+            str(record['route_name']),
+            str(record['planned_time']),
+            str(record['assigned_time']),
+            str(record['delay_minutes']),
+            str(record['driver_name']),
+            str(record['plate_number']),
+        ]
+        for record in records
+    ]
+
+
+def build_late_table(records: List[Dict]) -> Optional[Dict]:
+    """Раскладка late-таблицы для отрисовки (целиком или постранично)"""
+    if not records:
+        return None
+
+    font = get_font(12)
+    font_bold = get_font(12, bold=True)
+
+    headers = [header for header, _, _ in LATE_TABLE_COLUMNS]
+    max_col_widths = [width for _, width, _ in LATE_TABLE_COLUMNS]
+
+    layout = compute_table_layout(headers, late_table_rows(records), max_col_widths, font, font_bold)
+    return {
+        'layout': layout,
+        'font': font,
+        'font_bold': font_bold,
+        'aligns': [align for _, _, align in LATE_TABLE_COLUMNS],
+        'row_fills': None,
+    }
+
+
 def generate_png_table(records: List[Dict], output_path: str):
     """Генерация PNG таблицы с опоздавшими"""
-    if not records:
+    table = build_late_table(records)
+    if not table:
         return False
+
+    img = render_table(table['layout'], table['font'], table['font_bold'], aligns=table['aligns'])
+
+    img.save(output_path)
+    logger.info(f"Generated PNG table: {output_path}")
+    return True
+
+
+# Ограничения Telegram для фото: ширина + высота <= 10000, соотношение сторон <= 20
+TG_PHOTO_MAX_DIMENSIONS_SUM = 10000
+TG_PHOTO_MAX_ASPECT_RATIO = 20
+
+
+def paginate_table(layout: Dict, max_height: int, max_pixels: int) -> List[Tuple[int, int]]:
+    """Разбиение строк таблицы на страницы [(start, end), ...] в пределах бюджета по пикселям
+
+    Каждая страница повторяет шапку. Строка выше лимита остаётся на странице одна.
+    """
+    width = layout['width']
+    page_limit = min(
+        max_height,
+        max_pixels // max(width, 1),
+        TG_PHOTO_MAX_DIMENSIONS_SUM - width,
+        TG_PHOTO_MAX_ASPECT_RATIO * width,
+    )
+    base_height = 2 * BORDER + layout['header_height']
+
+    pages = []
+    start = 0
+    height = base_height
+    for i, row_h in enumerate(layout['row_heights']):
+        if i > start and height + row_h > page_limit:
+            pages.append((start, i))
+            start = i
+            height = base_height
+        height += row_h
+    pages.append((start, len(layout['row_heights'])))
+    return pages
+
+
+def _slice_layout(layout: Dict, start: int, end: int) -> Dict:
+    """Раскладка для части строк таблицы (шапка и ширины те же)"""
+    page = dict(layout)
+    page['cells'] = layout['cells'][start:end]
+    page['row_heights'] = layout['row_heights'][start:end]
+    page['height'] = 2 * BORDER + layout['header_height'] + sum(page['row_heights'])
+    return page
+
+
+def encode_png(img: Image.Image) -> bytes:
+    """Кодирование изображения в PNG в памяти"""
+    buffer = io.BytesIO()
+    img.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def _encode_once(img: Image.Image, image_format: str, colors: int, quality: int, compress_level: int) -> bytes:
+    """Одна попытка кодирования с заданными параметрами"""
+    buffer = io.BytesIO()
+    if image_format == 'jpeg':
+        img.convert('RGB').save(buffer, format='JPEG', quality=quality, optimize=True)
+    elif image_format == 'webp':
+        img.save(buffer, format='WEBP', quality=quality, method=4)
+    else:
+        if colors:
+            # В таблицах несколько цветов (белый, #f0f0f0, #ff8888, #ffd4aa, чёрный текст),
+            # палитра из десятков цветов сохраняет сглаживание текста
+            img = img.quantize(colors=colors, method=Image.Quantize.MEDIANCUT, dither=Image.Dither.NONE)
+        img.save(buffer, format='PNG', compress_level=compress_level)
+    return buffer.getvalue()
+
+
+def encode_image(img: Image.Image, config: Dict) -> bytes:
+    """Кодирование страницы таблицы для отправки
+
+    IMAGE_FORMAT: png (палитра "P", IMAGE_PALETTE_COLORS цветов, 0 - полноцветный RGB),
+    webp или jpeg (IMAGE_QUALITY). PNG_COMPRESS_LEVEL - уровень zlib.
+    Если задан IMAGE_TARGET_BYTES, качество/число цветов снижается, пока
+    результат не уложится в размер (или не кончатся ступени).
+    """
+    image_format = str(config.get('image_format', 'png')).lower()
+    if image_format == 'jpg':
+        image_format = 'jpeg'
+    if image_format not in ('png', 'webp', 'jpeg'):
+        logger.warning(f"Unknown IMAGE_FORMAT {image_format}, using png")
+        image_format = 'png'
+    colors = int(config.get('image_palette_colors', 32))
+    quality = int(config.get('image_quality', 85))
+    compress_level = int(config.get('png_compress_level', 9))
+    target_bytes = int(config.get('image_target_bytes', 0))
+
+    data = _encode_once(img, image_format, colors, quality, compress_level)
+    if not target_bytes or len(data) <= target_bytes:
+        return data
+
+    # Ступени снижения: для PNG - меньше цветов, для webp/jpeg - ниже качество
+    if image_format == 'png':
+        steps = [('colors', c) for c in (16, 8, 4) if not colors or c < colors]
+    else:
+        steps = [('quality', q) for q in (75, 65, 55, 45, 35) if q < quality]
+    for param, value in steps:
+        if param == 'colors':
+            data = _encode_once(img, image_format, value, quality, compress_level)
+        else:
+            data = _encode_once(img, image_format, colors, value, compress_level)
+        if len(data) <= target_bytes:
+            logger.debug(f"Image encoded to {len(data)} bytes with {param}={value}")
+            break
+    return data
+
+
+def image_mime_type(data: bytes) -> Tuple[str, str]:
+    """MIME-тип и расширение закодированного изображения по сигнатуре"""
+    if data[:3] == b'\xff\xd8\xff':
+        return 'image/jpeg', 'jpg'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp', 'webp'
+    return 'image/png', 'png'
+
+
+def _render_page_within_budget(table: Dict, start: int, end: int, config: Dict, max_bytes: int):
+    """Отрисовка страницы; если файл больше max_bytes - страница делится пополам"""
+    img = render_table(_slice_layout(table['layout'], start, end), table['font'], table['font_bold'],
+                       aligns=table['aligns'],
+                       row_fills=table['row_fills'][start:end] if table['row_fills'] else None)
+    data = encode_image(img, config)
+    del img
+    if len(data) > max_bytes and end - start > 1:
+        mid = (start + end) // 2
+        logger.debug(f"Page rows {start}-{end} is {len(data)} bytes > {max_bytes}, splitting")
+        yield from _render_page_within_budget(table, start, mid, config, max_bytes)
+        yield from _render_page_within_budget(table, mid, end, config, max_bytes)
+        return
+    if len(data) > max_bytes:
+        logger.warning(f"Single-row page is {len(data)} bytes, exceeds budget {max_bytes}")
+    yield data
+
+
+def render_table_pages(table: Dict, config: Dict):
+    """Постраничная отрисовка таблицы: генератор закодированных страниц (см. encode_image)
+
+    Страницы рисуются по очереди, в памяти одновременно только одно изображение.
+    Лимиты: PNG_MAX_PAGE_HEIGHT, PNG_MAX_PAGE_PIXELS, PNG_MAX_PAGE_BYTES.
+    """
+    pages = paginate_table(
+        table['layout'],
+        config.get('png_max_page_height', 2000),
+        config.get('png_max_page_pixels', 4000000),
+    )
+    if len(pages) > 1:
+        logger.info(f"Table with {len(table['layout']['row_heights'])} rows split into {len(pages)} pages")
+    max_bytes = config.get('png_max_page_bytes', 5 * 1024 * 1024)
+    for start, end in pages:
+        yield from _render_page_within_budget(table, start, end, config, max_bytes)
+
+
+# Общая HTTP-сессия процесса (создаётся при первом обращении)
+_HTTP_SESSION: Optional[requests.Session] = None
+_HTTP_SESSION_LOCK = threading.Lock()
+
+
+def create_http_session(config: Dict) -> requests.Session:
+    """HTTP-сессия с keep-alive и пулом соединений
+
+    Повторяются только ошибки установки соединения (запрос ещё не ушёл, поэтому
+    повтор POST безопасен). HTTP_POOL_SIZE - максимум соединений на один хост
+    (при исчерпании запрос ждёт свободное соединение), HTTP_POOL_HOSTS - число
+    хостов, для которых держатся пулы.
+    """
+    retry = Retry(
+        total=None,
+        connect=config.get('http_connect_retries', 3),
+        read=0,
+        status=0,
+        other=0,
+        backoff_factor=config.get('http_retry_backoff', 0.5),
+        allowed_methods=None,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=config.get('http_pool_hosts', 4),
+        pool_maxsize=config.get('http_pool_size', 10),
+        pool_block=True,
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_http_session(config: Dict, session: Optional[requests.Session] = None) -> requests.Session:
+    """Сессия для запроса: переданная явно, из config['http_session'] или общая для процесса"""
+    global _HTTP_SESSION
+    if session is not None:
+        return session
+    if config.get('http_session') is not None:
+        return config['http_session']
+    with _HTTP_SESSION_LOCK:
+        if _HTTP_SESSION is None:
+            _HTTP_SESSION = create_http_session(config)
+        return _HTTP_SESSION
+
+
+def telegram_api_url(config: Dict, method: str) -> str:
+    """URL метода Bot API (TG_API_BASE - например, локальный fake_telegram_api.py)"""
+    api_base = config.get('tg_api_base') or 'https://api.telegram.org'
+    return f"{api_base.rstrip('/')}/bot{config['tg_token']}/{method}"
+
+
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, не больше capacity накопленных
+
+    Отправка дороже capacity (большой альбом) допускается при полном бакете
+    и уводит его в минус: следующие отправки ждут, пока долг не погасится.
+    """
     
-    # Параметры таблицы
-    cell_padding = 10
-    row_height = 50  # Увеличено с 40 для лучшего размещения многострочного текста
-    # Ширины колонок: увеличена 3-я колонка "Время назначения..." с 150 до 180
-    col_widths = [250, 150, 180, 100, 200, 120]  # Ширины колонок
-    header_height = 50
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
     
-    num_rows = len(records) + 1  # +1 для заголовка
-    table_width = sum(col_widths) + (len(col_widths) + 1) * 2  # +границы
-    table_height = header_height + num_rows * row_height
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
     
-    # Создание изображения
-    img = Image.new('RGB', (table_width, table_height), color='white')
-    draw = ImageDraw.Draw(img)
+    def wait_time(self, cost: float = 1) -> float:
+        """Сколько секунд ждать, пока накопится cost токенов (но не больше capacity)"""
+        self._refill()
+        needed = min(cost, self.capacity)
+        if self.tokens >= needed:
+            return 0.0
+        return (needed - self.tokens) / self.rate
     
-    try:
-        font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 12)
-        font_bold = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 12)
-    except:
-        font = ImageFont.load_default()
-        font_bold = font
+    def consume(self, cost: float = 1) -> None:
+        """Списание полной стоимости отправки; баланс может уйти в минус"""
+        self._refill()
+        self.tokens -= cost
     
-    # Заголовки
-    headers = ['Наименование маршрута', 'Плановое время подачи', 'Время назначения а/м на маршрут (факт)', 
-               'Опоздание, мин.', 'ФИО водителя', 'Гос. №']
+    def pause(self, seconds: float) -> None:
+        """Обнуление токенов на seconds секунд (ответ 429 с retry_after)"""
+        self._refill()
+        self.tokens = min(self.tokens, 0.0) - seconds * self.rate
+
+
+class TelegramRateLimiter:
+    """Планировщик отправок в Telegram: общий лимит бота и лимит на чат
+
+    Скорость на чат адаптируется (AIMD): после успешного ответа растёт на
+    TG_RATE_INCREASE до TG_CHAT_RATE, после 429 - падает вдвое до TG_CHAT_MIN_RATE.
+    Планировщик общий для потоков (стадии, тенанты): бакеты меняются под блокировкой.
+    """
     
-    x = 2
-    y = 2
+    def __init__(self, config: Dict):
+        self.global_bucket = TokenBucket(config.get('tg_global_rate', 30.0), config.get('tg_global_rate', 30.0))
+        self.chat_rate = config.get('tg_chat_rate', 1.0)
+        self.chat_min_rate = min(config.get('tg_chat_min_rate', 0.3), self.chat_rate)
+        self.chat_burst = config.get('tg_chat_burst', 3.0)
+        self.rate_increase = config.get('tg_rate_increase', 0.05)
+        self.chats: Dict[str, TokenBucket] = {}
+        self.lock = threading.Lock()
     
-    # Рисование заголовка
-    for i, header in enumerate(headers):
-        cell_rect = [x, y, x + col_widths[i], y + header_height]
-        draw.rectangle(cell_rect, outline='black', width=2)
-        draw.rectangle([cell_rect[0]+1, cell_rect[1]+1, cell_rect[2]-1, cell_rect[3]-1], fill='#f0f0f0')
-        
-        # Текст заголовка с переносами
-        words = header.split()
-        text_lines = []
-        current_line = []
-        for word in words:
-            test_line = ' '.join(current_line + [word])
-            bbox = draw.textbbox((0, 0), test_line, font=font_bold)
-            if bbox[2] - bbox[0] <= col_widths[i] - 2 * cell_padding:
-                current_line.append(word)
-            else:
-                if current_line:
-                    text_lines.append(' '.join(current_line))
-                current_line = [word]
-        if current_line:
-            text_lines.append(' '.join(current_line))
-        
-        text_y = cell_rect[1] + cell_padding
-        for line in text_lines[:3]:  # Максимум 3 строки
-            draw.text((cell_rect[0] + cell_padding, text_y), line, fill='black', font=font_bold)
-            text_y += 15
-        
-        x += col_widths[i] + 2
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        # Вызывается под self.lock
+        key = str(chat_id)
+        if key not in self.chats:
+            self.chats[key] = TokenBucket(self.chat_rate, self.chat_burst)
+        return self.chats[key]
     
-    # Данные
-    y = header_height + 2
-    for record in records:
-        x = 2
-        row_data = [
-            record['route_name'],
-            record['planned_time'],
-            record['assigned_time'],
-            str(record['delay_minutes']),
-            record['driver_name'],
-            record['plate_number'],
+    def _try_acquire(self, chat_id, cost: float) -> float:
+        """Списание cost токенов, если обоих хватает (0), иначе - сколько секунд ждать"""
+        with self.lock:
+            chat_bucket = self._chat_bucket(chat_id)
+            delay = max(self.global_bucket.wait_time(cost), chat_bucket.wait_time(cost))
+            if delay <= 0:
+                self.global_bucket.consume(cost)
+                chat_bucket.consume(cost)
+            return delay
+    
+    def acquire(self, chat_id, cost: float = 1) -> None:
+        """Ожидание разрешения на отправку cost сообщений (альбом = число фото)"""
+        while True:
+            delay = self._try_acquire(chat_id, cost)
+            if delay <= 0:
+                break
+            time.sleep(delay)
+    
+    async def acquire_async(self, chat_id, cost: float = 1) -> None:
+        """То же, что acquire, но без блокировки event loop"""
+        while True:
+            delay = self._try_acquire(chat_id, cost)
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+    
+    def on_success(self, chat_id) -> None:
+        with self.lock:
+            bucket = self._chat_bucket(chat_id)
+            bucket.rate = min(self.chat_rate, bucket.rate + self.rate_increase)
+    
+    def on_rate_limited(self, chat_id, retry_after: float) -> None:
+        with self.lock:
+            bucket = self._chat_bucket(chat_id)
+            bucket.rate = max(self.chat_min_rate, bucket.rate / 2)
+            bucket.pause(retry_after)
+        logger.warning(f"Telegram rate limit for chat {chat_id}: retry after {retry_after}s, rate lowered to {bucket.rate:.2f} msg/s")
+
+
+# Лимиты Telegram действуют на бота: планировщик общий для всех тенантов с одним токеном
+_RATE_LIMITERS: Dict[str, TelegramRateLimiter] = {}
+_RATE_LIMITERS_LOCK = threading.Lock()
+
+
+def get_rate_limiter(config: Dict) -> TelegramRateLimiter:
+    """Планировщик из config['rate_limiter'] или общий для процесса (по токену бота)"""
+    if config.get('rate_limiter') is not None:
+        return config['rate_limiter']
+    token = config.get('tg_token') or ''
+    with _RATE_LIMITERS_LOCK:
+        if token not in _RATE_LIMITERS:
+            _RATE_LIMITERS[token] = TelegramRateLimiter(config)
+        return _RATE_LIMITERS[token]
+
+
+def telegram_retry_after(response: requests.Response) -> float:
+    """retry_after из ответа 429 (поле parameters.retry_after или заголовок Retry-After)"""
+    try:
+        retry_after = response.json().get('parameters', {}).get('retry_after')
+        if retry_after is not None:
+            return float(retry_after)
+    except ValueError:
+        pass
+    try:
+        return float(response.headers.get('Retry-After', 1))
+    except (TypeError, ValueError):
+        return 1.0
+
+
+# file_id действителен только для загрузившего бота: кэши раздельные по FILE_ID_CACHE_PATH.
+# Во время прогона кэш меняется только в памяти, файл пишется один раз (stage_persist, drain_outbox)
+_FILE_ID_CACHES: Dict[str, Dict[str, Dict]] = {}
+_FILE_ID_CACHES_LOCK = threading.Lock()
+
+
+def load_file_id_cache(config: Dict) -> Dict[str, Dict]:
+    """Кэш file_id загруженных в Telegram картинок: {sha256 картинки: {file_id, ts}}"""
+    path = config.get('file_id_cache_path') or ''
+    if path not in _FILE_ID_CACHES:
+        cache = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    cache = json.load(f)
+            except Exception as e:
+                logger.warning(f"Failed to load file_id cache from {path}: {e}")
+        _FILE_ID_CACHES[path] = cache
+    return _FILE_ID_CACHES[path]
+
+
+def save_file_id_cache(config: Dict, max_age_days: int = 30) -> None:
+    """Сохранение кэша file_id (записи старше max_age_days удаляются)"""
+    path = config.get('file_id_cache_path')
+    cache = _FILE_ID_CACHES.get(path or '')
+    if not path or cache is None:
+        return
+    cutoff = time.time() - max_age_days * 24 * 60 * 60
+    with _FILE_ID_CACHES_LOCK:
+        for image_hash in [h for h, entry in cache.items() if entry.get('ts', 0) < cutoff]:
+            del cache[image_hash]
+        snapshot = dict(cache)
+    try:
+        atomic_write_json(path, snapshot, indent=None)
+    except Exception as e:
+        logger.warning(f"Failed to save file_id cache to {path}: {e}")
+
+
+def _attached_photos(kwargs: Dict) -> List[Tuple[int, str]]:
+    """Загружаемые фото запроса: [(позиция в сообщении/альбоме, поле files)]"""
+    data = kwargs.get('data') or {}
+    files = kwargs.get('files') or {}
+    if 'media' in data:
+        return [
+            (i, item['media'][len('attach://'):])
+            for i, item in enumerate(json.loads(data['media']))
+            if item['media'].startswith('attach://') and item['media'][len('attach://'):] in files
         ]
-        
-        for i, cell_text in enumerate(row_data):
-            cell_rect = [x, y, x + col_widths[i], y + row_height]
-            draw.rectangle(cell_rect, outline='black', width=1)
-            
-            # Обрезка текста если слишком длинный
-            text = str(cell_text)[:40] + ('...' if len(str(cell_text)) > 40 else '')
-            
-            # Вычисляем высоту текста для вертикального центрирования
-            text_bbox = draw.textbbox((0, 0), text, font=font)
-            text_height = text_bbox[3] - text_bbox[1]
-            text_width = text_bbox[2] - text_bbox[0]
-            
-            # Если текст содержит перенос строки - обрабатываем многострочно
-            if '\n' in text:
-                lines = text.split('\n')
-                line_height = text_height
-                total_text_height = len(lines) * line_height + (len(lines) - 1) * 5  # + межстрочный интервал
-                text_y_start = cell_rect[1] + (row_height - total_text_height) // 2
-                for line in lines:
-                    if i == 0:  # Первая колонка "Наименование маршрута" - выравнивание по левому краю
-                        text_x = cell_rect[0] + cell_padding
-                    elif i == 2:  # 3-я колонка "Время назначения..." - центрирование
-                        line_bbox = draw.textbbox((0, 0), line, font=font)
-                        line_width = line_bbox[2] - line_bbox[0]
-                        text_x = cell_rect[0] + (col_widths[i] - line_width) // 2
-                    else:  # Остальные колонки - выравнивание по центру для чисел
-                        line_bbox = draw.textbbox((0, 0), line, font=font)
-                        line_width = line_bbox[2] - line_bbox[0]
-                        text_x = cell_rect[0] + (col_widths[i] - line_width) // 2
-                    draw.text((text_x, text_y_start), line, fill='black', font=font)
-                    text_y_start += line_height + 5
+    if 'photo' in files:
+        return [(0, 'photo')]
+    return []
+
+
+def file_id_request(config: Dict, kwargs: Dict) -> Optional[Dict]:
+    """Вариант запроса, где уже загруженные картинки заменены на file_id (None - заменять нечего)"""
+    if not config.get('file_id_cache_path') or not kwargs.get('files'):
+        return None
+    cache = load_file_id_cache(config)
+    data = dict(kwargs['data'])
+    files = dict(kwargs['files'])
+    media = json.loads(data['media']) if 'media' in data else None
+    replaced = 0
+    for i, field in _attached_photos(kwargs):
+        entry = cache.get(hashlib.sha256(files[field][1]).hexdigest())
+        if not entry:
+            continue
+        if media is None:
+            data['photo'] = entry['file_id']
+        else:
+            media[i]['media'] = entry['file_id']
+        del files[field]
+        replaced += 1
+    if not replaced:
+        return None
+    if media is not None:
+        data['media'] = json.dumps(media, ensure_ascii=False)
+    cached = {**kwargs, 'data': data}
+    if files:
+        cached['files'] = files
+    else:
+        cached.pop('files')
+    return cached
+
+
+def remember_file_ids(config: Dict, kwargs: Dict, response) -> None:
+    """Запоминание file_id загруженных картинок из ответа sendPhoto/sendMediaGroup (в памяти)"""
+    attached = _attached_photos(kwargs)
+    if not config.get('file_id_cache_path') or not attached:
+        return
+    try:
+        result = response.json().get('result')
+        messages = result if isinstance(result, list) else [result]
+        cache = load_file_id_cache(config)
+        for i, field in attached:
+            # Самый большой размер - последний в списке photo
+            file_id = messages[i]['photo'][-1]['file_id']
+            with _FILE_ID_CACHES_LOCK:
+                cache[hashlib.sha256(kwargs['files'][field][1]).hexdigest()] = {'file_id': file_id, 'ts': time.time()}
+    except Exception as e:
+        logger.debug(f"file_id not stored: {e}")
+
+
+def forget_file_ids(config: Dict, kwargs: Dict) -> None:
+    """Удаление из кэша file_id картинок запроса (Telegram не принял file_id)"""
+    cache = load_file_id_cache(config)
+    with _FILE_ID_CACHES_LOCK:
+        for _, field in _attached_photos(kwargs):
+            cache.pop(hashlib.sha256(kwargs['files'][field][1]).hexdigest(), None)
+
+
+def _is_bad_request(error: Exception) -> bool:
+    response = getattr(error, 'response', None)
+    return response is not None and response.status_code == 400
+
+
+def telegram_post(config: Dict, url: str, cost: float = 1, session: Optional[requests.Session] = None,
+                  **kwargs) -> requests.Response:
+    """POST в Bot API с переиспользованием file_id уже загруженных картинок
+
+    Если Telegram не принял сохранённый file_id, запрос повторяется с загрузкой файлов.
+    """
+    cached = file_id_request(config, kwargs)
+    if cached is not None:
+        try:
+            response = _telegram_post(config, url, cost, session, **cached)
+            remember_file_ids(config, cached, response)
+            return response
+        except requests.HTTPError as e:
+            if not _is_bad_request(e):
+                raise
+            logger.warning(f"Cached file_id rejected by Telegram, uploading images again: {e}")
+            forget_file_ids(config, kwargs)
+    response = _telegram_post(config, url, cost, session, **kwargs)
+    remember_file_ids(config, kwargs, response)
+    return response
+
+
+def _telegram_post(config: Dict, url: str, cost: float = 1, session: Optional[requests.Session] = None,
+                   **kwargs) -> requests.Response:
+    """POST в Bot API через планировщик: ожидание лимита, повтор после 429 и 5xx
+
+    Возвращает успешный ответ, иначе бросает исключение (как raise_for_status).
+    """
+    limiter = get_rate_limiter(config)
+    chat_id = config['tg_chat_id']
+    max_retries = config.get('tg_max_retries', 5)
+    attempt = 0
+    while True:
+        limiter.acquire(chat_id, cost)
+        response = get_http_session(config, session).post(url, **kwargs)
+        if response.status_code == 429 and attempt < max_retries:
+            attempt += 1
+            limiter.on_rate_limited(chat_id, telegram_retry_after(response))
+            continue
+        if response.status_code >= 500 and attempt < max_retries:
+            attempt += 1
+            delay = config.get('http_retry_backoff', 0.5) * (2 ** attempt)
+            logger.warning(f"Telegram server error {response.status_code}, retry {attempt}/{max_retries} in {delay:.1f}s")
+            time.sleep(delay)
+            continue
+        response.raise_for_status()
+        limiter.on_success(chat_id)
+        return response
+
+
+async def telegram_post_async(config: Dict, client: httpx.AsyncClient, url: str, cost: float = 1,
+                              **kwargs) -> httpx.Response:
+    """Асинхронный аналог telegram_post (httpx), лимиты, повторы и кэш file_id те же"""
+    cached = file_id_request(config, kwargs)
+    if cached is not None:
+        try:
+            response = await _telegram_post_async(config, client, url, cost, **cached)
+            remember_file_ids(config, cached, response)
+            return response
+        except httpx.HTTPStatusError as e:
+            if not _is_bad_request(e):
+                raise
+            logger.warning(f"Cached file_id rejected by Telegram, uploading images again: {e}")
+            forget_file_ids(config, kwargs)
+    response = await _telegram_post_async(config, client, url, cost, **kwargs)
+    remember_file_ids(config, kwargs, response)
+    return response
+
+
+async def _telegram_post_async(config: Dict, client: httpx.AsyncClient, url: str, cost: float = 1,
+                               **kwargs) -> httpx.Response:
+    limiter = get_rate_limiter(config)
+    chat_id = config['tg_chat_id']
+    max_retries = config.get('tg_max_retries', 5)
+    attempt = 0
+    while True:
+        await limiter.acquire_async(chat_id, cost)
+        response = await client.post(url, **kwargs)
+        if response.status_code == 429 and attempt < max_retries:
+            attempt += 1
+            limiter.on_rate_limited(chat_id, telegram_retry_after(response))
+            continue
+        if response.status_code >= 500 and attempt < max_retries:
+            attempt += 1
+            delay = config.get('http_retry_backoff', 0.5) * (2 ** attempt)
+            logger.warning(f"Telegram server error {response.status_code}, retry {attempt}/{max_retries} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            continue
+        response.raise_for_status()
+        limiter.on_success(chat_id)
+        return response
+
+
+# Лимит длины текстового сообщения Telegram
+TG_MESSAGE_LIMIT = 4096
+
+
+def format_text_table(headers: List[str], rows: List[List[str]], max_col_width: int = 24) -> Tuple[List[str], List[List[str]]]:
+    """Моноширинная таблица без растеризации
+
+    Returns:
+        (строки шапки, блоки строк данных) - многострочная ячейка (перенос textwrap)
+        даёт блок из нескольких строк, блоки не разрываются при разбиении на сообщения.
+    """
+    def wrap_cell(value: str, width: int) -> List[str]:
+        lines = []
+        for paragraph in str(value).split('\n'):
+            lines.extend(textwrap.wrap(paragraph, width=width) or [''])
+        return lines
+
+    widths = []
+    for i, header in enumerate(headers):
+        longest = max([len(str(header))] + [len(line) for row in rows for line in str(row[i]).split('\n')])
+        widths.append(max(1, min(max_col_width, longest)))
+
+    def format_block(cells: List[str]) -> List[str]:
+        wrapped = [wrap_cell(value, width) for value, width in zip(cells, widths)]
+        height = max(len(lines) for lines in wrapped)
+        return [
+            ' | '.join((lines[n] if n < len(lines) else '').ljust(width) for lines, width in zip(wrapped, widths)).rstrip()
+            for n in range(height)
+        ]
+
+    header_lines = format_block([str(h) for h in headers])
+    header_lines.append('-+-'.join('-' * width for width in widths))
+    return header_lines, [format_block([str(v) for v in row]) for row in rows]
+
+
+def render_html_pre_messages(headers: List[str], rows: List[List[str]], title: Optional[str] = None,
+                             limit: int = TG_MESSAGE_LIMIT) -> List[str]:
+    """Telegram-HTML сообщения с таблицей в <pre>, каждое не длиннее limit
+
+    Шапка повторяется в каждом сообщении, title (уже в HTML) - только в первом.
+    Слишком длинные блоки режутся по строкам (а строки - по символам) до
+    экранирования, поэтому теги и HTML-сущности никогда не разрезаются.
+    """
+    header_lines, row_blocks = format_text_table(headers, rows)
+    header_text = html.escape('\n'.join(header_lines))
+
+    def wrap_message(body: str, with_title: bool) -> str:
+        prefix = f"{title}\n" if with_title and title else ''
+        return f"{prefix}<pre>{header_text}\n{body}</pre>"
+
+    budget = max(limit - len(wrap_message('', True)), 1)
+
+    def split_line(line: str) -> List[str]:
+        """Экранированные куски строки, каждый не длиннее budget"""
+        pieces, current = [], ''
+        for char in line:
+            escaped = html.escape(char)
+            if current and len(current) + len(escaped) > budget:
+                pieces.append(current)
+                current = ''
+            current += escaped
+        pieces.append(current)
+        return pieces
+
+    def split_block(block: List[str]) -> List[str]:
+        """Блок строк таблицы, разбитый на экранированные части не длиннее budget"""
+        parts, current = [], ''
+        for line in block:
+            for piece in split_line(line):
+                candidate = f"{current}\n{piece}" if current else piece
+                if current and len(candidate) > budget:
+                    parts.append(current)
+                    candidate = piece
+                current = candidate
+        parts.append(current)
+        return parts
+
+    messages = []
+    body = ''
+    for block in row_blocks:
+        for block_text in split_block(block):
+            candidate = f"{body}\n{block_text}" if body else block_text
+            if body and len(wrap_message(candidate, not messages)) > limit:
+                messages.append(wrap_message(body, not messages))
+                body = block_text
             else:
-                # Однострочный текст - центрирование по вертикали и горизонтали
-                cell_height = row_height
-                text_y = cell_rect[1] + (cell_height - text_height) // 2
-                
-                if i == 0:  # Первая колонка "Наименование маршрута" - выравнивание по левому краю
-                    text_x = cell_rect[0] + cell_padding
-                else:  # Остальные колонки - центрирование по горизонтали
-                    text_x = cell_rect[0] + (col_widths[i] - text_width) // 2
-                
-                draw.text((text_x, text_y), text, fill='black', font=font)
-            
-            x += col_widths[i] + 2
-        
-        y += row_height
+                body = candidate
+    messages.append(wrap_message(body, not messages))
+    return messages
+
+
+def generate_html_table(headers: List[str], rows: List[List[str]], title: str = '') -> bytes:
+    """Самостоятельный HTML-файл с таблицей (для просмотра в браузере/дашборде)"""
+    head = ''.join(f"<th>{html.escape(str(h))}</th>" for h in headers)
+    body = '\n'.join(
+        '<tr>' + ''.join(f"<td>{html.escape(str(v))}</td>" for v in row) + '</tr>'
+        for row in rows
+    )
+    document = f"""<!DOCTYPE html>
+<html lang="ru">
+<head>
+<meta charset="utf-8">
+<title>{html.escape(title)}</title>
+<style>
+body {{ font-family: DejaVu Sans, Arial, sans-serif; font-size: 13px; }}
+table {{ border-collapse: collapse; }}
+th, td {{ border: 1px solid #000; padding: 4px 8px; vertical-align: top; }}
+th {{ background: #f0f0f0; text-align: left; }}
+</style>
+</head>
+<body>
+<h3>{html.escape(title)}</h3>
+<table>
+<thead><tr>{head}</tr></thead>
+<tbody>
+{body}
+</tbody>
+</table>
+</body>
+</html>
+"""
+    return document.encode('utf-8')
+
+
+def generate_csv_table(headers: List[str], rows: List[List[str]]) -> bytes:
+    """CSV-файл с таблицей (UTF-8 с BOM, чтобы Excel корректно открывал кириллицу)"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=';')
+    writer.writerow([str(h) for h in headers])
+    writer.writerows([[str(v) for v in row] for row in rows])
+    return buffer.getvalue().encode('utf-8-sig')
+
+
+def late_table_text(records: List[Dict]) -> Tuple[List[str], List[List[str]]]:
+    """Заголовки и строки late-report для текстовых форматов"""
+    return [header for header, _, _ in LATE_TABLE_COLUMNS], late_table_rows(records)
+
+
+def docs_table_text(df: pd.DataFrame) -> Tuple[List[str], List[List[str]]]:
+    """Заголовки и строки docs-report для текстовых форматов (те же колонки, что на картинке)"""
+    df, _ = prepare_docs_table(df)
+    rows = [
+        [str(row[col]) if pd.notna(row[col]) else '' for col in df.columns]
+        for _, row in df.iterrows()
+    ]
+    return [str(col) for col in df.columns], rows
+
+
+def generate_text_table(records: List[Dict], title: Optional[str] = None) -> List[str]:
+    """Late-report в виде Telegram-HTML сообщений с <pre> таблицей (без Pillow)"""
+    if not records:
+        return []
+    headers, rows = late_table_text(records)
+    return render_html_pre_messages(headers, rows, title=title)
+
+
+def generate_text_table_docs(df: pd.DataFrame, title: Optional[str] = None) -> List[str]:
+    """Docs-report водителя в виде Telegram-HTML сообщений с <pre> таблицей (без Pillow)"""
+    if len(df) == 0:
+        return []
+    headers, rows = docs_table_text(df)
+    if not headers:
+        return []
+    return render_html_pre_messages(headers, rows, title=title)
+
+
+def _photo_bytes(photo) -> bytes:
+    """Байты фото: изображение уже в памяти (bytes) или путь к файлу (для обратной совместимости)"""
+    if isinstance(photo, (bytes, bytearray)):
+        return bytes(photo)
+    with open(photo, 'rb') as f:
+        return f.read()
+
+
+def dump_debug_image(config: Dict, name: str, data: bytes):
+    """Сохранение отрендеренного изображения на диск для отладки (только если задан DEBUG_IMAGE_DIR)"""
+    debug_dir = config.get('debug_image_dir')
+    if not debug_dir:
+        return
+    try:
+        os.makedirs(debug_dir, exist_ok=True)
+        path = os.path.join(debug_dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        logger.debug(f"Debug image saved: {path}")
+    except Exception as e:
+        logger.warning(f"Failed to save debug image {name}: {e}")
+
+
+def telegram_photo_request(config: Dict, photo, caption: str, topic_id: Optional[int]) -> Dict:
+    """Параметры POST-запроса sendPhoto (общие для синхронной и асинхронной отправки)"""
+    data = {
+        'chat_id': config['tg_chat_id'],
+        'caption': caption[:1024],  # Ограничение длины
+    }
     
-    img.save(output_path)
-    logger.info(f"Generated PNG table: {output_path}")
-    return True
+    if topic_id:
+        data['message_thread_id'] = int(topic_id)
+    
+    photo_data = _photo_bytes(photo)
+    mime_type, ext = image_mime_type(photo_data)
+    files = {'photo': (f'report.{ext}', photo_data, mime_type)}
+    return {'data': data, 'files': files, 'timeout': 30}
+
+
+def telegram_media_group_request(config: Dict, photos: List, captions: List[Optional[str]], topic_id: Optional[int]) -> Dict:
+    """Параметры POST-запроса sendMediaGroup"""
+    media = []
+    for i, caption in enumerate(captions):
+        item = {'type': 'photo', 'media': f'attach://photo{i}'}
+        if caption:
+            item['caption'] = caption[:1024]
+        media.append(item)
+    
+    data = {
+        'chat_id': config['tg_chat_id'],
+        'media': json.dumps(media, ensure_ascii=False),
+    }
+    
+    if topic_id:
+        data['message_thread_id'] = int(topic_id)
+    
+    files = {}
+    for i, photo in enumerate(photos):
+        photo_data = _photo_bytes(photo)
+        mime_type, ext = image_mime_type(photo_data)
+        files[f'photo{i}'] = (f'page{i + 1}.{ext}', photo_data, mime_type)
+    return {'data': data, 'files': files, 'timeout': 60}
+
+
+def telegram_message_request(config: Dict, text: str, topic_id: Optional[int], parse_mode: Optional[str] = None) -> Dict:
+    """Параметры POST-запроса sendMessage"""
+    data = {
+        'chat_id': config['tg_chat_id'],
+        'text': text[:4096],
+    }
+    
+    if topic_id:
+        data['message_thread_id'] = int(topic_id)
+    
+    if parse_mode:
+        data['parse_mode'] = parse_mode
+    return {'json': data, 'timeout': 30}
 
 
-def send_telegram_photo(config: Dict, photo_path: str, caption: str, topic_id: Optional[int] = None):
-    """Отправка фото в Telegram в указанную тему"""
+def send_telegram_photo(config: Dict, photo, caption: str, topic_id: Optional[int] = None,
+                        session: Optional[requests.Session] = None):
+    """Отправка фото в Telegram в указанную тему
+
+    photo - изображение в памяти (bytes) или путь к файлу.
+    """
     if not config['tg_token'] or not config['tg_chat_id']:
         logger.error("Telegram credentials not set")
         return False
@@ -1208,29 +2842,79 @@ def send_telegram_photo(config: Dict, photo_path: str, caption: str, topic_id: O
         logger.info(f"[DRY_RUN] Would send photo to Telegram: chat {config['tg_chat_id']}, topic {topic_id}, caption length: {len(caption)}")
         return True
     
-    url = f"https://api.telegram.org/bot{config['tg_token']}/sendPhoto"
+    url = telegram_api_url(config, 'sendPhoto')
     
-    data = {
-        'chat_id': config['tg_chat_id'],
-        'caption': caption[:1024],  # Ограничение длины
-    }
+    try:
+        telegram_post(config, url, session=session, **telegram_photo_request(config, photo, caption, topic_id))
+        logger.info(f"Photo sent successfully to topic {topic_id}")
+        return True
+    except Exception as e:
+        logger.error(f"Failed to send photo: {e}")
+        return False
+
+
+def send_telegram_media_group(config: Dict, photos: List, captions: List[Optional[str]], topic_id: Optional[int] = None,
+                              session: Optional[requests.Session] = None):
+    """Отправка альбома (до 10 фото) через sendMediaGroup, порядок фото сохраняется
+
+    photos - изображения в памяти (bytes) или пути к файлам.
+    """
+    if not config['tg_token'] or not config['tg_chat_id']:
+        logger.error("Telegram credentials not set")
+        return False
     
-    if topic_id:
-        data['message_thread_id'] = int(topic_id)
+    if topic_id is None:
+        topic_id = config.get('tg_topic_id_late') or config.get('tg_topic_id')
+    
+    if config.get('dry_run', False):
+        logger.info(f"[DRY_RUN] Would send album of {len(photos)} photos to Telegram: chat {config['tg_chat_id']}, topic {topic_id}")
+        return True
+    
+    url = telegram_api_url(config, 'sendMediaGroup')
     
     try:
-        with open(photo_path, 'rb') as photo:
-            files = {'photo': photo}
-            response = requests.post(url, data=data, files=files, timeout=30)
-            response.raise_for_status()
-            logger.info(f"Photo sent successfully to topic {topic_id}")
-            return True
+        telegram_post(config, url, cost=len(photos), session=session,
+                      **telegram_media_group_request(config, photos, captions, topic_id))
+        logger.info(f"Album of {len(photos)} photos sent successfully to topic {topic_id}")
+        return True
     except Exception as e:
-        logger.error(f"Failed to send photo: {e}")
+        logger.error(f"Failed to send album: {e}")
         return False
 
 
-def send_telegram_text(config: Dict, text: str):
+def album_slices(count: int, max_size: int = 10) -> List[slice]:
+    """Разбиение count фото на альбомы не больше max_size, выровненные по размеру
+
+    Telegram принимает альбом из 2-10 фото, поэтому 11 страниц делятся на 6+5, а не 10+1.
+    """
+    albums = -(-count // max_size)
+    base, extra = divmod(count, albums) if albums else (0, 0)
+    slices = []
+    start = 0
+    for i in range(albums):
+        size = base + (1 if i < extra else 0)
+        slices.append(slice(start, start + size))
+        start += size
+    return slices
+
+
+def send_telegram_photos(config: Dict, photos: List, caption: str, topic_id: Optional[int] = None,
+                         session: Optional[requests.Session] = None):
+    """Отправка страниц таблицы: одно фото - sendPhoto, несколько - упорядоченные альбомы до 10 (album_slices)"""
+    if len(photos) == 1:
+        return send_telegram_photo(config, photos[0], caption, topic_id=topic_id, session=session)
+    
+    success = True
+    for part in album_slices(len(photos)):
+        chunk = photos[part]
+        # Подпись у первого фото первого альбома (как у одиночного фото)
+        captions = [caption if part.start == 0 and i == 0 else None for i in range(len(chunk))]
+        if not send_telegram_media_group(config, chunk, captions, topic_id=topic_id, session=session):
+            success = False
+    return success
+
+
+def send_telegram_text(config: Dict, text: str, session: Optional[requests.Session] = None):
     """Отправка текста в Telegram"""
     if not config['tg_token'] or not config['tg_chat_id']:
         return False
@@ -1239,28 +2923,203 @@ def send_telegram_text(config: Dict, text: str):
         logger.info(f"[DRY_RUN] Would send text to Telegram: {text[:100]}...")
         return True
     
-    url = f"https://api.telegram.org/bot{config['tg_token']}/sendMessage"
+    url = telegram_api_url(config, 'sendMessage')
     
     data = {
         'chat_id': config['tg_chat_id'],
         'text': text[:4096],
     }
     
-    if config['tg_topic_id']:
-        data['message_thread_id'] = int(config['tg_topic_id'])
+    topic_id = config.get('tg_topic_id_late') or config.get('tg_topic_id')
+    if topic_id:
+        data['message_thread_id'] = int(topic_id)
     
     try:
-        response = requests.post(url, json=data, timeout=30)
-        response.raise_for_status()
+        telegram_post(config, url, session=session, json=data, timeout=30)
         return True
     except Exception as e:
         logger.error(f"Failed to send text: {e}")
         return False
 
 
-def save_late_delays_to_api(config: Dict, records: List[Dict], delay_date: datetime) -> bool:
-    """Сохранение записей об опозданиях в базу данных через API"""
-    api_base = os.getenv('API_BASE_URL', 'http://localhost:3000')
+def late_record_key(record: Dict, delay_date: datetime) -> str:
+    """Стабильный ключ записи опоздания: водитель, маршрут, плановое время, дата"""
+    parts = [
+        normalize_text_value(record.get('driver_name', '')).lower(),
+        normalize_text_value(record.get('route_name', '')).lower(),
+        normalize_text_value(record.get('planned_time', '')),
+        delay_date.date().isoformat(),
+    ]
+    return hashlib.sha256('|'.join(parts).encode('utf-8')).hexdigest()
+
+
+def late_record_hash(api_record: Dict) -> str:
+    """Хеш изменяемых полей записи (новая версия той же записи отправляется повторно)"""
+    fields = [str(api_record.get(name, '')) for name in ('plate_number', 'assigned_time', 'delay_minutes')]
+    return hashlib.sha256('|'.join(fields).encode('utf-8')).hexdigest()[:16]
+
+
+def _post_api_chunk(config: Dict, url: str, chunk: List[Dict],
+                    session: Optional[requests.Session] = None) -> Tuple[bool, int, str]:
+    """POST одного чанка записей с повторами (backoff с jitter): (успех, сохранено, ошибка)
+
+    Повторяются ошибки соединения, таймауты, 429 и 5xx; остальные 4xx - сразу ошибка.
+    """
+    body = json.dumps({'records': chunk}, ensure_ascii=False).encode('utf-8')
+    headers = {
+        'Content-Type': 'application/json',
+    }
+    if config.get('api_key'):
+        headers['X-Api-Key'] = config['api_key']
+    if config.get('api_gzip', False):
+        body = gzip.compress(body)
+        headers['Content-Encoding'] = 'gzip'
+    
+    max_retries = config.get('api_max_retries', 4)
+    backoff = config.get('api_retry_backoff', 1.0)
+    error = ''
+    for attempt in range(max_retries + 1):
+        if attempt:
+            # Full jitter: случайная пауза до backoff * 2^attempt
+            time.sleep(random.uniform(0, backoff * 2 ** attempt))
+        try:
+            response = get_http_session(config, session).post(url, data=body, headers=headers,
+                                                               timeout=config.get('api_timeout', 30))
+        except requests.RequestException as e:
+            error = str(e)
+            logger.warning(f"API chunk attempt {attempt + 1}/{max_retries + 1} failed: {error}")
+            continue
+        if response.status_code in (200, 201):
+            try:
+                saved = response.json().get('saved', len(chunk))
+            except ValueError:
+                saved = len(chunk)
+            return True, saved, ''
+        error = f"{response.status_code} {response.text[:200]}"
+        if response.status_code != 429 and response.status_code < 500:
+            break
+        logger.warning(f"API chunk attempt {attempt + 1}/{max_retries + 1} failed: {error}")
+    return False, 0, error
+
+
+def _read_api_spool(path: str) -> Tuple[List[Dict], set]:
+    """Чтение spool: (батчи в порядке записи, id подтверждённых батчей)"""
+    batches, acked_ids = [], set()
+    if not os.path.exists(path):
+        return batches, acked_ids
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Недописанная строка (процесс прерван во время записи)
+                logger.warning(f"Skipping damaged line in API spool {path}")
+                continue
+            if 'ack' in entry:
+                acked_ids.add(entry['ack'])
+            else:
+                batches.append(entry)
+    return batches, acked_ids
+
+
+def _append_api_spool(path: str, entry: Dict) -> None:
+    spool_dir = os.path.dirname(path)
+    if spool_dir:
+        os.makedirs(spool_dir, exist_ok=True)
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _rewrite_api_spool(path: str, batches: List[Dict]) -> None:
+    """Атомарная перезапись spool только неподтверждёнными батчами"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for entry in batches:
+            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    _fsync_dir(path)
+
+
+def spool_api_batch(config: Dict, records: List[Dict], error: str) -> None:
+    """Запись неудачного чанка в spool (append-only JSONL) для повтора в следующем запуске"""
+    path = config.get('api_spool_path')
+    if not path:
+        return
+    entry = {'id': f"{time.time():.6f}-{random.getrandbits(32):08x}", 'ts': time.time(), 'error': error, 'records': records}
+    try:
+        _append_api_spool(path, entry)
+        logger.warning(f"Spooled {len(records)} late delay records to {path} for replay")
+        if os.path.getsize(path) > config.get('api_spool_max_bytes', 50 * 1024 * 1024):
+            compact_api_spool(config)
+    except Exception as e:
+        logger.error(f"Failed to spool late delay records: {e}")
+
+
+def compact_api_spool(config: Dict) -> None:
+    """Сжатие spool: убираются подтверждённые батчи, при превышении размера - самые старые"""
+    path = config['api_spool_path']
+    batches, acked_ids = _read_api_spool(path)
+    pending = [entry for entry in batches if entry['id'] not in acked_ids]
+    max_bytes = config.get('api_spool_max_bytes', 50 * 1024 * 1024)
+    sizes = [len(json.dumps(entry, ensure_ascii=False).encode('utf-8')) + 1 for entry in pending]
+    dropped = 0
+    while pending and sum(sizes) > max_bytes:
+        dropped += len(pending.pop(0)['records'])
+        sizes.pop(0)
+    if dropped:
+        logger.error(f"API spool exceeds {max_bytes} bytes: dropped {dropped} oldest late delay records")
+    _rewrite_api_spool(path, pending)
+
+
+def replay_api_spool(config: Dict, session: Optional[requests.Session] = None) -> None:
+    """Повтор отложенных батчей по порядку (в начале запуска); на первой ошибке - стоп"""
+    path = config.get('api_spool_path')
+    if not path or config.get('dry_run', False) or not os.path.exists(path) or not config.get('api_base_url'):
+        return
+    batches, acked_ids = _read_api_spool(path)
+    pending = [entry for entry in batches if entry['id'] not in acked_ids]
+    if not pending:
+        if batches:
+            _rewrite_api_spool(path, [])
+        return
+    
+    logger.info(f"Replaying {len(pending)} spooled late delay batches")
+    url = f"{config['api_base_url']}/api/late-delays"
+    acked = {}
+    replayed = 0
+    for entry in pending:
+        ok, _saved, error = _post_api_chunk(config, url, entry['records'], session=session)
+        if not ok:
+            logger.error(f"Spool replay stopped, backend still failing: {error}")
+            break
+        _append_api_spool(path, {'ack': entry['id']})
+        for api_record in entry['records']:
+            if api_record.get('record_key'):
+                acked[api_record['record_key']] = {'hash': late_record_hash(api_record), 'ts': time.time()}
+        replayed += 1
+    if acked:
+        with updated_state(config['state_path']) as state:
+            state.setdefault('api_acked', {}).update(acked)
+    logger.info(f"Replayed {replayed}/{len(pending)} spooled late delay batches")
+    compact_api_spool(config)
+
+
+def save_late_delays_to_api(config: Dict, records: List[Dict], delay_date: datetime,
+                            session: Optional[requests.Session] = None) -> bool:
+    """Сохранение записей об опозданиях в базу данных через API
+
+    Записи отправляются чанками по API_CHUNK_SIZE (опционально gzip), каждый чанк
+    с повторами; в лог пишется результат по каждому неудачному чанку.
+    
+    Каждая запись несёт record_key и сохраняется на backend через upsert. Ключи
+    подтверждённых записей хранятся в state (api_acked), повторно отправляются
+    только новые и изменившиеся записи.
+    """
+    api_base = config.get('api_base_url')
     
     if not api_base:
         logger.warning("API_BASE_URL not set, skipping database save")
@@ -1278,6 +3137,8 @@ def save_late_delays_to_api(config: Dict, records: List[Dict], delay_date: datet
                 'assigned_time': record.get('assigned_time', ''),
                 'delay_minutes': record.get('delay_minutes', 0),
                 'delay_date': delay_date.isoformat(),
+                'record_key': late_record_key(record, delay_date),
+                'upsert': True,
             }
             api_records.append(api_record)
         
@@ -1285,22 +3146,59 @@ def save_late_delays_to_api(config: Dict, records: List[Dict], delay_date: datet
             logger.warning("No records to save")
             return False
         
-        # Отправляем POST запрос (без аутентификации для localhost)
+        # Дельта: пропускаем записи, которые backend уже подтвердил в этой же версии
+        state = load_state(config['state_path'])
+        acked = state.get('api_acked', {})
+        total_records = len(api_records)
+        api_records = [
+            api_record for api_record in api_records
+            if acked.get(api_record['record_key'], {}).get('hash') != late_record_hash(api_record)
+        ]
+        if not api_records:
+            logger.info(f"All {total_records} late delay records already saved to database, nothing to sync")
+            return True
+        logger.info(f"Syncing {len(api_records)}/{total_records} new or changed late delay records")
+        
+        # Отправляем POST запросы (без аутентификации для localhost)
         url = f"{api_base}/api/late-delays"
-        headers = {
-            'Content-Type': 'application/json',
-        }
+        chunk_size = max(1, config.get('api_chunk_size', 500))
+        chunks = [api_records[i:i + chunk_size] for i in range(0, len(api_records), chunk_size)]
+        
+        saved_count = 0
+        failed = []
+        new_acked = {}
+        for index, chunk in enumerate(chunks):
+            if failed and config.get('api_spool_path'):
+                # Backend недоступен: остальные чанки сразу в spool, без повторов (порядок сохраняется)
+                ok, saved, error = False, 0, f"skipped after chunk {failed[0][0] + 1} failed"
+            else:
+                ok, saved, error = _post_api_chunk(config, url, chunk, session=session)
+            if ok:
+                saved_count += saved
+                for api_record in chunk:
+                    new_acked[api_record['record_key']] = {'hash': late_record_hash(api_record), 'ts': time.time()}
+            else:
+                first_row = index * chunk_size
+                failed.append((index, first_row, first_row + len(chunk) - 1, error))
+                logger.error(f"Failed to save late delays chunk {index + 1}/{len(chunks)} "
+                             f"(records {first_row}-{first_row + len(chunk) - 1}): {error}")
+                spool_api_batch(config, chunk, error)
         
-        response = requests.post(url, json={'records': api_records}, headers=headers, timeout=10)
+        # Подтверждённые ключи храним 60 дней
+        max_age_seconds = 60 * 24 * 60 * 60
+        with updated_state(config['state_path']) as state:
+            acked = {**state.get('api_acked', {}), **new_acked}
+            state['api_acked'] = {
+                key: entry for key, entry in acked.items()
+                if time.time() - entry.get('ts', 0) < max_age_seconds
+            }
         
-        if response.status_code in (200, 201):
-            result = response.json()
-            saved_count = result.get('saved', len(api_records))
-            logger.info(f"Successfully saved {saved_count} late delay records to database")
+        if not failed:
+            logger.info(f"Successfully saved {saved_count} late delay records to database ({len(chunks)} chunks)")
             return True
-        else:
-            logger.error(f"Failed to save late delays to API: {response.status_code} {response.text}")
-            return False
+        logger.error(f"Saved {saved_count}/{len(api_records)} late delay records: "
+                     f"{len(failed)}/{len(chunks)} chunks failed")
+        return False
             
     except Exception as e:
         logger.error(f"Error saving late delays to API: {e}")
@@ -1308,8 +3206,8 @@ def save_late_delays_to_api(config: Dict, records: List[Dict], delay_date: datet
         traceback.print_exc()
         return False
 
-
-def send_telegram_message(config: Dict, text: str, topic_id: Optional[int] = None):
+def send_telegram_message(config: Dict, text: str, topic_id: Optional[int] = None, parse_mode: Optional[str] = None,
+                          session: Optional[requests.Session] = None):
     """Отправка текстового сообщения в Telegram в указанную тему"""
     if not config['tg_token'] or not config['tg_chat_id']:
         logger.error("Telegram credentials not set")
@@ -1319,26 +3217,58 @@ def send_telegram_message(config: Dict, text: str, topic_id: Optional[int] = Non
         logger.info(f"[DRY_RUN] Would send message to Telegram: topic {topic_id}, text: {text[:100]}...")
         return True
     
-    url = f"https://api.telegram.org/bot{config['tg_token']}/sendMessage"
+    url = telegram_api_url(config, 'sendMessage')
+    
+    try:
+        telegram_post(config, url, session=session, **telegram_message_request(config, text, topic_id, parse_mode))
+        logger.info(f"Message sent successfully to topic {topic_id}")
+        return True
+    except Exception as e:
+        logger.error(f"Failed to send message: {e}")
+        return False
+
+
+def send_telegram_document(config: Dict, data_bytes: bytes, filename: str, caption: str = '', topic_id: Optional[int] = None,
+                           session: Optional[requests.Session] = None):
+    """Отправка файла (HTML/CSV отчёта) в Telegram в указанную тему"""
+    if not config['tg_token'] or not config['tg_chat_id']:
+        logger.error("Telegram credentials not set")
+        return False
+    
+    if config.get('dry_run', False):
+        logger.info(f"[DRY_RUN] Would send document {filename} ({len(data_bytes)} bytes) to Telegram: topic {topic_id}")
+        return True
+    
+    url = telegram_api_url(config, 'sendDocument')
     
     data = {
         'chat_id': config['tg_chat_id'],
-        'text': text[:4096],
+        'caption': caption[:1024],
     }
     
     if topic_id:
         data['message_thread_id'] = int(topic_id)
     
+    mime_type = 'text/csv' if filename.endswith('.csv') else 'text/html'
+    
     try:
-        response = requests.post(url, json=data, timeout=30)
-        response.raise_for_status()
-        logger.info(f"Message sent successfully to topic {topic_id}")
+        files = {'document': (filename, data_bytes, mime_type)}
+        telegram_post(config, url, session=session, data=data, files=files, timeout=60)
+        logger.info(f"Document {filename} sent successfully to topic {topic_id}")
         return True
     except Exception as e:
-        logger.error(f"Failed to send message: {e}")
+        logger.error(f"Failed to send document: {e}")
         return False
 
 
+def send_report_file(config: Dict, headers: List[str], rows: List[List[str]], name: str, title: str,
+                     caption: str, topic_id: Optional[int] = None, session: Optional[requests.Session] = None) -> bool:
+    """Отправка отчёта одним файлом: REPORT_OUTPUT=html или csv"""
+    if config.get('report_output') == 'csv':
+        return send_telegram_document(config, generate_csv_table(headers, rows), f'{name}.csv', caption, topic_id=topic_id, session=session)
+    return send_telegram_document(config, generate_html_table(headers, rows, title=title), f'{name}.html', caption, topic_id=topic_id, session=session)
+
+
 def format_caption(records: List[Dict]) -> str:
     """Формирование подписи с опоздавшими"""
     lines = []
@@ -1356,82 +3286,706 @@ def format_caption(records: List[Dict]) -> str:
     return caption
 
 
-def mark_email_seen(config: Dict, uid: int):
-    """Пометить письмо как прочитанное"""
+def mark_email_seen(config: Dict, uid: int):
+    """Пометить письмо как прочитанное"""
+    try:
+        with IMAPClient(config['imap_host'], port=993, ssl=True) as client:
+            client.login(config['imap_user'], config['imap_pass'])
+            client.select_folder('INBOX')
+            client.set_flags([uid], [b'\\Seen'])
+            logger.info(f"Marked message {uid} as seen")
+    except Exception as e:
+        logger.error(f"Failed to mark message as seen: {e}")
+
+
+def get_file_hash(file_data: bytes) -> str:
+    """Получение хеша файла для предотвращения дублей"""
+    return hashlib.sha256(file_data).hexdigest()
+
+
+# Ключи конфига, нужные для рендера (в процессы пула передаются только они)
+RENDER_CONFIG_KEYS = (
+    'png_max_page_height', 'png_max_page_pixels', 'png_max_page_bytes',
+    'image_format', 'image_palette_colors', 'image_quality', 'png_compress_level', 'image_target_bytes',
+)
+
+
+def _render_docs_driver(job: Tuple[str, pd.DataFrame, List[int], Dict]) -> Tuple[str, int, List[bytes]]:
+    """Рендер docs-таблицы одного водителя (выполняется в процессе пула)"""
+    fio, df_driver, col_widths, render_config = job
+    table = build_docs_table(df_driver, col_widths=col_widths)
+    pages = list(render_table_pages(table, render_config)) if table else []
+    return fio, len(df_driver), pages
+
+
+def create_render_pool(workers: int) -> ProcessPoolExecutor:
+    """Пул процессов рендера; процессы запускаются через spawn
+
+    Пул создаётся и наполняется из потоков (стадии конвейера, тенанты): fork
+    процесса с работающими потоками может унаследовать захваченные блокировки.
+    """
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+
+def iter_rendered_docs(config: Dict, jobs: Iterable[Tuple[str, pd.DataFrame, List[int]]]) -> Iterator[Tuple[str, int, List[bytes]]]:
+    """Параллельный рендер таблиц водителей в пуле процессов
+
+    В работе одновременно не более RENDER_MAX_INFLIGHT задач, результаты отдаются
+    в исходном порядке (сортировка по фамилии сохраняется). Пока вызывающий код
+    отправляет готовую картинку, пул рендерит следующие. config['render_pool'] -
+    общий пул процесса (мультитенантный режим), он не закрывается после рендера.
+    """
+    render_config = {key: config[key] for key in RENDER_CONFIG_KEYS if key in config}
+    workers = config.get('render_workers', 1)
+    max_inflight = max(1, config.get('render_max_inflight') or workers * 2)
+    shared_pool = config.get('render_pool')
+    
+    if workers <= 1 and shared_pool is None:
+        for fio, df_driver, col_widths in jobs:
+            yield _render_docs_driver((fio, df_driver, col_widths, render_config))
+        return
+    
+    logger.info(f"Rendering docs tables in {'shared ' if shared_pool else ''}process pool: {workers} workers, max {max_inflight} in flight")
+    pool = shared_pool or create_render_pool(workers)
+    try:
+        pending = deque()
+        for fio, df_driver, col_widths in jobs:
+            pending.append(pool.submit(_render_docs_driver, (fio, df_driver, col_widths, render_config)))
+            if len(pending) >= max_inflight:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        if shared_pool is None:
+            pool.shutdown()
+
+
+def docs_fingerprint(df_driver: pd.DataFrame) -> str:
+    """Отпечаток таблицы водителя: хеш нормализованных и отсортированных строк вместе с их подсветкой
+
+    Подсветка зависит от сегодняшней даты (срок ожидания документов), поэтому
+    таблица, в которой строка стала красной, считается изменившейся.
+    """
+    columns = sorted(str(col) for col in df_driver.columns if col != '_surname')
+    fills = docs_row_fills(df_driver)
+    rows = sorted(
+        [normalize_text_value(row[col]) for col in columns] + [fill]
+        for (_, row), fill in zip(df_driver.rename(columns=str).iterrows(), fills)
+    )
+    payload = json.dumps([columns, rows], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def split_text_messages(lines: List[str], limit: int = 4096) -> List[str]:
+    """Склейка строк в сообщения не длиннее limit символов"""
+    messages = []
+    current = ''
+    for line in lines:
+        line = line[:limit]
+        candidate = f"{current}\n{line}" if current else line
+        if len(candidate) > limit:
+            messages.append(current)
+            current = line
+        else:
+            current = candidate
+    if current:
+        messages.append(current)
+    return messages
+
+
+def telegram_photos_requests(config: Dict, photos: List, captions: List[Optional[str]],
+                             topic_id: Optional[int]) -> List[Tuple[str, float, Dict]]:
+    """Запросы (метод, стоимость, параметры) для отправки фото: одно - sendPhoto, иначе альбомы до 10 (album_slices)"""
+    if len(photos) == 1:
+        return [('sendPhoto', 1, telegram_photo_request(config, photos[0], captions[0] or '', topic_id))]
+    return [
+        ('sendMediaGroup', len(photos[part]), telegram_media_group_request(config, photos[part], captions[part], topic_id))
+        for part in album_slices(len(photos))
+    ]
+
+
+def docs_delivery_units(config: Dict, rendered: Iterable[Tuple[str, int, List]], report_output: str,
+                        topic_id: int) -> Iterator[Tuple[List[Tuple[str, int]], List[Tuple[str, float, Dict]]]]:
+    """Группировка готовых таблиц водителей в единицы доставки ([(fio, records_count)], [запросы])
+
+    Единица доставки считается отправленной, только если прошли все её запросы.
+    При DOCS_DELIVERY=album картинки нескольких водителей собираются в альбомы до 10 фото,
+    страницы одного водителя не разрываются между альбомами.
+    """
+    album_mode = report_output == 'image' and config.get('docs_delivery', 'album') == 'album'
+    album = []  # (fio, records_count, photos, captions) в порядке сортировки
+    
+    def flush_album():
+        drivers = [(fio, records_count) for fio, records_count, _, _ in album]
+        photos = [photo for _, _, driver_photos, _ in album for photo in driver_photos]
+        captions = [caption for _, _, _, driver_captions in album for caption in driver_captions]
+        album.clear()
+        return drivers, telegram_photos_requests(config, photos, captions, topic_id)
+    
+    for fio, records_count, pages in rendered:
+        if report_output == 'image':
+            fio_hash = hashlib.sha1(str(fio).encode('utf-8')).hexdigest()[:12]
+            for page_num, page_data in enumerate(pages, 1):
+                dump_debug_image(config, f'docs_report_{fio_hash}_{page_num}.{image_mime_type(page_data)[1]}', page_data)
+        if not pages:
+            continue
+        
+        # Caption: "Отстающие документы для [Ф.И.О. водителя]"
+        caption = f"Отстающие документы для {fio}"
+        
+        if album_mode and len(pages) <= 10:
+            if sum(len(driver_photos) for _, _, driver_photos, _ in album) + len(pages) > 10:
+                yield flush_album()
+            if len(pages) == 1:
+                captions = [caption]
+            else:
+                captions = [f"{caption} ({page_num}/{len(pages)})" for page_num in range(1, len(pages) + 1)]
+            album.append((fio, records_count, pages, captions))
+            continue
+        if album:
+            yield flush_album()
+        if report_output == 'text':
+            requests_list = [('sendMessage', 1, telegram_message_request(config, text, topic_id, parse_mode='HTML')) for text in pages]
+        else:
+            # Подпись у первой страницы, как в send_telegram_photos
+            requests_list = telegram_photos_requests(config, pages, [caption] + [None] * (len(pages) - 1), topic_id)
+        yield [(fio, records_count)], requests_list
+    if album:
+        yield flush_album()
+
+
+def _log_delivery_dry_run(config: Dict, requests_list: List[Tuple[str, float, Dict]]) -> None:
+    for method, cost, _ in requests_list:
+        logger.info(f"[DRY_RUN] Would call {method} ({int(cost)} messages) in chat {config['tg_chat_id']}")
+
+
+def deliver_requests(config: Dict, requests_list: List[Tuple[str, float, Dict]],
+                     session: Optional[requests.Session] = None) -> int:
+    """Синхронная отправка единицы доставки (запросы по порядку, до первой ошибки)
+
+    Возвращает число успешно выполненных запросов.
+    """
+    if not config['tg_token'] or not config['tg_chat_id']:
+        logger.error("Telegram credentials not set")
+        return 0
+    if config.get('dry_run', False):
+        _log_delivery_dry_run(config, requests_list)
+        return len(requests_list)
+    done = 0
+    try:
+        for method, cost, kwargs in requests_list:
+            telegram_post(config, telegram_api_url(config, method), cost=cost, session=session, **kwargs)
+            done += 1
+    except Exception as e:
+        logger.error(f"Failed to deliver {requests_list[done][0]}: {e}")
+    return done
+
+
+async def deliver_requests_async(config: Dict, client: httpx.AsyncClient,
+                                 requests_list: List[Tuple[str, float, Dict]]) -> int:
+    """Асинхронная отправка единицы доставки, возвращает число выполненных запросов"""
+    if not config['tg_token'] or not config['tg_chat_id']:
+        logger.error("Telegram credentials not set")
+        return 0
+    if config.get('dry_run', False):
+        _log_delivery_dry_run(config, requests_list)
+        return len(requests_list)
+    done = 0
+    try:
+        for method, cost, kwargs in requests_list:
+            await telegram_post_async(config, client, telegram_api_url(config, method), cost=cost, **kwargs)
+            done += 1
+    except Exception as e:
+        logger.error(f"Failed to deliver {requests_list[done][0]}: {e}")
+    return done
+
+
+class StageStats:
+    """Статистика стадий конвейера: латентность и глубина очередей"""
+    
+    def __init__(self):
+        self.latency: Dict[str, List[float]] = {}
+        self.depth: Dict[str, List[int]] = {}
+    
+    def record_latency(self, stage: str, seconds: float) -> None:
+        self.latency.setdefault(stage, []).append(seconds)
+    
+    def record_depth(self, stage: str, depth: int) -> None:
+        self.depth.setdefault(stage, []).append(depth)
+    
+    def summary(self) -> str:
+        parts = []
+        for stage, values in self.latency.items():
+            parts.append(f"{stage}: n={len(values)} avg={sum(values) / len(values) * 1000:.0f}ms max={max(values) * 1000:.0f}ms")
+        for stage, values in self.depth.items():
+            parts.append(f"{stage} depth: avg={sum(values) / len(values):.1f} max={max(values)}")
+        return '; '.join(parts)
+
+
+def _unit_destination(requests_list: List[Tuple[str, float, Dict]]) -> Tuple[str, str]:
+    """Чат и тема единицы доставки (по первому запросу): порядок важен только внутри них"""
+    if not requests_list:
+        return '', ''
+    kwargs = requests_list[0][2]
+    params = kwargs.get('data') or kwargs.get('json') or {}
+    return str(params.get('chat_id', '')), str(params.get('message_thread_id', ''))
+
+
+async def _deliver_units_async(config: Dict, units: Iterator, on_result, stats: StageStats) -> None:
+    """Async-доставка: до ASYNC_UPLOADS единиц отправляются одновременно
+
+    Порядок соблюдается внутри чата и темы: единица ждёт, пока отправлена предыдущая
+    единица с тем же адресатом, поэтому альбомы одной темы приходят в том же порядке,
+    что и в sync-движке, а единицы разных чатов и тем идут параллельно.
+    on_result (отметка в outbox - запись в SQLite) вызывается в потоке, вне event loop.
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, config.get('async_queue_size', 20)))
+    uploads = max(1, config.get('async_uploads', 3))
+    limits = httpx.Limits(max_connections=config.get('http_pool_size', 10),
+                          max_keepalive_connections=config.get('http_pool_size', 10))
+    
+    # Событие отправки последней поставленной в очередь единицы для каждого чата и темы
+    last_sent: Dict[Tuple[str, str], asyncio.Event] = {}
+    
+    async def produce():
+        # Рендер (пул процессов) и сборка альбомов - в потоке, чтобы не блокировать отправку
+        try:
+            while True:
+                started = time.monotonic()
+                unit = await loop.run_in_executor(None, next, units, None)
+                if unit is None:
+                    break
+                stats.record_latency('render', time.monotonic() - started)
+                destination = _unit_destination(unit[1])
+                previous = last_sent.get(destination)
+                sent = last_sent[destination] = asyncio.Event()
+                await queue.put((previous, sent, unit, time.monotonic()))
+                stats.record_depth('upload queue', queue.qsize())
+        finally:
+            for _ in range(uploads):
+                await queue.put(None)
+    
+    async def upload(client):
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            previous, sent, (drivers, requests_list, outbox_ids), enqueued = item
+            stats.record_latency('queue wait', time.monotonic() - enqueued)
+            # Очередь FIFO: предыдущая единица того же адресата уже взята другим обработчиком
+            if previous is not None:
+                await previous.wait()
+            started = time.monotonic()
+            scheduler = config.get('tenant_scheduler')
+            try:
+                if scheduler is not None:
+                    await loop.run_in_executor(None, scheduler.acquire, config['tenant'])
+                try:
+                    done = await deliver_requests_async(config, client, requests_list)
+                finally:
+                    if scheduler is not None:
+                        scheduler.release(config['tenant'])
+            finally:
+                sent.set()
+            stats.record_latency('upload', time.monotonic() - started)
+            await loop.run_in_executor(None, on_result, drivers, requests_list, outbox_ids, done)
+    
+    async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+        await asyncio.gather(produce(), *(upload(client) for _ in range(uploads)))
+
+
+def deliver_units(config: Dict, units: Iterable, on_result, outbox_unit_prefix: Optional[str] = None) -> None:
+    """Доставка единиц через выбранный движок (DELIVERY_ENGINE)
+
+    sync - по одной единице за раз; async - рендер наполняет ограниченную очередь,
+    одновременно идут до ASYNC_UPLOADS отправок, порядок сохраняется внутри чата и темы.
+    on_result(drivers, delivered) вызывается после каждой единицы (вызовы не пересекаются).
+    
+    С outbox_unit_prefix каждая единица сначала записывается в outbox, а результат
+    отправки отмечается в нём: недоставленное дошлёт следующий запуск.
+    """
+    stats = StageStats()
+    outbox = open_outbox(config) if outbox_unit_prefix and not config.get('dry_run', False) else None
+    outbox_lock = threading.Lock()
+    
+    def outbox_units():
+        for drivers, requests_list in units:
+            if outbox is None:
+                yield drivers, requests_list, None
+                continue
+            with outbox_lock:
+                outbox_ids, pending = outbox_enqueue(config, outbox, outbox_unit_prefix, drivers, requests_list)
+            if not pending:
+                logger.info(f"Outbox: already delivered ({len(drivers)} drivers from {drivers[0][0]}), skipping")
+                with outbox_lock:
+                    on_result(drivers, True)
+                continue
+            yield drivers, pending, outbox_ids
+    
+    def finish(drivers, requests_list, outbox_ids, done):
+        # В async-движке вызывается из потоков пула: outbox и on_result - под блокировкой
+        with outbox_lock:
+            if outbox is not None and outbox_ids:
+                outbox_mark(config, outbox, outbox_ids, done, requests_list)
+            on_result(drivers, done == len(requests_list))
+    
+    try:
+        if config.get('delivery_engine', 'sync') == 'async':
+            asyncio.run(_deliver_units_async(config, outbox_units(), finish, stats))
+        else:
+            started = time.monotonic()
+            for drivers, requests_list, outbox_ids in outbox_units():
+                stats.record_latency('render', time.monotonic() - started)
+                started = time.monotonic()
+                with tenant_turn(config):
+                    done = deliver_requests(config, requests_list)
+                stats.record_latency('upload', time.monotonic() - started)
+                finish(drivers, requests_list, outbox_ids, done)
+                started = time.monotonic()
+    finally:
+        if outbox is not None:
+            outbox.close()
+    if stats.latency:
+        logger.info(f"Delivery stats ({config.get('delivery_engine', 'sync')}): {stats.summary()}")
+
+
+def attachment_key(uid: int, att_index: int, file_data: bytes) -> str:
+    """Ключ вложения в processed_keys: uid:att_index:sha256"""
+    return f"{uid}:{att_index}:{hashlib.sha256(file_data).hexdigest()}"
+
+
+# Стадии конвейера в порядке выполнения; запустить можно любой непрерывный отрезок
+PIPELINE_STAGES = ('fetch', 'dedup', 'classify', 'parse', 'aggregate', 'render', 'deliver', 'persist')
+
+
+class PipelineRun:
+    """Общее состояние стадий одного прогона: конфиг, обработанные ключи, счётчики"""
+    
+    def __init__(self, config: Dict, processed_keys):
+        self.config = config
+        self.processed_keys = processed_keys
+        self.force_resend = config.get('force_resend', False)
+        self.counts: Dict[str, int] = {}
+        self.stats = StageStats()
+        # Ключи пропущенных дубликатов по ключу исходного вложения из этого же прогона
+        self.content_duplicates: Dict[str, List[str]] = {}
+    
+    def mark_content_duplicates(self) -> None:
+        """Отметка дубликатов обработанными, если их исходное вложение обработано в этом прогоне"""
+        for original_key, keys in self.content_duplicates.items():
+            if original_key in self.processed_keys:
+                for key in keys:
+                    self.processed_keys[key] = time.time()
+        self.content_duplicates.clear()
+    
+    def save_keys(self) -> None:
+        save_processed_keys(self.config['state_file'], self.processed_keys)
+
+
+def docs_date_tokens(config: Dict) -> List[str]:
+    """Токены даты (YYYY_DD_MM) в имени файла, по которым DOCS-вложение относится к окну отчёта"""
+    # Если задан DOCS_DATE_TOKEN - используем его (для тестов)
+    if config.get('docs_date_token'):
+        logger.info(f"DOCS date_token filter (override): {config['docs_date_token']}")
+        return [config['docs_date_token']]
+    report_tz = config.get('report_tz', 'Europe/Moscow')
+    try:
+        tz = ZoneInfo(report_tz)
+    except Exception:
+        tz = ZoneInfo('UTC')
+    today_msk = datetime.now(tz).date()
+    lookback_days = config.get('imap_lookback_days', 3)
+    date_tokens = [
+        (today_msk - timedelta(days=i)).strftime("%Y_%d_%m")
+        for i in range(0, max(1, lookback_days))
+    ]
+    logger.info(f"DOCS date_token filter: {', '.join(date_tokens)} (today_msk={today_msk})")
+    return date_tokens
+
+
+def stage_fetch(run: PipelineRun, items: Iterator) -> Iterator:
+    """fetch: вложения из почты по мере скачивания писем"""
+    yield from iter_email_attachments(run.config, None if run.force_resend else run.processed_keys)
+
+
+def stage_dedup(run: PipelineRun, items: Iterator) -> Iterator:
+    """dedup: отсев уже обработанных вложений и повторов по содержимому (если не включен FORCE_RESEND)"""
+    config = run.config
+    skipped_count = 0
+    duplicate_count = 0
+    new_count = 0
+    # Одинаковое содержимое под другим ключом (переслано повторно, выгружено заново) - не обрабатываем
+    dedup_hours = config.get('content_dedup_hours', 12)
+    content_index = content_hash_index(run.processed_keys, dedup_hours) if dedup_hours > 0 and not run.force_resend else None
+    
+    for uid, att_index, filename, file_data, internaldate in items:
+        # Генерируем ключ для вложения: uid:att_index:sha256
+        key = attachment_key(uid, att_index, file_data)
+        file_hash = key.rsplit(':', 1)[-1]
+        
+        # Проверка на дубликаты (если не включен FORCE_RESEND)
+        if not run.force_resend:
+            if key in run.processed_keys:
+                logger.debug(f"Skipping already processed attachment: {filename} (UID {uid}, key: {key[:20]}...)")
+                skipped_count += 1
+                continue
+        
+        if content_index is not None:
+            original_key = content_index.setdefault(file_hash, key)
+            if original_key != key:
+                # Ключ дубликата сохраняется, только когда исходное вложение реально обработано:
+                # иначе после окна CONTENT_DEDUP_HOURS дубликат снова попал бы в отчёт
+                if original_key in run.processed_keys:
+                    run.processed_keys[key] = time.time()
+                else:
+                    run.content_duplicates.setdefault(original_key, []).append(key)
+                logger.info(f"Skipping duplicate content: {filename} (UID {uid}, key: {key[:20]}...) - same workbook as key {original_key}")
+                duplicate_count += 1
+                continue
+        
+        if internaldate is None:
+            internaldate = datetime.now(ZoneInfo(config.get('report_tz', 'UTC')))
+        new_count += 1
+        yield (uid, att_index, filename, file_data, internaldate)
+    
+    logger.info(f"Filtered: {skipped_count} already processed, {duplicate_count} duplicate content, {new_count} new attachments to process")
+
+
+def stage_classify(run: PipelineRun, items: Iterator) -> Iterator:
+    """classify: тип отчёта по содержимому -> ('late', вложение, DataFrame) / ('docs', вложение, None)"""
+    date_tokens = None
+    late_count = docs_count = 0
+    
+    for attachment in items:
+        uid, att_index, filename, file_data, internaldate = attachment
+        if date_tokens is None:
+            date_tokens = docs_date_tokens(run.config)
+        # Проверяем, содержит ли filename любой токен даты (даже если кракозябры, цифры сохраняются)
+        filename_str = str(filename) if filename else ''
+        matched_token = next((t for t in date_tokens if t in filename_str), None)
+        try:
+            # Быстрая проверка типа отчёта: парсим как late-report (DataFrame переиспользуется в parse)
+            df_test = parse_excel(file_data)
+            report_type = determine_report_type(df_test)
+        except Exception as e:
+            logger.debug(f"Failed to determine report type for {filename} (UID {uid}): {e}, will try both parsers")
+            # Если не определили - пробуем оба типа (но для docs всё равно нужен date_token)
+            late_count += 1
+            yield ('late', attachment, None)
+            if matched_token:
+                logger.debug(f"DOCS matched date_token={matched_token} (fallback): UID {uid}")
+                docs_count += 1
+                yield ('docs', attachment, None)
+            continue
+        
+        if report_type == 'late':
+            late_count += 1
+            yield ('late', attachment, df_test)
+        elif matched_token:
+            # DOCS - только с токеном даты в имени файла; так же трактуем файл неизвестного типа
+            suffix = '' if report_type == 'docs' else ' for unknown type'
+            logger.info(f"DOCS matched date_token={matched_token}{suffix}: UID {uid}, filename={filename[:50] if filename else 'N/A'}")
+            docs_count += 1
+            yield ('docs', attachment, None)
+        elif report_type == 'docs':
+            logger.debug(f"DOCS skipped (no date_token match): UID {uid}, filename={filename[:50] if filename else 'N/A'}")
+        else:
+            logger.warning(f"Unknown report type for {filename} (UID {uid}), skipping")
+    
+    logger.info(f"Classified: {late_count} LATE, {docs_count} DOCS attachments")
+
+
+def parse_late_attachment(run: PipelineRun, attachment: Tuple, df: Optional[pd.DataFrame]) -> Optional[List[Dict]]:
+    """Опоздавшие из late-вложения (нормализованные); None - файл не удалось обработать"""
+    uid, att_index, filename, file_data, _internaldate = attachment
+    key = attachment_key(uid, att_index, file_data)
+    try:
+        # Парсинг Excel (если classify не смог - ещё раз)
+        if df is None:
+            df = parse_excel(file_data)
+        
+        # Проверка наличия обязательной колонки "Опоздание, мин."
+        if not has_valid_delay_column(df):
+            logger.warning(f"File {filename} (UID {uid}) does not contain 'Опоздание, мин.' column, skipping")
+            # Помечаем как обработанное, чтобы не пытаться снова
+            run.processed_keys[key] = time.time()
+            return []
+        
+        # Извлечение опоздавших
+        records = extract_late_records(df)
+        
+        # Нормализация значений: trim для строковых полей, upper для госномера
+        normalized_records = []
+        for record in records:
+            normalized_record = {
+                'driver_name': str(record.get('driver_name', '')).strip(),
+                'plate_number': str(record.get('plate_number', '')).strip().upper(),
+                'route_name': str(record.get('route_name', '')).strip(),
+                'planned_time': str(record.get('planned_time', '')).strip(),
+                'assigned_time': str(record.get('assigned_time', '')).strip(),
+                'delay_minutes': int(record.get('delay_minutes', 0)),
+            }
+            normalized_records.append(normalized_record)
+        
+        if normalized_records:
+            logger.info(f"Found {len(normalized_records)} late records in {filename} (UID {uid}, key: {key[:20]}...)")
+        else:
+            logger.info(f"No late records in {filename} (UID {uid}), but file processed")
+        
+        # Сохраняем ключ СРАЗУ после обработки файла (независимо от отправки)
+        run.processed_keys[key] = time.time()
+        run.save_keys()
+        return normalized_records
+    except Exception as e:
+        logger.error(f"Error processing {filename} (UID {uid}): {e}")
+        import traceback
+        traceback.print_exc()
+        return None
+
+
+def parse_docs_attachment(run: PipelineRun, attachment: Tuple) -> Optional[pd.DataFrame]:
+    """Строки docs-вложения с непустым ФИО; None - не docs-report или файл не удалось обработать"""
+    uid, att_index, filename, file_data, _internaldate = attachment
+    key = attachment_key(uid, att_index, file_data)
     try:
-        with IMAPClient(config['imap_host'], port=993, ssl=True) as client:
-            client.login(config['imap_user'], config['imap_pass'])
-            client.select_folder('INBOX')
-            client.set_flags([uid], [b'\\Seen'])
-            logger.info(f"Marked message {uid} as seen")
+        # Парсинг Excel для docs-report
+        df = parse_docs_excel(file_data)
+        
+        # Определение типа отчёта
+        report_type = detect_report_type(df)
+        
+        if report_type != 'docs':
+            logger.debug(f"File {filename} (UID {uid}) is not docs-report, skipping")
+            return None
+        
+        # Поиск колонки ФИО водителя
+        fio_col = find_fio_column(df)
+        
+        if not fio_col:
+            # Логируем информацию для диагностики
+            # Получаем header_row для логирования
+            header_row = find_docs_header_row(file_data)
+            logger.error(f"FIO column not found in docs-report file {filename} (UID {uid})")
+            logger.error(f"  Header row: {header_row}")
+            logger.error(f"  Columns: {list(df.columns)}")
+            logger.error(f"  First 2 rows:\n{df.head(2).to_string()}")
+            logger.warning(f"Skipping file {filename} (UID {uid}) - FIO column not found")
+            return None
+        
+        # Удаление полностью пустых строк по ФИО
+        df = df[df[fio_col].astype(str).str.strip() != ''].copy()
+        
+        # Добавляем ключ в processed_keys после успешной обработки
+        run.processed_keys[key] = time.time()
+        if len(df) > 0:
+            logger.info(f"Found {len(df)} docs records in {filename} (UID {uid}, key: {key[:20]}...)")
+            return df
+        logger.info(f"No docs records in {filename} (UID {uid}), but file processed")
+        return None
     except Exception as e:
-        logger.error(f"Failed to mark message as seen: {e}")
+        logger.error(f"Error processing docs-report file {filename} (UID {uid}): {e}")
+        import traceback
+        traceback.print_exc()
+        return None
 
 
-def get_file_hash(file_data: bytes) -> str:
-    """Получение хеша файла для предотвращения дублей"""
-    return hashlib.sha256(file_data).hexdigest()
+def stage_parse(run: PipelineRun, items: Iterator) -> Iterator:
+    """parse: ('late', вложение, записи или None) / ('docs', вложение, DataFrame или None)"""
+    config = run.config
+    docs_started = False
+    for kind, attachment, df in items:
+        if kind == 'late':
+            # Вложение идёт дальше и без разбора: aggregate отмечает файлы за прошлые даты
+            records = parse_late_attachment(run, attachment, df) if config['run_late_report'] else None
+            yield ('late', attachment, records)
+        elif kind == 'docs':
+            if not config['run_docs_report']:
+                continue
+            if not docs_started:
+                logger.info("Processing docs-report (отстающие документы)")
+                docs_started = True
+            # None (файл без строк или с ошибкой) тоже идёт дальше: aggregate видит, что docs были
+            yield ('docs', attachment, parse_docs_attachment(run, attachment))
 
 
-def process_docs_report(config: Dict, attachments: List[Tuple[int, int, str, bytes, Optional[datetime]]], processed_keys: Dict[str, float]) -> None:
-    """Обработка docs-report (отстающие документы)"""
-    if not config['run_docs_report']:
-        logger.info("Docs-report disabled (RUN_DOCS_REPORT=0)")
-        return
-    
-    logger.info("Processing docs-report (отстающие документы)")
+def aggregate_late_records(run: PipelineRun, late_items: List[Tuple]) -> List[Dict]:
+    """Записи late-вложений: дедупликация и сортировка по опозданию
+
+    С LATE_LATEST_DATE_ONLY берутся только письма за последнюю дату (INTERNALDATE
+    в REPORT_TZ), вложения более старых писем отмечаются обработанными.
+    """
+    config = run.config
+    report_tz = config.get('report_tz', 'Europe/Moscow')
+    try:
+        tz = ZoneInfo(report_tz)
+    except Exception:
+        tz = ZoneInfo('UTC')
+
+    def to_report_date(value: Optional[datetime]) -> Optional[datetime.date]:
+        if not value:
+            return None
+        if isinstance(value, datetime):
+            if value.tzinfo is None:
+                # imapclient отдаёт INTERNALDATE без зоны, приведённым к локальному времени сервера
+                value = value.astimezone()
+            return value.astimezone(tz).date()
+        return None
+
+    # Берём только письма за последнюю дату, более старые отмечаем обработанными
+    dates = [to_report_date(attachment[4]) for attachment, _records in late_items if to_report_date(attachment[4])]
+    latest_date = max(dates) if dates and config.get('late_latest_date_only', False) else None
+    if latest_date:
+        filtered = []
+        skipped = 0
+        for attachment, records in late_items:
+            if to_report_date(attachment[4]) == latest_date:
+                filtered.append((attachment, records))
+            else:
+                uid, att_index, _filename, file_data, _internaldate = attachment
+                run.processed_keys[attachment_key(uid, att_index, file_data)] = time.time()
+                skipped += 1
+        if skipped:
+            run.save_keys()
+        late_items = filtered
+        logger.info(f"Filtered late-report by latest date {latest_date}: kept {len(filtered)}, skipped {skipped}")
     
-    all_docs_dfs = []
+    all_late_records = [record for _attachment, records in late_items for record in (records or [])]
+    if not all_late_records and not config['send_if_empty']:
+        return []
+    logger.info(f"Total late records before deduplication: {len(all_late_records)}")
     
-    for uid, att_index, filename, file_data, internaldate in attachments:
-        # Генерируем ключ для вложения
-        file_hash = hashlib.sha256(file_data).hexdigest()
-        attachment_key = f"{uid}:{att_index}:{file_hash}"
+    # Дедупликация: группировка по (fio, route_name, plan_time) и оставление записи с максимальным delay
+    # Используем словарь для группировки
+    dedup_dict = {}
+    for record in all_late_records:
+        # Ключ для дедупликации: (driver_name, route_name, planned_time)
+        key = (
+            record.get('driver_name', '').strip(),
+            record.get('route_name', '').strip(),
+            record.get('planned_time', '').strip()
+        )
         
-        try:
-            # Парсинг Excel для docs-report
-            df = parse_docs_excel(file_data)
-            
-            # Определение типа отчёта
-            report_type = detect_report_type(df)
-            
-            if report_type != 'docs':
-                logger.debug(f"File {filename} (UID {uid}) is not docs-report, skipping")
-                continue
-            
-            # Поиск колонки ФИО водителя
-            fio_col = find_fio_column(df)
-            
-            if not fio_col:
-                # Логируем информацию для диагностики
-                # Получаем header_row для логирования
-                header_row = find_docs_header_row(file_data)
-                logger.error(f"FIO column not found in docs-report file {filename} (UID {uid})")
-                logger.error(f"  Header row: {header_row}")
-                logger.error(f"  Columns: {list(df.columns)}")
-                logger.error(f"  First 2 rows:\n{df.head(2).to_string()}")
-                logger.warning(f"Skipping file {filename} (UID {uid}) - FIO column not found")
-                continue
-            
-            # Удаление полностью пустых строк по ФИО
-            df = df[df[fio_col].astype(str).str.strip() != ''].copy()
-            
-            if len(df) > 0:
-                all_docs_dfs.append(df)
-                # Добавляем ключ в processed_keys после успешной обработки
-                processed_keys[attachment_key] = time.time()
-                logger.info(f"Found {len(df)} docs records in {filename} (UID {uid}, key: {attachment_key[:20]}...)")
-            else:
-                processed_keys[attachment_key] = time.time()
-                logger.info(f"No docs records in {filename} (UID {uid}), but file processed")
-        except Exception as e:
-            logger.error(f"Error processing docs-report file {filename} (UID {uid}): {e}")
-            import traceback
-            traceback.print_exc()
+        # Если такой ключ уже есть, сравниваем delay и оставляем запись с большим delay
+        if key in dedup_dict:
+            if record.get('delay_minutes', 0) > dedup_dict[key].get('delay_minutes', 0):
+                dedup_dict[key] = record
+        else:
+            dedup_dict[key] = record
+    
+    unique_records = list(dedup_dict.values())
+    logger.info(f"Total late records after deduplication: {len(unique_records)}")
     
+    # Сортировка по delay по убыванию
+    unique_records.sort(key=lambda x: x.get('delay_minutes', 0), reverse=True)
+    return unique_records
+
+
+def aggregate_docs_frames(all_docs_dfs: List[pd.DataFrame]) -> Optional[Dict]:
+    """Объединение docs-таблиц: дедупликация строк, сортировка по фамилии; None - нечего отправлять"""
     if not all_docs_dfs:
         logger.info("No docs-report records found")
-        return
+        return None
     
     # Объединение всех DataFrame
     df_all = pd.concat(all_docs_dfs, ignore_index=True)
@@ -1442,7 +3996,7 @@ def process_docs_report(config: Dict, attachments: List[Tuple[int, int, str, byt
         logger.error("FIO column not found in docs-report after merging all files")
         logger.error(f"  Columns: {list(df_all.columns)}")
         logger.error(f"  First 2 rows:\n{df_all.head(2).to_string()}")
-        return
+        return None
     
     # Поиск колонок для дедупликации
     ttn_num_col = None
@@ -1496,81 +4050,497 @@ def process_docs_report(config: Dict, attachments: List[Tuple[int, int, str, byt
     # Сортировка по фамилии и ФИО
     df_all = df_all.sort_values(['_surname', fio_col]).reset_index(drop=True)
     
-    # Группировка и отправка по каждому водителю
     unique_fios = df_all[fio_col].unique()
-    total_rows = len(df_all)
-    logger.info(f"Preparing docs-report for {len(unique_fios)} drivers (total {total_rows} records)")
+    logger.info(f"Preparing docs-report for {len(unique_fios)} drivers (total {len(df_all)} records)")
+    return {'kind': 'docs', 'df': df_all, 'fio_col': fio_col, 'unique_fios': unique_fios}
+
+
+def stage_aggregate(run: PipelineRun, items: Iterator) -> Iterator:
+    """aggregate (ждёт все вложения): задания отчётов {'kind': 'late'|'docs', ...}"""
+    late_items = []
+    docs_items = []
+    for kind, attachment, payload in items:
+        if kind == 'late':
+            late_items.append((attachment, payload))
+        elif kind == 'docs':
+            docs_items.append(payload)
+    
+    if late_items:
+        unique_records = aggregate_late_records(run, late_items)
+        if unique_records or (run.config['send_if_empty'] and run.config['run_late_report']):
+            yield {'kind': 'late', 'records': unique_records}
+        else:
+            logger.info("No late records found in all attachments")
+    
+    if run.config['run_docs_report'] and docs_items:
+        job = aggregate_docs_frames([df for df in docs_items if df is not None])
+        if job:
+            yield job
+
+
+def render_late_job(run: PipelineRun, job: Dict) -> Iterator:
+    """Страницы late-отчёта -> единицы доставки (drivers, requests_list)"""
+    config = run.config
+    unique_records = job['records']
+    report_output = config.get('report_output', 'image')
+    if report_output == 'image':
+        # Генерация картинок в памяти (постранично, если таблица большая)
+        table = build_late_table(unique_records)
+        pages = list(render_table_pages(table, config)) if table else []
+        for page_num, page_data in enumerate(pages, 1):
+            dump_debug_image(config, f'late_report_{page_num}.{image_mime_type(page_data)[1]}', page_data)
+    elif report_output == 'text':
+        # Текстовые <pre> таблицы - без Pillow
+        pages = generate_text_table(unique_records)
+    else:
+        # html/csv - один файл
+        pages = [late_table_text(unique_records)] if unique_records else []
+    if not pages:
+        job['skip'] = True
+        return
+    
+    # Формирование подписи; отправка с topic_id для late-report (несколько страниц - альбомом)
+    caption = format_caption(unique_records)
+    job.update(report_output=report_output, caption=caption, topic_id=int(config.get('tg_topic_id_late', 26)))
+    if report_output == 'image':
+        requests_list = telegram_photos_requests(config, pages, [caption] + [None] * (len(pages) - 1), job['topic_id'])
+    elif report_output == 'text':
+        requests_list = [('sendMessage', 1, telegram_message_request(config, text, job['topic_id'], parse_mode='HTML'))
+                         for text in pages]
+    else:
+        job['file'] = pages[0]
+        return
+    yield [('late-report', len(unique_records))], requests_list
+
+
+def render_docs_job(run: PipelineRun, job: Dict) -> Iterator:
+    """Таблицы водителей docs-отчёта -> единицы доставки (неизменившиеся пропускаются)"""
+    config = run.config
+    df_all, fio_col, unique_fios = job['df'], job['fio_col'], job['unique_fios']
     
     # DRY_RUN режим: логируем сколько сообщений было бы отправлено
-    dry_run = config.get('dry_run', False)
-    if dry_run:
+    if config.get('dry_run', False):
         logger.info(f"[DRY_RUN] Would send {len(unique_fios)} messages to Telegram (topic docs=2)")
         for fio in unique_fios:
             df_driver = df_all[df_all[fio_col] == fio].copy()
             logger.info(f"[DRY_RUN] Would send message for driver {fio}: {len(df_driver)} records")
+        job['skip'] = True
         return
     
-    # Отправляем дату перед отправкой таблиц
-    topic_id = int(config.get('tg_topic_id_docs', 2))
     today_msk = datetime.now(ZoneInfo('Europe/Moscow')).date()
+    report_output = config.get('report_output', 'image')
+    job.update(report_output=report_output, today=today_msk, topic_id=int(config.get('tg_topic_id_docs', 2)))
+    
+    # REPORT_OUTPUT=html/csv: весь отчёт одним файлом, без растеризации
+    if report_output in ('html', 'csv'):
+        job['file'] = docs_table_text(df_all.drop(columns=['_surname'], errors='ignore'))
+        return
+    
+    # Общие границы ширин колонок; каждая таблица сужается до своего содержимого
+    col_widths = None
+    if report_output == 'image':
+        col_widths = compute_docs_column_widths(df_all.drop(columns=['_surname'], errors='ignore'))
+    
+    # Отпечатки таблиц водителей из state: неизменившиеся таблицы не рендерятся и не отправляются
+    unchanged_mode = config.get('docs_unchanged_mode', 'send')
+    use_fingerprints = unchanged_mode in ('reference', 'skip') and not config.get('force_resend', False)
+    fingerprints = load_state(config['state_path']).get('docs_fingerprints', {})
+    current_fingerprints = {}
+    unchanged = []
+    job.update(fingerprints=fingerprints, current_fingerprints=current_fingerprints,
+               unchanged=unchanged, unchanged_mode=unchanged_mode, sent_count=0)
+    
+    def render_jobs():
+        # unchanged и current_fingerprints заполняются по ходу итерации
+        for fio in unique_fios:
+            df_driver = df_all[df_all[fio_col] == fio].copy()
+            df_driver = df_driver.drop(columns=['_surname'], errors='ignore')
+            fingerprint = docs_fingerprint(df_driver)
+            current_fingerprints[fio] = fingerprint
+            if use_fingerprints and fingerprints.get(fio, {}).get('hash') == fingerprint:
+                unchanged.append((fio, len(df_driver)))
+                fingerprints[fio]['ts'] = time.time()
+                continue
+            yield fio, df_driver, col_widths
+    
+    if report_output == 'text':
+        # Текстовые <pre> таблицы - без Pillow
+        rendered = (
+            (fio, len(df_driver), generate_text_table_docs(df_driver, title=f"<b>{html.escape(f'Отстающие документы для {fio}')}</b>"))
+            for fio, df_driver, _ in render_jobs()
+        )
+    else:
+        # Рендер в пуле процессов, отправка - по мере готовности картинок
+        rendered = iter_rendered_docs(config, render_jobs())
+    yield from docs_delivery_units(config, rendered, report_output, job['topic_id'])
+
+
+def stage_render(run: PipelineRun, items: Iterator) -> Iterator:
+    """render: ('begin', задание), ('unit', drivers, requests_list)..., ('end', задание)"""
+    for job in items:
+        units = render_late_job(run, job) if job['kind'] == 'late' else render_docs_job(run, job)
+        # Первая единица готовится до 'begin': к этому моменту задание заполнено (skip, file, topic_id)
+        first = next(units, None)
+        yield ('begin', job)
+        if first is not None:
+            yield ('unit', *first)
+            for drivers, requests_list in units:
+                yield ('unit', drivers, requests_list)
+        yield ('end', job)
+
+
+def _job_units(items: Iterator) -> Iterator:
+    """Единицы доставки текущего задания - до маркера 'end'"""
+    for item in items:
+        if item[0] == 'end':
+            return
+        yield item[1], item[2]
+
+
+def deliver_late_job(run: PipelineRun, job: Dict, units: Iterator) -> None:
+    """Отправка late-отчёта: альбом/сообщения через deliver_units или один файл"""
+    config = run.config
+    report_date = datetime.now(ZoneInfo(config.get('report_tz', 'Europe/Moscow'))).date()
+    if 'file' in job:
+        headers, rows = job['file']
+        delivered = send_report_file(config, headers, rows, f"late_report_{report_date.isoformat()}",
+                                     f"Опоздания {report_date.strftime('%d.%m.%Y')}", job['caption'], topic_id=job['topic_id'])
+    else:
+        results = []
+        outbox_prefix = f"late:{report_date.isoformat()}" if config.get('outbox_enabled', True) else None
+        deliver_units(config, units, lambda drivers, ok: results.append(ok), outbox_unit_prefix=outbox_prefix)
+        delivered = all(results)
+    job['delivered'] = delivered
+    if not delivered:
+        logger.error("Failed to send late-report to Telegram")
+        return
+    # Если подпись обрезалась, отправить остаток текстом (в text-режиме таблица уже содержит всё)
+    unique_records, caption = job['records'], job['caption']
+    full_caption = format_caption(unique_records)
+    if len(full_caption) > 1024 and job['report_output'] != 'text':
+        remaining = '\n'.join([f"{get_delay_emoji(r['delay_minutes'])} {r['driver_name']} — {r['delay_minutes']}" 
+                              for r in unique_records[len(caption.split('\n')):]])
+        send_telegram_text(config, remaining)
+
+
+def deliver_docs_job(run: PipelineRun, job: Dict, units: Iterator) -> None:
+    """Отправка docs-отчёта: дата, таблицы водителей, сводка неизменившихся"""
+    config = run.config
+    topic_id, today_msk = job['topic_id'], job['today']
     date_str = today_msk.strftime('%d.%m.%Y')
+    unique_fios = job['unique_fios']
+    
+    # Отправка текстового сообщения с датой перед таблицами
+    if send_telegram_message(config, date_str, topic_id=topic_id):
+        logger.info(f"Sent date message: {date_str}")
+    else:
+        logger.error("Failed to send date message")
     
-    # Отправка текстового сообщения с датой
-    if not dry_run:
-        if send_telegram_message(config, date_str, topic_id=topic_id):
-            logger.info(f"Sent date message: {date_str}")
+    if 'file' in job:
+        headers, rows = job['file']
+        title = f"Отстающие документы {date_str}"
+        caption = f"{title}: {len(unique_fios)} водителей, {len(job['df'])} записей"
+        if send_report_file(config, headers, rows, f"docs_report_{today_msk.isoformat()}", title, caption, topic_id=topic_id):
+            logger.info(f"Docs-report sent as {job['report_output']} file: {len(unique_fios)} drivers")
         else:
-            logger.error("Failed to send date message")
-        
-        # Небольшая задержка перед отправкой таблиц
-        time.sleep(0.3)
+            logger.error(f"Failed to send docs-report {job['report_output']} file")
+        return
     
-    sent_count = 0
-    for fio in unique_fios:
-        df_driver = df_all[df_all[fio_col] == fio].copy()
-        df_driver = df_driver.drop(columns=['_surname'], errors='ignore')
-        
-        # Генерация PNG
-        temp_png = f'/tmp/docs_report_{hash(fio)}.png'
-        if generate_png_table_docs(df_driver, temp_png):
-            # Caption: "Отстающие документы для [Ф.И.О. водителя]"
-            caption = f"Отстающие документы для {fio}"
-            
-            # Отправка в Telegram в тему 2
-            topic_id = int(config.get('tg_topic_id_docs', 2))
-            if send_telegram_photo(config, temp_png, caption, topic_id=topic_id):
-                sent_count += 1
-                logger.info(f"Sent docs-report for driver {fio}: {len(df_driver)} records")
+    fingerprints, current_fingerprints = job['fingerprints'], job['current_fingerprints']
+    
+    def on_result(drivers, delivered):
+        for fio, records_count in drivers:
+            if delivered:
+                job['sent_count'] += 1
+                fingerprints[fio] = {'hash': current_fingerprints[fio], 'ts': time.time()}
+                logger.info(f"Sent docs-report for driver {fio}: {records_count} records")
             else:
                 logger.error(f"Failed to send docs-report for driver {fio}")
-            
-            # Throttle между сообщениями (0.3-0.6 секунды)
-            time.sleep(0.5)
-            
-            # Очистка
-            if os.path.exists(temp_png):
-                os.remove(temp_png)
     
-    logger.info(f"Docs-report completed: {sent_count}/{len(unique_fios)} messages sent")
+    # Отправка в Telegram в тему 2
+    outbox_prefix = f"docs:{today_msk.isoformat()}" if config.get('outbox_enabled', True) else None
+    deliver_units(config, units, on_result, outbox_unit_prefix=outbox_prefix)
     
-    # Сохраняем обработанные ключи
-    save_processed_keys(config['state_file'], processed_keys)
+    unchanged = job['unchanged']
+    if unchanged:
+        logger.info(f"Docs-report unchanged for {len(unchanged)} drivers (mode={job['unchanged_mode']}), render and upload skipped")
+        if job['unchanged_mode'] == 'reference':
+            lines = ["Без изменений (таблицы отправлялись ранее):"]
+            lines += [f"• {fio} — {records_count}" for fio, records_count in unchanged]
+            for text in split_text_messages(lines):
+                send_telegram_message(config, text, topic_id=topic_id)
 
 
-def main():
-    """Основная функция"""
-    config = load_config()
+def stage_deliver(run: PipelineRun, items: Iterator) -> Iterator:
+    """deliver: отправка единиц каждого задания по мере рендера; дальше идут задания"""
+    items = iter(items)
+    for item in items:
+        if item[0] != 'begin':
+            continue
+        job = item[1]
+        units = _job_units(items)
+        if not job.get('skip'):
+            if job['kind'] == 'late':
+                deliver_late_job(run, job, units)
+            else:
+                deliver_docs_job(run, job, units)
+        # Единицы, которые отправка не забрала (пропуск, ошибка)
+        for _unit in units:
+            pass
+        yield job
+
+
+def stage_persist(run: PipelineRun, items: Iterator) -> Iterator:
+    """persist: сохранение в API, отпечатков docs и обработанных ключей"""
+    config = run.config
+    try:
+        for job in items:
+            if job['kind'] == 'late' and job.get('delivered'):
+                # Сохраняем данные в базу через API за текущую дату в московском времени
+                report_tz = config.get('report_tz', 'Europe/Moscow')
+                try:
+                    tz = ZoneInfo(report_tz)
+                except:
+                    tz = ZoneInfo('UTC')
+                delay_date = datetime.now(tz).date()
+                delay_datetime = datetime.combine(delay_date, datetime.min.time()).replace(tzinfo=tz)
+                save_late_delays_to_api(config, job['records'], delay_datetime)
+                logger.info(f"Successfully processed late-report with {len(job['records'])} unique late records")
+            elif job['kind'] == 'docs' and 'fingerprints' in job:
+                # Сохраняем отпечатки (старше 30 дней удаляем) поверх свежего state:
+                # api_acked мог обновиться параллельно, пока рендерились таблицы
+                max_age_seconds = 30 * 24 * 60 * 60
+                with updated_state(config['state_path']) as state:
+                    state['docs_fingerprints'] = {
+                        fio: entry for fio, entry in job['fingerprints'].items()
+                        if time.time() - entry.get('ts', 0) < max_age_seconds
+                    }
+                unchanged = job['unchanged']
+                logger.info(f"Docs-report completed: {job['sent_count']}/{len(job['unique_fios']) - len(unchanged)} messages sent, {len(unchanged)} unchanged")
+            yield job
+    finally:
+        # Сохраняем обработанные ключи и file_id загруженных за прогон картинок
+        run.mark_content_duplicates()
+        run.save_keys()
+        save_file_id_cache(config)
+
+
+STAGE_FUNCTIONS = {
+    'fetch': stage_fetch,
+    'dedup': stage_dedup,
+    'classify': stage_classify,
+    'parse': stage_parse,
+    'aggregate': stage_aggregate,
+    'render': stage_render,
+    'deliver': stage_deliver,
+    'persist': stage_persist,
+}
+
+_STAGE_DONE = object()
+
+
+def _counted(run: PipelineRun, name: str, items: Iterator) -> Iterator:
+    for item in items:
+        run.counts[name] = run.counts.get(name, 0) + 1
+        yield item
+
+
+def _queue_put(stage_queue: Queue, entry, stop: threading.Event) -> None:
+    # Ограниченная очередь: стадия ждёт, пока следующая разберёт элементы (backpressure)
+    while not stop.is_set():
+        try:
+            stage_queue.put(entry, timeout=0.2)
+            return
+        except Full:
+            continue
+
+
+def _queue_items(stage_queue: Queue, stop: threading.Event) -> Iterator:
+    while not stop.is_set():
+        try:
+            item, error = stage_queue.get(timeout=0.2)
+        except Empty:
+            continue
+        if item is _STAGE_DONE:
+            if error is not None:
+                raise error
+            return
+        yield item
+
+
+def _stage_worker(run: PipelineRun, name: str, items: Iterator, stage_queue: Queue, stop: threading.Event) -> None:
+    error = None
+    try:
+        for item in items:
+            _queue_put(stage_queue, (item, None), stop)
+            run.stats.record_depth(name, stage_queue.qsize())
+    except BaseException as e:
+        error = e
+    finally:
+        _queue_put(stage_queue, (_STAGE_DONE, error), stop)
+
+
+def run_pipeline(config: Dict, processed_keys, stages: Optional[Iterable[str]] = None,
+                 source: Optional[Iterable] = None) -> List:
+    """Прогон конвейера fetch → dedup → classify → parse → aggregate → render → deliver → persist
+
+    stages - непрерывный отрезок PIPELINE_STAGES (по умолчанию PIPELINE_STAGES из конфига или все);
+    source - входные элементы первой стадии, если это не fetch. Возвращает выход последней стадии.
+    Стадии связаны генераторами; с PIPELINE_CONCURRENT=1 каждая работает в своём потоке,
+    между стадиями - очереди на PIPELINE_QUEUE_SIZE элементов.
+    """
+    stages = tuple(stages or config.get('pipeline_stages') or PIPELINE_STAGES)
+    unknown = [name for name in stages if name not in PIPELINE_STAGES]
+    if unknown:
+        raise ValueError(f"Unknown pipeline stages: {', '.join(unknown)}")
+    first = PIPELINE_STAGES.index(stages[0])
+    if stages != PIPELINE_STAGES[first:first + len(stages)]:
+        raise ValueError(f"Pipeline stages must be a contiguous part of {' → '.join(PIPELINE_STAGES)}: {','.join(stages)}")
     
-    logger.info("Starting late-report service")
+    run = PipelineRun(config, processed_keys)
+    concurrent = config.get('pipeline_concurrent', False)
+    stop = threading.Event()
+    threads = []
+    stream = iter(source or ())
+    for name in stages:
+        stream = _counted(run, name, STAGE_FUNCTIONS[name](run, stream))
+        if concurrent:
+            stage_queue = Queue(maxsize=max(1, config.get('pipeline_queue_size', 4)))
+            thread = threading.Thread(target=_stage_worker, args=(run, name, stream, stage_queue, stop),
+                                      name=f"{config.get('tenant') or 'pipeline'}-{name}", daemon=True)
+            thread.start()
+            threads.append(thread)
+            stream = _queue_items(stage_queue, stop)
+    
+    started = time.monotonic()
+    try:
+        results = list(stream)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join(timeout=5)
+    counts = ' '.join(f"{name}={run.counts.get(name, 0)}" for name in stages)
+    stats = run.stats.summary()
+    logger.info(f"Pipeline {'concurrent' if concurrent else 'sequential'} done in {time.monotonic() - started:.1f}s: {counts}" + (f"; {stats}" if stats else ''))
+    return results
+
+
+def process_docs_report(config: Dict, attachments: List[Tuple[int, int, str, bytes, Optional[datetime]]], processed_keys: Dict[str, float]) -> None:
+    """Обработка docs-report (отстающие документы): стадии parse … persist для уже отобранных вложений"""
+    if not config['run_docs_report']:
+        logger.info("Docs-report disabled (RUN_DOCS_REPORT=0)")
+        return
+    run_pipeline(config, processed_keys, stages=PIPELINE_STAGES[PIPELINE_STAGES.index('parse'):],
+                 source=(('docs', attachment, None) for attachment in attachments))
+
+
+class TenantScheduler:
+    """Справедливая очередь тенантов к отправке: свободный слот получает следующий по кругу ожидающий тенант
+
+    Тенант с сотнями таблиц не задерживает остальных: их единицы доставки
+    чередуются, одновременно отправляется не больше slots единиц.
+    """
+    
+    def __init__(self, names: List[str], slots: int = 2):
+        self.order = list(names)
+        self.slots = max(1, slots)
+        self.active = 0
+        self.waiting = {name: 0 for name in self.order}
+        self.next_index = 0
+        self.cond = threading.Condition()
+    
+    def _next_waiting(self) -> Optional[str]:
+        for i in range(len(self.order)):
+            name = self.order[(self.next_index + i) % len(self.order)]
+            if self.waiting[name]:
+                return name
+        return None
+    
+    def acquire(self, name: str) -> None:
+        with self.cond:
+            self.waiting[name] += 1
+            while self.active >= self.slots or self._next_waiting() != name:
+                self.cond.wait()
+            self.waiting[name] -= 1
+            self.active += 1
+            self.next_index = (self.order.index(name) + 1) % len(self.order)
+            # Следующий по кругу тоже может занять свободный слот
+            self.cond.notify_all()
+    
+    def release(self, name: str) -> None:
+        with self.cond:
+            self.active -= 1
+            self.cond.notify_all()
+    
+    @contextmanager
+    def turn(self, name: str):
+        self.acquire(name)
+        try:
+            yield
+        finally:
+            self.release(name)
+
+
+def tenant_turn(config: Dict):
+    """Очередь тенанта к отправке (вне мультитенантного режима - без ожидания)"""
+    scheduler = config.get('tenant_scheduler')
+    return scheduler.turn(config['tenant']) if scheduler is not None else nullcontext()
+
+
+# Файлы состояния, которые у каждого тенанта свои: если путь не задан в конфиге тенанта,
+# файл кладётся в подкаталог с именем тенанта рядом с путём по умолчанию
+TENANT_PATH_KEYS = {
+    'state_path': 'STATE_PATH',
+    'state_file': 'STATE_FILE',
+    'state_db_path': 'STATE_DB_PATH',
+    'state_journal_path': 'STATE_JOURNAL_PATH',
+    'outbox_path': 'OUTBOX_PATH',
+    'api_spool_path': 'API_SPOOL_PATH',
+    'file_id_cache_path': 'FILE_ID_CACHE_PATH',
+}
+
+
+def load_tenant_configs(tenants_file: str) -> List[Dict]:
+    """Конфиги тенантов из TENANTS_FILE: JSON-список объектов с переменными окружения (как в env-файле) и name"""
+    with open(tenants_file, 'r', encoding='utf-8') as f:
+        tenants = json.load(f)
+    if not isinstance(tenants, list) or not tenants:
+        raise ValueError(f"{tenants_file}: expected a non-empty JSON list of tenant objects")
+    
+    configs = []
+    names = set()
+    for i, overrides in enumerate(tenants, start=1):
+        name = str(overrides.get('name') or f"tenant{i}")
+        if name in names:
+            raise ValueError(f"{tenants_file}: duplicate tenant name {name}")
+        names.add(name)
+        config = load_config(overrides)
+        config['tenant'] = name
+        for key, env_name in TENANT_PATH_KEYS.items():
+            if overrides.get(env_name) is None and config.get(key):
+                config[key] = os.path.join(os.path.dirname(config[key]), name, os.path.basename(config[key]))
+        configs.append(config)
+    return configs
+
+
+def run_service(config: Dict) -> None:
+    """Один прогон сервиса для одного конфига: досылка, почта → отчёты → Telegram/API → state"""
+    # Дозапуск сообщений, не доставленных в прошлых запусках, и отложенных сохранений в API
+    drain_outbox(config)
+    replay_api_spool(config)
     
     # Загрузка обработанных ключей (если не включен FORCE_RESEND)
     force_resend = config.get('force_resend', False)
-    if force_resend:
+    if force_resend and config.get('state_backend', 'sqlite') == 'json':
         logger.info("FORCE_RESEND: True -> state filtering disabled")
         processed_keys = {}
     else:
-        processed_keys = load_processed_keys(config['state_file'])
-        logger.info(f"Loaded {len(processed_keys)} processed keys from state")
+        processed_keys = open_processed_keys(config)
+        if force_resend:
+            # Ключи по-прежнему записываются, но при фильтрации не учитываются
+            logger.info("FORCE_RESEND: True -> state filtering disabled")
+        else:
+            logger.info(f"Loaded {len(processed_keys)} processed keys from state")
     
     # DOCS_ONLY режим
     docs_only = config.get('docs_only', False)
@@ -1579,271 +4549,67 @@ def main():
         config['run_late_report'] = False
         config['run_docs_report'] = True
     
-    # Получение вложений из почты
-    attachments = get_email_attachments(config)
-    
-    if not attachments:
-        logger.info("No new attachments found")
-        return
-    
-    logger.info(f"Found {len(attachments)} Excel attachments")
-    
-    # Фильтрация уже обработанных вложений (если не включен FORCE_RESEND)
-    new_attachments = []
-    skipped_count = 0
-    
-    for uid, att_index, filename, file_data, _internaldate in attachments:
-        # Генерируем ключ для вложения: uid:att_index:sha256
-        file_hash = hashlib.sha256(file_data).hexdigest()
-        attachment_key = f"{uid}:{att_index}:{file_hash}"
-        
-        # Проверка на дубликаты (если не включен FORCE_RESEND)
-        if not force_resend:
-            if attachment_key in processed_keys:
-                logger.debug(f"Skipping already processed attachment: {filename} (UID {uid}, key: {attachment_key[:20]}...)")
-                skipped_count += 1
-                continue
-        
-        internaldate = locals().get('internaldate')
-        if internaldate is None:
-            internaldate = datetime.now(ZoneInfo(config.get('report_tz', 'UTC')))
-        new_attachments.append((uid, att_index, filename, file_data, internaldate))
-    
-    logger.info(f"Filtered: {skipped_count} already processed, {len(new_attachments)} new attachments to process")
-    
-    if not new_attachments:
-        logger.info("No new attachments to process")
-        return
-    
-    # Получаем today_msk для фильтрации DOCS по токенам даты
-    # Если задан DOCS_DATE_TOKEN - используем его (для тестов)
-    if config.get('docs_date_token'):
-        date_tokens = [config['docs_date_token']]
-        logger.info(f"DOCS date_token filter (override): {date_tokens[0]}")
-    else:
-        report_tz = config.get('report_tz', 'Europe/Moscow')
-        try:
-            tz = ZoneInfo(report_tz)
-        except Exception:
-            tz = ZoneInfo('UTC')
-        today_msk = datetime.now(tz).date()
-        lookback_days = config.get('imap_lookback_days', 3)
-        date_tokens = [
-            (today_msk - timedelta(days=i)).strftime("%Y_%d_%m")
-            for i in range(0, max(1, lookback_days))
-        ]
-        logger.info(f"DOCS date_token filter: {', '.join(date_tokens)} (today_msk={today_msk})")
+    # Почта → отчёты → Telegram/API → state
+    run_pipeline(config, processed_keys)
+
+
+def run_tenants(config: Dict) -> bool:
+    """Прогон всех тенантов из TENANTS_FILE в одном процессе
+
+    Общие для тенантов: HTTP-пул, пул процессов рендера, шрифты и кэши раскладки,
+    планировщик лимитов Telegram (по токену бота). Тенанты работают параллельно
+    (до TENANT_WORKERS), отправка чередуется по кругу через TenantScheduler.
+    Ошибка одного тенанта не останавливает остальных. Возвращает True, если все прошли без ошибок.
+    """
+    tenant_configs = load_tenant_configs(config['tenants_file'])
+    names = [tenant_config['tenant'] for tenant_config in tenant_configs]
+    logger.info(f"Multi-tenant run: {len(names)} tenants ({', '.join(names)})")
+    # Имя тенанта в логах - через имя потока
+    for handler in logging.getLogger().handlers:
+        handler.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] [%(threadName)s] %(message)s'))
     
-    # Разделение на late и docs отчёты
-    late_attachments = []
-    docs_attachments = []
+    scheduler = TenantScheduler(names, slots=config.get('tenant_delivery_slots', 2))
+    render_workers = max(tenant_config.get('render_workers', 1) for tenant_config in tenant_configs)
+    render_pool = create_render_pool(render_workers) if render_workers > 1 else None
+    for tenant_config in tenant_configs:
+        tenant_config['tenant_scheduler'] = scheduler
+        tenant_config['render_pool'] = render_pool
     
-    for uid, att_index, filename, file_data, internaldate in new_attachments:
+    def run_tenant(tenant_config: Dict) -> bool:
+        threading.current_thread().name = f"tenant:{tenant_config['tenant']}"
+        started = time.monotonic()
         try:
-            # Быстрая проверка типа отчёта
-            # Сначала пробуем парсить как late-report
-            df_test = parse_excel(file_data)
-            report_type = determine_report_type(df_test)
-            
-            # Для DOCS: дополнительная проверка по токену даты в имени файла
-            if report_type == 'docs':
-                # Проверяем, содержит ли filename любой токен даты (даже если кракозябры, цифры сохраняются)
-                filename_str = str(filename) if filename else ''
-                matched_token = next((t for t in date_tokens if t in filename_str), None)
-                if matched_token:
-                    docs_attachments.append((uid, att_index, filename, file_data, internaldate))
-                    logger.info(f"DOCS matched date_token={matched_token}: UID {uid}, filename={filename[:50] if filename else 'N/A'}")
-                else:
-                    logger.debug(f"DOCS skipped (no date_token match): UID {uid}, filename={filename[:50] if filename else 'N/A'}")
-            elif report_type == 'late':
-                late_attachments.append((uid, att_index, filename, file_data, internaldate))
-            else:
-                # Если тип не определился, но файл выглядит как docs (по токену даты) — считаем его docs
-                filename_str = str(filename) if filename else ''
-                matched_token = next((t for t in date_tokens if t in filename_str), None)
-                if matched_token:
-                    docs_attachments.append((uid, att_index, filename, file_data, internaldate))
-                    logger.info(f"DOCS matched date_token={matched_token} for unknown type: UID {uid}, filename={filename[:50] if filename else 'N/A'}")
-                else:
-                    logger.warning(f"Unknown report type for {filename} (UID {uid}), skipping")
+            run_service(tenant_config)
+            logger.info(f"Tenant {tenant_config['tenant']} finished in {time.monotonic() - started:.1f}s")
+            return True
         except Exception as e:
-            logger.debug(f"Failed to determine report type for {filename} (UID {uid}): {e}, will try both parsers")
-            # Если не определили - пробуем оба типа (но для docs всё равно нужен date_token)
-            late_attachments.append((uid, att_index, filename, file_data, internaldate))
-            # Для docs проверяем date_token
-            filename_str = str(filename) if filename else ''
-            matched_token = next((t for t in date_tokens if t in filename_str), None)
-            if matched_token:
-                docs_attachments.append((uid, att_index, filename, file_data, internaldate))
-                logger.debug(f"DOCS matched date_token={matched_token} (fallback): UID {uid}")
+            logger.exception(f"Tenant {tenant_config['tenant']} failed: {e}")
+            return False
     
-    logger.info(f"Classified: {len(late_attachments)} LATE, {len(docs_attachments)} DOCS attachments")
-
-    if late_attachments:
-        report_tz = config.get('report_tz', 'Europe/Moscow')
-        try:
-            tz = ZoneInfo(report_tz)
-        except Exception:
-            tz = ZoneInfo('UTC')
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, config.get('tenant_workers', 4))) as executor:
+            results = list(executor.map(run_tenant, tenant_configs))
+    finally:
+        if render_pool is not None:
+            render_pool.shutdown()
+    failed = [name for name, ok in zip(names, results) if not ok]
+    if failed:
+        logger.error(f"Multi-tenant run: {len(failed)} tenants failed: {', '.join(failed)}")
+    return not failed
 
-        def to_report_date(value: Optional[datetime]) -> Optional[datetime.date]:
-            if not value:
-                return None
-            if isinstance(value, datetime):
-                if value.tzinfo is None:
-                    value = value.replace(tzinfo=ZoneInfo('UTC'))
-                return value.astimezone(tz).date()
-            return None
 
-        dates = [to_report_date(d) for *_rest, d in late_attachments if to_report_date(d)]
-        latest_date = max(dates) if dates else None
-        if latest_date:
-            filtered = []
-            skipped = 0
-            for uid, att_index, filename, file_data, internaldate in late_attachments:
-                att_date = to_report_date(internaldate)
-                if att_date == latest_date:
-                    filtered.append((uid, att_index, filename, file_data, internaldate))
-                else:
-                    file_hash = hashlib.sha256(file_data).hexdigest()
-                    attachment_key = f"{uid}:{att_index}:{file_hash}"
-                    processed_keys[attachment_key] = time.time()
-                    skipped += 1
-            if skipped:
-                save_processed_keys(config['state_file'], processed_keys)
-            late_attachments = filtered
-            logger.info(f"Filtered late-report by latest date {latest_date}: kept {len(filtered)}, skipped {skipped}")
-    
-    # Обработка late-report
-    all_late_records = []
-    late_processed_uids = []
-    late_processed_hashes = []
-    
-    if config['run_late_report'] and late_attachments:
-        logger.info(f"Processing {len(late_attachments)} late-report attachments")
-        
-        for uid, att_index, filename, file_data, _internaldate in late_attachments:
-            # Генерируем ключ для вложения
-            file_hash = hashlib.sha256(file_data).hexdigest()
-            attachment_key = f"{uid}:{att_index}:{file_hash}"
-            
-            try:
-                # Парсинг Excel
-                df = parse_excel(file_data)
-                
-                # Проверка наличия обязательной колонки "Опоздание, мин."
-                if not has_valid_delay_column(df):
-                    logger.warning(f"File {filename} (UID {uid}) does not contain 'Опоздание, мин.' column, skipping")
-                    # Помечаем как обработанное, чтобы не пытаться снова
-                    processed_keys[attachment_key] = time.time()
-                    continue
-            
-                # Извлечение опоздавших
-                records = extract_late_records(df)
-                
-                # Нормализация значений: trim для строковых полей, upper для госномера
-                normalized_records = []
-                for record in records:
-                    normalized_record = {
-                        'driver_name': str(record.get('driver_name', '')).strip(),
-                        'plate_number': str(record.get('plate_number', '')).strip().upper(),
-                        'route_name': str(record.get('route_name', '')).strip(),
-                        'planned_time': str(record.get('planned_time', '')).strip(),
-                        'assigned_time': str(record.get('assigned_time', '')).strip(),
-                        'delay_minutes': int(record.get('delay_minutes', 0)),
-                    }
-                    normalized_records.append(normalized_record)
-                
-                if normalized_records:
-                    all_late_records.extend(normalized_records)
-                    logger.info(f"Found {len(normalized_records)} late records in {filename} (UID {uid}, key: {attachment_key[:20]}...)")
-                else:
-                    logger.info(f"No late records in {filename} (UID {uid}), but file processed")
-                
-                # Сохраняем ключ СРАЗУ после обработки файла (независимо от отправки)
-                processed_keys[attachment_key] = time.time()
-                # Сохраняем state сразу после каждого файла
-                save_processed_keys(config['state_file'], processed_keys)
-            except Exception as e:
-                logger.error(f"Error processing {filename} (UID {uid}): {e}")
-                import traceback
-                traceback.print_exc()
-    
-    if not all_late_records and not config['send_if_empty'] and not (config.get('run_docs_report') and docs_attachments):
-        logger.info("No late records found in all attachments")
-        # Сохраняем state даже если нет записей
-        save_processed_keys(config['state_file'], processed_keys)
+def main():
+    """Основная функция"""
+    config = load_config()
+    
+    logger.info("Starting late-report service")
+    
+    if config.get('tenants_file'):
+        if not run_tenants(config):
+            raise SystemExit(1)
         return
     
-    # Обработка late-report только если есть записи или включена отправка пустых отчётов
-    if all_late_records or config['send_if_empty']:
-        logger.info(f"Total late records before deduplication: {len(all_late_records)}")
-        
-        # Дедупликация: группировка по (fio, route_name, plan_time) и оставление записи с максимальным delay
-        # Используем словарь для группировки
-        dedup_dict = {}
-        for record in all_late_records:
-            # Ключ для дедупликации: (driver_name, route_name, planned_time)
-            key = (
-                record.get('driver_name', '').strip(),
-                record.get('route_name', '').strip(),
-                record.get('planned_time', '').strip()
-            )
-            
-            # Если такой ключ уже есть, сравниваем delay и оставляем запись с большим delay
-            if key in dedup_dict:
-                if record.get('delay_minutes', 0) > dedup_dict[key].get('delay_minutes', 0):
-                    dedup_dict[key] = record
-            else:
-                dedup_dict[key] = record
-        
-        unique_records = list(dedup_dict.values())
-        logger.info(f"Total late records after deduplication: {len(unique_records)}")
-        
-        # Сортировка по delay по убыванию
-        unique_records.sort(key=lambda x: x.get('delay_minutes', 0), reverse=True)
-        
-        # Генерация PNG
-        temp_png = '/tmp/late_report.png'
-        if generate_png_table(unique_records, temp_png):
-            # Формирование подписи
-            caption = format_caption(unique_records)
-            
-            # Отправка в Telegram с topic_id для late-report
-            topic_id_late = int(config.get('tg_topic_id_late', 26))
-            if send_telegram_photo(config, temp_png, caption, topic_id=topic_id_late):
-                # Если подпись обрезалась, отправить остаток текстом
-                full_caption = format_caption(unique_records)
-                if len(full_caption) > 1024:
-                    remaining = '\n'.join([f"{get_delay_emoji(r['delay_minutes'])} {r['driver_name']} — {r['delay_minutes']}" 
-                                          for r in unique_records[len(caption.split('\n')):]])
-                    send_telegram_text(config, remaining)
-                
-                # Сохраняем данные в базу через API
-                # Используем текущую дату в московском времени
-                report_tz = config.get('report_tz', 'Europe/Moscow')
-                try:
-                    tz = ZoneInfo(report_tz)
-                except:
-                    tz = ZoneInfo('UTC')
-                delay_date = datetime.now(tz).date()
-                delay_datetime = datetime.combine(delay_date, datetime.min.time()).replace(tzinfo=tz)
-                save_late_delays_to_api(config, unique_records, delay_datetime)
-                
-                logger.info(f"Successfully processed late-report with {len(unique_records)} unique late records")
-            else:
-                logger.error("Failed to send late-report to Telegram")
-                # Ключи уже сохранены выше после обработки файлов, но сохраняем еще раз для надежности
-                save_processed_keys(config['state_file'], processed_keys)
-        
-        # Очистка временного файла
-        if os.path.exists(temp_png):
-            os.remove(temp_png)
-    
-    # Обработка docs-report
-    if config['run_docs_report'] and docs_attachments:
-        logger.info(f"Processing {len(docs_attachments)} docs-report attachments")
-        process_docs_report(config, docs_attachments, processed_keys)
+    run_service(config)
 
 
 if __name__ == '__main__':
@@ -12,7 +12,7 @@ from late_report import (
     get_delay_emoji, get_file_hash, mark_email_seen,
     decode_filename, is_excel_file, has_valid_delay_column,
     detect_report_type, parse_docs_excel, generate_png_table_docs, process_docs_report,
-    load_processed_keys, save_processed_keys
+    open_processed_keys, save_processed_keys
 )
 from imapclient import IMAPClient
 from datetime import datetime, timedelta
@@ -163,7 +163,7 @@ def main():
     logger.info(f"STATE_FILE: {config.get('state_file')}")
     
     # Загрузка обработанных ключей
-    processed_keys = load_processed_keys(config.get('state_file', '/opt/fuel-control/tools/late-report/state/processed.json'))
+    processed_keys = open_processed_keys(config)
     logger.info(f"Loaded {len(processed_keys)} processed keys from state")
     
     # Получение вложений (последние TEST_LIMIT писем за сегодня)
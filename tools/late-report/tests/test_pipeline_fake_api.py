@@ -0,0 +1,479 @@
+"""Прогон конвейера late_report против локального fake Telegram Bot API"""
+import gzip
+import io
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from email.message import EmailMessage
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import late_report  # noqa: E402
+from fake_telegram_api import start_fake_telegram_api  # noqa: E402
+
+DATE_TOKEN = '2026_19_10'
+
+
+def docs_xlsx(drivers: int, rows: int = 2) -> bytes:
+    """docs-report с drivers водителями по rows строк"""
+    records = [
+        {
+            'ФИО водителя': f'Водитель{i:02d} Имя Отчество',
+            'Код получателя': str(1000 + j),
+            'Компания получателя': 'ООО Ромашка',
+            'Пункт назначения': f'г. Москва, склад {j}',
+            'Дата ТТН': '2026-10-18',
+            'Номер ТТН': str(5550000 + i * 10 + j),
+            'Причина некорректности ТТН': 'Нет подписи получателя',
+            'Срок ожидания документов по маршруту': '2026-10-30',
+        }
+        for i in range(drivers) for j in range(rows)
+    ]
+    buffer = io.BytesIO()
+    pd.DataFrame(records).to_excel(buffer, index=False)
+    return buffer.getvalue()
+
+
+def late_xlsx(rows: int) -> bytes:
+    """late-report с rows опозданиями"""
+    records = [
+        {
+            'ФИО водителя': f'Иванов{i:02d} Иван',
+            'Госномер': f'а{i:03d}вс77',
+            'Типовой маршрут наименование': f'Маршрут {i % 4}',
+            'Плановое время': '08:00',
+            'Назначенное время': f'08:{i:02d}',
+            'Опоздание, мин.': i * 3,
+        }
+        for i in range(1, rows + 1)
+    ]
+    buffer = io.BytesIO()
+    pd.DataFrame(records).to_excel(buffer, index=False)
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def fake_api():
+    servers = []
+
+    def start(**options):
+        server, base_url = start_fake_telegram_api(**options)
+        servers.append(server)
+        return server, base_url
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def make_config(tmp_path, monkeypatch):
+    monkeypatch.setenv('LATE_REPORT_ENV', str(tmp_path / 'missing.env'))
+
+    def make(base_url: str, **overrides) -> dict:
+        config = late_report.load_config({
+            # Планировщик лимитов общий на токен: у каждого теста свой
+            'TG_TOKEN': f'test-{uuid.uuid4().hex}',
+            'TG_CHAT_ID': '-100123',
+            'TG_API_BASE': base_url,
+            'RUN_LATE_REPORT': False,
+            'DOCS_DATE_TOKEN': DATE_TOKEN,
+            'DOCS_DELIVERY': 'single',
+            'RENDER_WORKERS': 1,
+            'STATE_PATH': tmp_path / 'state.json',
+            'STATE_FILE': tmp_path / 'processed.json',
+            'STATE_DB_PATH': tmp_path / 'processed.sqlite',
+            'STATE_JOURNAL_PATH': tmp_path / 'processed.journal',
+            'OUTBOX_PATH': tmp_path / 'outbox.sqlite',
+            'FILE_ID_CACHE_PATH': tmp_path / 'file_ids.json',
+            'API_SPOOL_PATH': tmp_path / 'api_spool.jsonl',
+            'API_BASE_URL': '',
+        })
+        config.update(overrides)
+        return config
+
+    return make
+
+
+def run_docs(config: dict, processed_keys, drivers: int) -> None:
+    attachment = (1, 0, f'docs_{DATE_TOKEN}.xlsx', docs_xlsx(drivers), None)
+    late_report.run_pipeline(config, processed_keys, stages=late_report.PIPELINE_STAGES[1:], source=[attachment])
+
+
+def png_page(index: int) -> bytes:
+    buffer = io.BytesIO()
+    Image.new('RGB', (40 + index, 20), color='white').save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def driver_captions(server) -> list:
+    return [message['caption'] for message in server.state.messages if message.get('caption')]
+
+
+@pytest.mark.parametrize('engine', ['sync', 'async'])
+def test_delivery_keeps_driver_order(fake_api, make_config, engine):
+    server, base_url = fake_api(latency_ms=5, jitter_ms=40)
+    config = make_config(base_url, delivery_engine=engine, async_uploads=4,
+                         tg_chat_rate=1000.0, tg_chat_burst=1000.0, tg_global_rate=1000.0)
+
+    run_docs(config, {}, drivers=8)
+
+    expected = [f'Отстающие документы для Водитель{i:02d} Имя Отчество' for i in range(8)]
+    assert driver_captions(server) == expected
+
+
+def test_rate_limited_album_is_delivered(fake_api, make_config):
+    # Альбом из 6 таблиц дороже лимита чата: принимается, когда окно пусто
+    server, base_url = fake_api(chat_limit=3, chat_window=1)
+    config = make_config(base_url, docs_delivery='album', tg_chat_rate=50.0, tg_chat_burst=50.0)
+
+    run_docs(config, {}, drivers=6)
+
+    assert server.state.stats['rate_limited'] >= 1
+    assert len(driver_captions(server)) == 6
+    assert server.state.stats['by_method']['sendMediaGroup'].get('200') == 1
+
+
+@pytest.mark.parametrize('backend', ['sqlite', 'journal', 'json'])
+def test_dry_run_does_not_persist_keys(fake_api, make_config, backend):
+    server, base_url = fake_api()
+    config = make_config(base_url, state_backend=backend, dry_run=True)
+    processed_keys = late_report.open_processed_keys(config)
+
+    run_docs(config, processed_keys, drivers=3)
+    if hasattr(processed_keys, 'close'):
+        processed_keys.close()
+
+    assert server.state.messages == []
+    config = make_config(base_url, state_backend=backend)
+    processed_keys = late_report.open_processed_keys(config)
+    assert len(processed_keys) == 0
+
+    run_docs(config, processed_keys, drivers=3)
+    assert len(driver_captions(server)) == 3
+
+
+@pytest.mark.parametrize('pages', [11, 21])
+def test_pages_split_into_valid_albums(fake_api, make_config, pages):
+    # Telegram не принимает альбом из одного фото: 11 страниц - это 6+5, а не 10+1
+    server, base_url = fake_api()
+    config = make_config(base_url, tg_chat_rate=1000.0, tg_chat_burst=1000.0, tg_global_rate=1000.0)
+    photos = [png_page(i) for i in range(pages)]
+    captions = ['Таблица'] + [None] * (pages - 1)
+
+    requests_list = late_report.telegram_photos_requests(config, photos, captions, topic_id=None)
+    done = late_report.deliver_requests(config, requests_list)
+
+    assert done == len(requests_list)
+    assert all(2 <= cost <= 10 for method, cost, _ in requests_list if method == 'sendMediaGroup')
+    assert len(server.state.messages) == pages
+    assert late_report.send_telegram_photos(config, photos, 'Таблица')
+    assert len(server.state.messages) == 2 * pages
+
+
+def test_async_units_overlap_across_topics_and_keep_order_within(fake_api, make_config):
+    server, base_url = fake_api(latency_ms=200)
+    config = make_config(base_url, delivery_engine='async', async_uploads=4,
+                         tg_chat_rate=1000.0, tg_chat_burst=1000.0, tg_global_rate=1000.0)
+    units = [
+        ([(f'{topic}-{i}', 1)], [('sendMessage', 1, late_report.telegram_message_request(config, f'{topic}-{i}', topic))])
+        for i in range(3) for topic in (2, 26)
+    ]
+    results = []
+
+    started = time.monotonic()
+    late_report.deliver_units(config, units, lambda drivers, ok: results.append((drivers[0][0], ok)))
+    elapsed = time.monotonic() - started
+
+    assert all(ok for _, ok in results) and len(results) == 6
+    for topic in (2, 26):
+        texts = [m['text'] for m in server.state.messages if m.get('message_thread_id') == topic]
+        assert texts == [f'{topic}-{i}' for i in range(3)]
+    # Две темы параллельно: около 3 задержек вместо 6
+    assert elapsed < 6 * 0.2 * 0.8
+
+
+def test_file_id_cache_written_once_and_reused(fake_api, make_config, monkeypatch):
+    server, base_url = fake_api()
+    config = make_config(base_url, tg_chat_rate=1000.0, tg_chat_burst=1000.0, tg_global_rate=1000.0)
+    writes = []
+    atomic_write_json = late_report.atomic_write_json
+
+    def counting_write(path, data, **kwargs):
+        writes.append(str(path))
+        return atomic_write_json(path, data, **kwargs)
+
+    monkeypatch.setattr(late_report, 'atomic_write_json', counting_write)
+    run_docs(config, {}, drivers=5)
+
+    assert writes.count(config['file_id_cache_path']) == 1
+    uploaded = server.state.stats['uploaded_bytes']
+    assert uploaded > 0
+
+    # Те же картинки во втором прогоне уходят по file_id, без загрузки
+    late_report._FILE_ID_CACHES.pop(config['file_id_cache_path'], None)
+    os.remove(config['outbox_path'])
+    run_docs(config, {}, drivers=5)
+    assert server.state.stats['uploaded_bytes'] == uploaded
+    assert len(driver_captions(server)) == 10
+
+
+def test_concurrent_docs_persist_keeps_api_acked(fake_api, make_config, monkeypatch):
+    # docs-задача читает state до того, как late-задача подтвердит записи в API
+    server, base_url = fake_api()
+    config = make_config(base_url, pipeline_concurrent=True, run_late_report=True,
+                         api_base_url='http://backend.invalid', attachment_name_regex='',
+                         tg_chat_rate=1000.0, tg_chat_burst=1000.0, tg_global_rate=1000.0)
+
+    posted = []
+
+    def slow_post(config, url, chunk, session=None):
+        time.sleep(0.3)
+        posted.extend(chunk)
+        return True, len(chunk), None
+
+    monkeypatch.setattr(late_report, '_post_api_chunk', slow_post)
+    source = [
+        (1, 0, 'Соблюдение сроков.xlsx', late_xlsx(5), None),
+        (2, 0, f'docs_{DATE_TOKEN}.xlsx', docs_xlsx(3), None),
+    ]
+    late_report.run_pipeline(config, {}, stages=late_report.PIPELINE_STAGES[1:], source=source)
+
+    state = late_report.load_state(config['state_path'])
+    assert posted and set(state.get('api_acked', {})) == {record['record_key'] for record in posted}
+    assert len(state.get('docs_fingerprints', {})) == 3
+
+
+def outbox_statuses(config: dict) -> list:
+    conn = late_report.open_outbox(config)
+    try:
+        return [status for (status,) in conn.execute('SELECT status FROM outbox ORDER BY id')]
+    finally:
+        conn.close()
+
+
+def expire_outbox_backoff(config: dict) -> None:
+    conn = late_report.open_outbox(config)
+    with conn:
+        conn.execute('UPDATE outbox SET next_attempt = 0')
+    conn.close()
+
+
+def test_outbox_redelivers_failed_units_on_next_run(fake_api, make_config):
+    server, base_url = fake_api(error_rate=1.0)
+    config = make_config(base_url, tg_max_retries=0,
+                         tg_chat_rate=1000.0, tg_chat_burst=1000.0, tg_global_rate=1000.0)
+
+    run_docs(config, {}, drivers=3)
+    assert server.state.messages == []
+    assert outbox_statuses(config) == ['pending'] * 3
+
+    # До конца backoff единицы не повторяются
+    server.state.error_rate = 0
+    late_report.drain_outbox(config)
+    assert server.state.messages == []
+
+    expire_outbox_backoff(config)
+    late_report.drain_outbox(config)
+    assert driver_captions(server) == [f'Отстающие документы для Водитель{i:02d} Имя Отчество' for i in range(3)]
+    assert outbox_statuses(config) == ['sent'] * 3
+
+    # Повторный прогон того же отчёта ничего не отправляет (идемпотентность)
+    run_docs(config, {}, drivers=3)
+    assert len(driver_captions(server)) == 3
+
+
+def test_outbox_gives_up_after_max_attempts(fake_api, make_config):
+    server, base_url = fake_api(error_rate=1.0)
+    config = make_config(base_url, tg_max_retries=0, outbox_max_attempts=2, docs_delivery='album',
+                         tg_chat_rate=1000.0, tg_chat_burst=1000.0, tg_global_rate=1000.0)
+
+    run_docs(config, {}, drivers=2)
+    expire_outbox_backoff(config)
+    late_report.drain_outbox(config)
+    assert set(outbox_statuses(config)) == {'dead'}
+
+    server.state.error_rate = 0
+    expire_outbox_backoff(config)
+    late_report.drain_outbox(config)
+    assert server.state.messages == []
+
+
+def test_journal_prune_compacts_removed_keys(tmp_path):
+    path = str(tmp_path / 'processed.journal')
+    store = late_report.JournalKeyStore(path, fsync_batch=3)
+    old_ts = time.time() - 40 * 24 * 60 * 60
+    store.update({f'1:{i}:old{i}': old_ts for i in range(10)})
+    store.update({f'2:{i}:new{i}': time.time() for i in range(5)})
+    store['2:0:new0'] = time.time()
+    assert store.lines == 16
+
+    store.prune(max_age_days=30)
+    store.close()
+
+    with open(path, encoding='utf-8') as f:
+        assert len(f.readlines()) == 5
+    reopened = late_report.JournalKeyStore(path)
+    assert sorted(reopened.keys) == [f'2:{i}:new{i}' for i in range(5)]
+    reopened.close()
+
+
+def test_journal_drops_torn_tail(tmp_path):
+    path = str(tmp_path / 'processed.journal')
+    store = late_report.JournalKeyStore(path)
+    store['1:0:aaa'] = time.time()
+    store.close()
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write('17000')
+
+    store = late_report.JournalKeyStore(path)
+    store['1:1:bbb'] = time.time()
+    store.close()
+
+    assert set(late_report.JournalKeyStore(path).keys) == {'1:0:aaa', '1:1:bbb'}
+
+
+def test_duplicate_content_is_processed_once(fake_api, make_config):
+    server, base_url = fake_api()
+    config = make_config(base_url, tg_chat_rate=1000.0, tg_chat_burst=1000.0, tg_global_rate=1000.0)
+    data = docs_xlsx(2)
+    processed_keys = {}
+    source = [
+        (1, 0, f'docs_{DATE_TOKEN}.xlsx', data, None),
+        (2, 0, f'docs_{DATE_TOKEN} (копия).xlsx', data, None),
+    ]
+
+    late_report.run_pipeline(config, processed_keys, stages=late_report.PIPELINE_STAGES[1:], source=source)
+
+    # Отчёт уходит один раз; ключ копии отмечается вслед за обработанным оригиналом
+    assert len(driver_captions(server)) == 2
+    assert set(processed_keys) == {late_report.attachment_key(1, 0, data), late_report.attachment_key(2, 0, data)}
+
+    late_report.run_pipeline(config, processed_keys, stages=late_report.PIPELINE_STAGES[1:], source=source[1:])
+    assert len(driver_captions(server)) == 2
+
+
+class FakeBodyPart(tuple):
+    """Лист BODYSTRUCTURE: размер части - седьмое поле"""
+    is_multipart = False
+
+
+class FakeIMAPClient:
+    """IMAPClient с одним письмом; считает скачивания RFC822"""
+    message = b''
+    downloads = 0
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def login(self, user, password):
+        pass
+
+    def select_folder(self, mailbox):
+        return {b'UIDVALIDITY': 7}
+
+    def search(self, criteria):
+        return [1]
+
+    def fetch(self, uids, items):
+        if 'RFC822' in items:
+            FakeIMAPClient.downloads += 1
+            return {uid: {b'RFC822': self.message, b'INTERNALDATE': None} for uid in uids}
+        body = FakeBodyPart(('application', 'octet-stream', None, None, None, 'base64', len(self.message)))
+        return {uid: {b'BODYSTRUCTURE': body, b'RFC822.SIZE': len(self.message)} for uid in uids}
+
+
+def test_meta_index_skips_download_of_processed_message(make_config, monkeypatch):
+    message = EmailMessage()
+    message['Message-ID'] = '<docs@example.com>'
+    message.set_content('docs')
+    message.add_attachment(docs_xlsx(1), maintype='application', subtype='vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+                           filename=f'docs_{DATE_TOKEN}.xlsx')
+    FakeIMAPClient.message = message.as_bytes()
+    FakeIMAPClient.downloads = 0
+    monkeypatch.setattr(late_report, 'IMAPClient', FakeIMAPClient)
+    config = make_config('http://telegram.invalid', imap_user='user', imap_pass='pass', attachment_regex='')
+    processed_keys = {}
+
+    attachments = list(late_report.iter_email_attachments(config, processed_keys))
+    assert len(attachments) == 1 and FakeIMAPClient.downloads == 1
+    uid, att_index, _, file_data, _ = attachments[0]
+    processed_keys[late_report.attachment_key(uid, att_index, file_data)] = time.time()
+
+    assert list(late_report.iter_email_attachments(config, processed_keys)) == []
+    assert FakeIMAPClient.downloads == 1
+    # Без ключа вложения письмо снова скачивается
+    assert len(list(late_report.iter_email_attachments(config, {}))) == 1
+    assert FakeIMAPClient.downloads == 2
+
+
+def test_api_chunk_is_gzipped_with_api_key(make_config):
+    received = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            received.append((dict(self.headers), body))
+            payload = json.dumps({'saved': 2}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        config = make_config('http://telegram.invalid', api_gzip=True, api_key='secret')
+        records = [{'record_key': 'a', 'driver_name': 'Иванов'}, {'record_key': 'b', 'driver_name': 'Петров'}]
+        url = f'http://127.0.0.1:{server.server_address[1]}/api/late-delays'
+
+        assert late_report._post_api_chunk(config, url, records) == (True, 2, '')
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    headers, body = received[0]
+    assert headers['Content-Encoding'] == 'gzip' and headers['X-Api-Key'] == 'secret'
+    assert json.loads(gzip.decompress(body)) == {'records': records}
+
+
+def test_rate_limiter_shared_between_threads():
+    # 20 токенов сразу, дальше 200 в секунду: 100 отправок из 8 потоков - не быстрее 0.4 с
+    limiter = late_report.TelegramRateLimiter({'tg_global_rate': 200.0, 'tg_chat_rate': 1000.0, 'tg_chat_burst': 20.0})
+    limiter.global_bucket = late_report.TokenBucket(200.0, 20.0)
+    sessions = []
+
+    def worker(count):
+        sessions.append(late_report.get_http_session({}))
+        for _ in range(count):
+            limiter.acquire('-100123')
+
+    threads = [threading.Thread(target=worker, args=(count,)) for count in (13,) * 4 + (12,) * 4]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    assert elapsed >= 0.4 * 0.9
+    assert len({id(session) for session in sessions}) == 1